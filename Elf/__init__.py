@@ -20,6 +20,7 @@ Send bug reports to Invisigoth or Metr0.
 # Copyright (C) 2007 Invisigoth - See LICENSE file for details
 import os
 import sys
+import mmap
 import struct
 import traceback
 import zlib
@@ -29,6 +30,16 @@ from Elf.elf_lookup import *
 
 verbose = False
 
+# Elf attributes which are parsed on first use (and the method to do it)
+lazy_attrs = {
+    "symbols":"parseSymbols",
+    "symbols_by_name":"parseSymbols",
+    "symbols_by_addr":"parseSymbols",
+    "dynamic_symbols":"parseDynamic",
+    "dynamics":"parseDynamic",
+    "relocs":"parseRelocs",
+}
+
 class Elf:
 
     """
@@ -46,9 +57,6 @@ class Elf:
         self.sections = []
         self.pheaders = []
         self.secnames = {}
-        self.symbols = []
-        self.symbols_by_name = {}
-        self.symbols_by_addr = {}
         self.e_ident = "NOTHINGHEREATALL"
         self.e_type = 0
         self.e_machine = 0
@@ -75,7 +83,7 @@ class Elf:
 
         if len(initstr) > 0:
             if os.path.exists(initstr):
-                bytes = file(initstr, "rb").read()
+                bytes = self._mapFile(initstr)
                 self.myname = initstr
 
             self.initFromBytes(bytes)
@@ -127,9 +135,30 @@ class Elf:
                     sec.setName(name)
                     self.secnames[name] = sec
 
-        self.parseSymbols()
-        self.parseDynamic()
-        self.parseRelocs()
+        # The symbols, dynamics and relocs are parsed on first use
+        # (see __getattr__)
+
+    def _mapFile(self, filename):
+        # Map the file read only rather than reading it all in
+        f = file(filename, "rb")
+        try:
+            try:
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (mmap.error, ValueError), e:
+                return f.read() # Empty files (and odd platforms) can't be mapped
+        finally:
+            f.close()
+
+    def __getattr__(self, name):
+        """
+        Parse the symbols, dynamics and relocs the first time
+        they are asked for.
+        """
+        parser = lazy_attrs.get(name)
+        if parser == None:
+            raise AttributeError(name)
+        getattr(self, parser)()
+        return self.__dict__[name]
 
     def getName(self):
         return self.myname
@@ -189,9 +218,13 @@ class Elf:
  
 
     def getStrtabString(self, offset, section=".strtab"):
-        bytes = self.getSection(section).getBytes()
-        index = bytes.find("\x00", offset)
-        return bytes[offset:index]
+        sec = self.getSection(section)
+        start = sec.sh_offset + offset
+        end = sec.sh_offset + sec.sh_size
+        index = self.data.find("\x00", start, end)
+        if index == -1:
+            index = end
+        return self.data[start:index]
 
     def initFromBytes(self, bytes):
 
@@ -407,27 +440,65 @@ class Elf:
     def getSymbols(self):
         return self.symbols
 
-    def parseSymbols(self):
+    def _iterEntries(self, sec, cls):
+        # Yield the cls entries parsed from a section using offsets
+        # into the file data (no copies of the rest of the table)
+        if sec.sh_type == SHT_NOBITS:
+            return
+        data = self.data
+        size = len(cls())
+        off = sec.sh_offset
+        end = min(off + sec.sh_size, len(data))
+        while off + size <= end:
+            ent = cls()
+            ent.initFromBuffer(data, off)
+            yield ent
+            off += size
+
+    def _getSymbolClass(self):
+        if self.bits == 32:
+            return Elf32Symbol
+        elif self.bits == 64:
+            return Elf64Symbol
+        raise Exception('Platform not supported: %d' % (self.bits))
+
+    def iterSymbols(self):
         """
-        Parse out the symbols that this elf binary has for us.
+        Yield the symbols from the symbol table section(s) one at a
+        time (without parsing them all or keeping them around).
         """
+        symclass = self._getSymbolClass()
         for sec in self.sections:
             if sec.sh_type == SHT_SYMTAB:
-                symtab = sec.getBytes()
-                while symtab:
-                    if self.bits == 32:
-                        newsym = Elf32Symbol(symtab)
-                    elif self.bits == 64:
-                        newsym = Elf64Symbol(symtab)
-                    else:
-                        raise Exception('Platform not supported: %d' % (self.bits))
-
+                for newsym in self._iterEntries(sec, symclass):
                     #FIXME this is dorked!
                     if newsym.st_name:
                         name = self.getStrtabString(newsym.st_name, ".strtab")
                         newsym.setName(name)
-                    self.addSymbol(newsym)
-                    symtab = symtab[len(newsym):]
+                    yield newsym
+
+    def iterDynSyms(self):
+        """
+        Yield the dynamic symbols one at a time (see iterSymbols).
+        """
+        sec = self.getSection(".dynsym")
+        if not sec:
+            return
+        for newsym in self._iterEntries(sec, self._getSymbolClass()):
+            if newsym.st_name:
+                name = self.getStrtabString(newsym.st_name, ".dynstr")
+                newsym.setName(name)
+            yield newsym
+
+    def parseSymbols(self):
+        """
+        Parse out the symbols that this elf binary has for us.
+        """
+        self.symbols = []
+        self.symbols_by_name = {}
+        self.symbols_by_addr = {}
+        for newsym in self.iterSymbols():
+            self.addSymbol(newsym)
 
     def parseRelocs(self):
         """
@@ -437,40 +508,32 @@ class Elf:
         self.relocs = []
         for sec in self.sections:
             if sec.sh_type == SHT_REL:
-                bytes = sec.getBytes()
-                while bytes:
-                    if self.bits == 32:
-                        reloc = Elf32Reloc(bytes)
-                    elif self.bits == 64:
-                        reloc = Elf64Reloc(bytes)
-                    else:
-                        raise Exception('Platform not supported: %d' % (self.bits))
-                    index = reloc.getSymTabIndex()
-                    try:
-                        sym = self.dynamic_symbols[index]
-                        reloc.setName(sym.getName())
-                    except:
-                        traceback.print_exc()
-                    self.relocs.append(reloc)
-                    bytes = bytes[len(reloc):]
+                if self.bits == 32:
+                    cls = Elf32Reloc
+                elif self.bits == 64:
+                    cls = Elf64Reloc
+                else:
+                    raise Exception('Platform not supported: %d' % (self.bits))
 
             elif sec.sh_type == SHT_RELA:
-                bytes = sec.getBytes()
-                while bytes:
-                    if self.bits == 32:
-                        reloc = Elf32Reloca(bytes)
-                    elif self.bits == 64:
-                        reloc = Elf64Reloca(bytes)
-                    else:
-                        raise Exception('Platform not supported: %d' % (self.bits))
-                    index = reloc.getSymTabIndex()
-                    try:
-                        sym = self.dynamic_symbols[index]
-                        reloc.setName(sym.getName())
-                    except:
-                        traceback.print_exc()
-                    self.relocs.append(reloc)
-                    bytes = bytes[len(reloc):]
+                if self.bits == 32:
+                    cls = Elf32Reloca
+                elif self.bits == 64:
+                    cls = Elf64Reloca
+                else:
+                    raise Exception('Platform not supported: %d' % (self.bits))
+
+            else:
+                continue
+
+            for reloc in self._iterEntries(sec, cls):
+                index = reloc.getSymTabIndex()
+                try:
+                    sym = self.dynamic_symbols[index]
+                    reloc.setName(sym.getName())
+                except:
+                    traceback.print_exc()
+                self.relocs.append(reloc)
 
     def parseDynamic(self):
         self.dynamic_symbols = []
@@ -479,30 +542,17 @@ class Elf:
         if not sec:
             return
 
-        symtab = sec.getBytes()
+        self.dynamic_symbols = list(self.iterDynSyms())
 
-        while symtab:
-            if self.bits == 32:
-                newsym = Elf32Symbol(symtab)
-            elif self.bits == 64:
-                newsym = Elf64Symbol(symtab)
-            else:
-                raise Exception('Platform not supported: %d' % (self.bits))
-            if newsym.st_name:
-                name = self.getStrtabString(newsym.st_name, ".dynstr")
-                newsym.setName(name)
-            self.dynamic_symbols.append(newsym)
-            symtab = symtab[len(newsym):]
+        if self.bits == 32:
+            cls = Elf32Dynamic
+        elif self.bits == 64:
+            cls = Elf64Dynamic
+        else:
+            raise Exception('Platform not supported: %d' % (self.bits))
 
         dynsec = self.getSection(".dynamic")
-        dynbytes = dynsec.getBytes()
-        while dynbytes:
-            if self.bits == 32:
-                dyn = Elf32Dynamic(dynbytes)
-            elif self.bits == 64:
-                dyn = Elf64Dynamic(dynbytes)
-            else:
-                raise Exception('Platform not supported: %d' % (self.bits))
+        for dyn in self._iterEntries(dynsec, cls):
             if dyn.d_tag in Elf32Dynamic.has_string:
                 name = self.getStrtabString(dyn.d_value, ".dynstr")
                 dyn.setName(name)
@@ -510,7 +560,6 @@ class Elf:
             self.dynamics.append(dyn)
             if dyn.d_tag == DT_NULL: # Represents the end
                 break
-            dynbytes = dynbytes[len(dyn):]
 
     def getDynamics(self):
         return self.dynamics
@@ -544,7 +593,10 @@ class Elf32Dynamic:
         return "%s %s" % (name,self.getTypeName())
 
     def initFromBytes(self, bytes):
-        self.d_tag,self.d_value = struct.unpack("2L", bytes[:len(self)])
+        self.initFromBuffer(bytes, 0)
+
+    def initFromBuffer(self, buf, offset):
+        self.d_tag,self.d_value = struct.unpack_from("2L", buf, offset)
 
     def getName(self):
         return self.name
@@ -559,8 +611,8 @@ class Elf32Dynamic:
         return struct.calcsize("2L")
 
 class Elf64Dynamic(Elf32Dynamic):
-    def initFromBytes(self, bytes):
-        self.d_tag,self.d_value = struct.unpack("2Q", bytes[:len(self)])
+    def initFromBuffer(self, buf, offset):
+        self.d_tag,self.d_value = struct.unpack_from("2Q", buf, offset)
 
     def __len__(self):
         return struct.calcsize("2Q")
@@ -584,7 +636,10 @@ class Elf32Reloc:
         return "%s %s <%s>" % (hex(self.r_offset),self.getName(),self.getTypeName())
 
     def initFromBytes(self,bytes):
-        (self.r_offset, self.r_info) = struct.unpack("2L",bytes[:len(self)])
+        self.initFromBuffer(bytes, 0)
+
+    def initFromBuffer(self, buf, offset):
+        (self.r_offset, self.r_info) = struct.unpack_from("2L", buf, offset)
 
     def setName(self, name):
         self.name = name
@@ -609,15 +664,15 @@ class Elf32Reloca(Elf32Reloc):
         self.r_addend = 0
         Elf32Reloc.__init__(self, bytes)
 
-    def initFromBytes(self, bytes):
-        (self.r_offset, self.r_info, self.r_addend) = struct.unpack("3L", bytes[:len(self)])
+    def initFromBuffer(self, buf, offset):
+        (self.r_offset, self.r_info, self.r_addend) = struct.unpack_from("3L", buf, offset)
 
     def __len__(self):
         return struct.calcsize("3L")
 
 class Elf64Reloc(Elf32Reloc):
-    def initFromBytes(self, bytes):
-        self.r_offset, self.r_info = struct.unpack('2Q', bytes[:len(self)])
+    def initFromBuffer(self, buf, offset):
+        self.r_offset, self.r_info = struct.unpack_from('2Q', buf, offset)
 
     def getType(self):
         return self.r_info & 0xffffffff
@@ -633,8 +688,8 @@ class Elf64Reloca(Elf64Reloc):
         self.r_addend = 0
         Elf64Reloc.__init__(self, bytes)
 
-    def initFromBytes(self, bytes):
-        self.r_offset, self.r_info, self.r_addend = struct.unpack('3Q', bytes[:len(self)])
+    def initFromBuffer(self, buf, offset):
+        self.r_offset, self.r_info, self.r_addend = struct.unpack_from('3Q', buf, offset)
 
     def __len__(self):
         return struct.calcsize("3Q")
@@ -675,12 +730,15 @@ class Elf32Symbol:
         return -1
 
     def initFromBytes(self,bytes):
+        self.initFromBuffer(bytes, 0)
+
+    def initFromBuffer(self, buf, offset):
         (self.st_name,
         self.st_value,
         self.st_size,
         self.st_info,
         self.st_other,
-        self.st_shndx) = struct.unpack("3L2BH",bytes[:len(self)])
+        self.st_shndx) = struct.unpack_from("3L2BH", buf, offset)
 
     def serialize(self):
         return struct.pack("3L2BH",
@@ -704,7 +762,7 @@ class Elf32Symbol:
         return struct.calcsize("3L2BH")
 
 class Elf64Symbol(Elf32Symbol):
-    def initFromBytes(self,bytes):
+    def initFromBuffer(self, buf, offset):
         fmt = "IBBHLL"
         (self.st_name,
         self.st_info,
@@ -712,7 +770,7 @@ class Elf64Symbol(Elf32Symbol):
         self.st_shndx,
         self.st_value,
         self.st_size,
-        ) = struct.unpack(fmt,bytes[:len(self)])
+        ) = struct.unpack_from(fmt, buf, offset)
 
     def serialize(self):
         return struct.pack("IBBHLL",
@@ -6,6 +6,10 @@ MUCH like its inspiration pyro, but slimmer and safer for things like threading
 and object de-registration.  Essentially, cobra allows you to call methods from
 and get/set attributes on objects that exist on a remote system.
 
+Every message carries a request id (the response has the id of the request)
+so one connection may have many calls outstanding at once (see
+CobraMethod.callAsync()) and the server runs the calls for a connection on a
+pool of worker threads.
 """
 # Copyright (C) 2007 Invisigoth - See LICENSE file for details
 import marshal
@@ -14,7 +18,8 @@ import sys
 import os
 import socket
 from SocketServer import ThreadingTCPServer, BaseRequestHandler
-from threading import currentThread,Thread,RLock
+from threading import currentThread,Thread,RLock,Lock,Condition
+from Queue import Queue
 import cPickle as pickle
 import urllib2
 import struct
@@ -31,10 +36,11 @@ except Exception, e:
 
 daemon = None
 verbose = False
-version = "Cobra2"
+version = "Cobra3"
 COBRA_PORT=5656
 COBRASSL_PORT=5653
 cobra_retrymax = None # Optional *global* retry max count
+cobra_maxworkers = 16 # The max worker threads for each server connection
 
 # Message Types
 COBRA_HELLO     = 0
@@ -44,6 +50,12 @@ COBRA_SETATTR   = 3
 COBRA_ERROR     = 4
 COBRA_GOODBYE   = 5
 
+# mtype, request id, name size, data size
+# NOTE: Cobra2 used a "<LLL" header (no request id).  The version is
+#       only checked in the hello, which a Cobra2 peer can't parse, so
+#       mixed versions are *not* refused cleanly (they misread the stream).
+#       Upgrade both ends together.
+cobra_header = struct.Struct("<LLLL")
 
 class CobraException(Exception):
     """Base for Cobra exceptions"""
@@ -153,21 +165,59 @@ def bumpCobraSocket(proxy):
     port = proxy.__dict__["__cobra_port"]
     currentThread().cobrasocks.pop((host,port), None)
 
+class CobraFuture:
+    """
+    The response to a request which may still be on its way
+    (see CobraMethod.callAsync()).
+    """
+    def __init__(self, csock, reqid):
+        self.csock = csock
+        self.reqid = reqid
+        self.response = None
+
+    def __del__(self):
+        # Nobody can collect the response now, don't let it pile up
+        # in the socket.
+        if self.response == None:
+            self.csock.dropResponse(self.reqid)
+
+    def getResponse(self):
+        """
+        Wait for (if needed) and return the mtype, name, data response.
+        """
+        if self.response == None:
+            self.response = self.csock.waitResponse(self.reqid)
+        return self.response
+
+    def wait(self):
+        """
+        Wait for (if needed) and return the result of the request
+        (or raise the exception from the remote side).
+        """
+        mtype, name, data = self.getResponse()
+        if mtype == COBRA_ERROR:
+            raise data
+        return data
+
 class CobraMethod:
     def __init__(self, proxy, methname):
         self.proxy = proxy
         self.methname = methname
 
     def __call__(self, *args, **kwargs):
+        return self.callAsync(*args, **kwargs).wait()
+
+    def callAsync(self, *args, **kwargs):
+        """
+        Send the call without waiting for it to complete and return a
+        CobraFuture for the result.  Many calls may be sent this way
+        before waiting for any of them (the server may run them in any
+        order).
+        """
         name = self.proxy.__dict__["__cobra_name"]
         if verbose: print "CALLING:",name,self.methname,repr(args)[:20],repr(kwargs)[:20]
         csock = getCobraSocket(self.proxy)
-        mtype, name, data = csock.cobraTransaction(COBRA_CALL, name, (self.methname, args, kwargs))
-        if mtype == COBRA_CALL:
-            return data
-
-        if mtype == COBRA_ERROR:
-            raise data
+        return csock.sendRequest(COBRA_CALL, name, (self.methname, args, kwargs))
 
 class CobraSocket:
     def __init__(self, sock, client=False, retrymax=None, ssl=False, sslVerify=False, sslKey=None, sslCert=None, timeout=None):
@@ -184,6 +234,16 @@ class CobraSocket:
         if self.retrymax == None:
             self.retrymax = cobra_retrymax
 
+        # Client requests which have not been answered (and are sent
+        # again on reconnect) and the responses not yet collected
+        self.nextid = 1
+        self.pending = {}   # reqid -> (mtype, objname, pickled data)
+        self.responses = {} # reqid -> (mtype, name, data)
+
+        self.sendlock = RLock()
+        self.recvcond = Condition()
+        self.receiving = False
+
     def getSockName(self):
         return self.socket.getsockname()
 
@@ -207,62 +267,178 @@ class CobraSocket:
 
     def cobraTransaction(self, mtype, objname, data):
         """
-        This is an API for clients to use.  It will retransmit
-        a sendMessage() automagically on recpt of an exception
-        in recvMessage()
+        This is an API for clients to use.  It sends a request and
+        waits for the response (re-sending the request if the socket
+        must be reconnected before the response arrives).
         """
-        while True:
+        return self.sendRequest(mtype, objname, data).getResponse()
+
+    def sendRequest(self, mtype, objname, data):
+        """
+        Send a request (from a client) and return a CobraFuture for
+        the response without waiting for it.
+        """
+        buf = self._pickleData(data)
+        self.sendlock.acquire()
+        try:
+            reqid = self.nextid
+            self.nextid += 1
+            self.pending[reqid] = (mtype, objname, buf)
+            sock = self.socket
             try:
-                self.sendMessage(mtype, objname, data)
-                return self.recvMessage()
-            except CobraClosedException, e:
-                self.reConnect()
-            except socket.error, e:
-                self.reConnect()
-            except OpenSSLSysCallError, e:
-                self.reConnect()
+                self._sendBuf(mtype, reqid, objname, buf)
+            except (socket.error, OpenSSLSysCallError), e:
+                self._reConnectResend(sock)
+        finally:
+            self.sendlock.release()
 
-    def sendMessage(self, mtype, objname, data):
+        return CobraFuture(self, reqid)
+
+    def waitResponse(self, reqid):
         """
-        Send message is responsable for transmission of cobra messages,
-        and socket reconnection in the event that the send fails for network
-        reasons.
+        Return the (mtype, name, data) response for a request sent with
+        sendRequest() once it arrives.  Whichever thread is waiting
+        receives responses (for any request) until its own arrives.
+        """
+        self.recvcond.acquire()
+        try:
+            while not self.responses.has_key(reqid):
+                if self.receiving:
+                    self.recvcond.wait()
+                    continue
+
+                self.receiving = True
+                self.recvcond.release()
+                try:
+                    self._recvResponse()
+                finally:
+                    self.recvcond.acquire()
+                    self.receiving = False
+                    self.recvcond.notifyAll()
+
+            return self.responses.pop(reqid)
+
+        finally:
+            self.recvcond.release()
+
+    def dropResponse(self, reqid):
+        """
+        Forget a request whose response will never be collected (it
+        is no longer re-sent, and is dropped if/when it arrives).
         """
+        self.recvcond.acquire()
+        try:
+            self.pending.pop(reqid, None)
+            self.responses.pop(reqid, None)
+        finally:
+            self.recvcond.release()
+
+    def _recvResponse(self):
+        # Receive one response and file it by request id
+        sock = self.socket
+        try:
+            mtype, reqid, name, buf = self._recvRaw()
+        except (CobraClosedException, socket.error, OpenSSLSysCallError), e:
+            self._reConnectResend(sock)
+            return
+
+        # A response we can't unpickle is an error for that request
         try:
-            buf = pickle.dumps(data)
+            data = pickle.loads(buf)
+        except Exception, e:
+            mtype = COBRA_ERROR
+            data = CobraPickleException("Failed to unpickle the response: %s" % e)
+
+        # (Responses for requests already answered or dropped are dropped)
+        self.recvcond.acquire()
+        try:
+            if self.pending.pop(reqid, None) != None:
+                self.responses[reqid] = (mtype, name, data)
+        finally:
+            self.recvcond.release()
+
+    def _reConnectResend(self, sock):
+        # Reconnect and send all the unanswered requests again (unless
+        # another thread has already reconnected since sock was used)
+        self.sendlock.acquire()
+        try:
+            if self.socket is not sock:
+                return
+            while True:
+                self.reConnect()
+                try:
+                    for reqid, (mtype, objname, buf) in sorted(self.pending.items()):
+                        self._sendBuf(mtype, reqid, objname, buf)
+                    return
+                except (socket.error, OpenSSLSysCallError), e:
+                    pass
+        finally:
+            self.sendlock.release()
+
+    def _pickleData(self, data):
+        try:
+            return pickle.dumps(data)
         except pickle.PickleError, e:
             raise CobraPickleException("The arguments/attributes must be pickleable: %s" % e)
 
-        while True:
-            try:
-                s = self.socket
-                s.sendall(''.join( (struct.pack("<LLL", mtype, len(objname), len(buf)), objname, buf)))
-                return
-            except socket.error, e:
-                if e.args[0] == errno.EPIPE:
+    def _sendBuf(self, mtype, reqid, objname, buf):
+        hdr = cobra_header.pack(mtype, reqid, len(objname), len(buf))
+        self.socket.sendall(''.join( (hdr, objname, buf) ))
+
+    def sendMessage(self, mtype, objname, data, reqid=0):
+        """
+        Send message is responsable for transmission of cobra messages,
+        and socket reconnection in the event that the send fails for network
+        reasons.  (The server uses reqid to say which request a response
+        is for)
+        """
+        buf = self._pickleData(data)
+
+        self.sendlock.acquire()
+        try:
+            while True:
+                try:
+                    self._sendBuf(mtype, reqid, objname, buf)
+                    return
+                except socket.error, e:
+                    if e.args[0] == errno.EPIPE:
+                        if not self.client:
+                            raise CobraClosedException
+                    elif not self.client:
+                        raise
+                    self.reConnect()
+                except OpenSSLSysCallError, e:
                     if not self.client:
-                        raise CobraClosedException
-                elif not self.client:
-                    raise
-                self.reConnect()
-            except OpenSSLSysCallError, e:
-                if not self.client:
-                    raise
-                self.reConnect()
+                        raise
+                    self.reConnect()
+        finally:
+            self.sendlock.release()
 
-    def recvMessage(self):
+    def recvRequest(self):
         """
-        Returns tuple of mtype, objname, and data
+        Returns tuple of mtype, reqid, objname, and data
         This method is *NOT* responsable for re-connection, because there
         is not context on the server side for what to send on re-connect.
         Client side uses of the CobraSocket object should use cobraTransaction
-        to ensure re-tranmission of the request on reception errors.
+        (or sendRequest) to ensure re-tranmission of the request on reception
+        errors.
         """
+        mtype, reqid, name, buf = self._recvRaw()
+        return (mtype, reqid, name, pickle.loads(buf))
+
+    def _recvRaw(self):
+        # Return the mtype, reqid, objname and (pickled) data of a message
         s = self.socket
-        hdr = self.recvExact(s, 12)
-        mtype, nsize, dsize = struct.unpack("<LLL", hdr)
+        hdr = self.recvExact(s, cobra_header.size)
+        mtype, reqid, nsize, dsize = cobra_header.unpack(hdr)
         name = self.recvExact(s, nsize)
-        data = pickle.loads(self.recvExact(s, dsize))
+        return (mtype, reqid, name, self.recvExact(s, dsize))
+
+    def recvMessage(self):
+        """
+        Returns tuple of mtype, objname, and data (see recvRequest)
+        """
+        mtype, reqid, name, data = self.recvRequest()
         return (mtype, name, data)
 
     def recvExact(self, s, size):
@@ -365,6 +541,8 @@ class CobraDaemon(ThreadingTCPServer):
         self.reflock = RLock()
         self.refcnts = {}
 
+        self.maxworkers = cobra_maxworkers
+
         self.allow_reuse_address = True
         ThreadingTCPServer.__init__(self, (host, port), CobraConnectionHandler)
 
@@ -474,6 +652,12 @@ class CobraConnectionHandler(BaseRequestHandler):
             self.handleError,
             self.handleGoodbye)
 
+        # The worker threads (started as needed) which run the requests
+        self.jobs = Queue()
+        self.workers = 0
+        self.busy = 0
+        self.poollock = Lock()
+
     def handle(self):
         peer = self.request.getpeername()
         me = self.request.getsockname()
@@ -482,50 +666,100 @@ class CobraConnectionHandler(BaseRequestHandler):
         setCallerInfo(peer)
         setLocalInfo(me)
 
-        while True:
-
-            try:
-                mtype,name,data = csock.recvMessage()
-            except CobraClosedException:
-                break
-            except socket.error:
-                if verbose: traceback.print_exc()
-                break
-
-            obj = self.server.getSharedObject(name)
-            if verbose: print "MSG FOR:",name,type(obj)
+        try:
+            while True:
 
-            if obj == None:
                 try:
-                    csock.sendMessage(COBRA_ERROR, name, Exception("Unknown object requested: %s" % name))
+                    msg = csock.recvRequest()
                 except CobraClosedException:
-                    pass
-                if verbose: print "WARNING: Got request for unknown object",name
-                continue
+                    break
+                except socket.error:
+                    if verbose: traceback.print_exc()
+                    break
+
+                self.dispatchRequest(csock, msg)
+
+        finally:
+            for i in xrange(self.workers):
+                self.jobs.put(None)
+
+    def dispatchRequest(self, csock, msg):
+        """
+        Queue a request for the workers (starting another worker if
+        they are all busy and there are less than the server's
+        maxworkers).
+        """
+        self.poollock.acquire()
+        try:
+            self.busy += 1
+            if self.busy > self.workers and self.workers < self.server.maxworkers:
+                thr = Thread(target=self.workerThread, args=(csock,))
+                thr.setDaemon(True)
+                thr.start()
+                self.workers += 1
+        finally:
+            self.poollock.release()
 
+        self.jobs.put(msg)
+
+    def workerThread(self, csock):
+        setCallerInfo(self.request.getpeername())
+        setLocalInfo(self.request.getsockname())
+        while True:
+            msg = self.jobs.get()
+            if msg == None:
+                return
             try:
-                handler = self.handlers[mtype]
-            except:
-                try:
-                    csock.sendMessage(COBRA_ERROR, name, Exception("Invalid Message Type"))
-                except CobraClosedException:
-                    pass
-                if verbose: print "WARNING: Got Invalid Message Type: %d for %s" % (mtype, data)
-                continue
+                self.handleRequest(csock, *msg)
+            finally:
+                self.poollock.acquire()
+                self.busy -= 1
+                self.poollock.release()
+
+    def handleRequest(self, csock, mtype, reqid, name, data):
+        """
+        Run one request and send the response (tagged with reqid).
+        """
+        obj = self.server.getSharedObject(name)
+        if verbose: print "MSG FOR:",name,type(obj)
+
+        if obj == None:
+            if verbose: print "WARNING: Got request for unknown object",name
+            resp = (COBRA_ERROR, name, Exception("Unknown object requested: %s" % name))
 
+        elif mtype >= len(self.handlers):
+            if verbose: print "WARNING: Got Invalid Message Type: %d for %s" % (mtype, data)
+            resp = (COBRA_ERROR, name, Exception("Invalid Message Type"))
+
+        else:
             try:
-                handler(csock, name, obj, data)
+                resp = self.handlers[mtype](oname=name, obj=obj, data=data)
             except Exception, e:
                 if verbose: traceback.print_exc()
-                try:
-                    csock.sendMessage(COBRA_ERROR, name, e)
-                except CobraClosedException:
-                    pass
+                resp = (COBRA_ERROR, name, e)
+
+        if resp == None:
+            return
+
+        rtype, rname, rdata = resp
+        try:
+            csock.sendMessage(rtype, rname, rdata, reqid=reqid)
+        except (CobraClosedException, socket.error):
+            pass
+        except Exception, e:
+            # Most likely the response won't pickle...
+            if verbose: traceback.print_exc()
+            try:
+                csock.sendMessage(COBRA_ERROR, name, e, reqid=reqid)
+            except (CobraClosedException, socket.error):
+                pass
+
+    # The handlers return the (mtype, name, data) to respond with
 
-    def handleError(self, csock, oname, obj, data):
+    def handleError(self, oname, obj, data):
         print "THIS SHOULD NEVER HAPPEN"
 
-    def handleHello(self, csock, oname, obj, data):
+    def handleHello(self, oname, obj, data):
         """
         Hello messages are used to get the initial cache of
         method names for the newly connected object.
@@ -536,42 +770,27 @@ class CobraConnectionHandler(BaseRequestHandler):
         for name in dir(obj):
             if type(getattr(obj,name)) == types.MethodType:
                 ret[name] = True
-        try:
-            csock.sendMessage(COBRA_HELLO, version, ret)
-        except CobraClosedException:
-            pass
+        return (COBRA_HELLO, version, ret)
 
-    def handleCall(self, csock, oname, obj, data):
+    def handleCall(self, oname, obj, data):
         if verbose: print "GOT A CALL",data
         methodname, args, kwargs = data
         meth = getattr(obj, methodname)
-        try:
-            csock.sendMessage(COBRA_CALL, "", meth(*args, **kwargs))
-        except CobraClosedException:
-            pass
+        return (COBRA_CALL, "", meth(*args, **kwargs))
 
-    def handleGetAttr(self, csock, oname, obj, name):
-        if verbose: print "GETTING ATTRIBUTE:",name
-        try:
-            csock.sendMessage(COBRA_GETATTR, "", getattr(obj, name))
-        except CobraClosedException:
-            pass
+    def handleGetAttr(self, oname, obj, data):
+        if verbose: print "GETTING ATTRIBUTE:",data
+        return (COBRA_GETATTR, "", getattr(obj, data))
 
-    def handleSetAttr(self, csock, oname, obj, data):
+    def handleSetAttr(self, oname, obj, data):
         if verbose: print "SETTING ATTRIBUTE:",data
         name,value = data
         setattr(obj, name, value)
-        try:
-            csock.sendMessage(COBRA_SETATTR, "", "")
-        except CobraClosedException:
-            pass
+        return (COBRA_SETATTR, "", "")
 
-    def handleGoodbye(self, csock, oname, obj, data):
+    def handleGoodbye(self, oname, obj, data):
         self.server.decrefObject(oname)
-        try:
-            csock.sendMessage(COBRA_GOODBYE, "", "")
-        except CobraClosedException:
-            pass
+        return (COBRA_GOODBYE, "", "")
 
 def isCobraUri(uri):
     try:
@@ -5,6 +5,7 @@ the use of the ArchitectureModule, Opcode, Operand, and
 Emulator objects.
 """
 
+import copy
 import struct
 import platform
 
@@ -23,6 +24,7 @@ BR_TABLE = 1<<3 # The branch target is the base of a pointer array of jmp/call s
 BR_FALL  = 1<<4 # The branch is a "fall through" to the next instruction
 
 import envi.bits as e_bits
+import envi.cache as e_cache
 import envi.memory as e_mem
 import envi.registers as e_reg
 import envi.memcanvas as e_canvas
@@ -36,6 +38,26 @@ class ArchitectureModule:
     def __init__(self, archname, maxinst=32):
         self._arch_name = archname
         self._arch_maxinst = maxinst
+        self._arch_dcache = None
+
+    def setDecodeCache(self, size=4096):
+        """
+        Enable an LRU cache (of up to size entries) for opcodes created
+        by makeOpcode() with a va.  Opcodes are only returned from the
+        cache if the bytes they were decoded from are unchanged.
+
+        Use setDecodeCache(0) to disable the cache.
+        """
+        if size:
+            self._arch_dcache = e_cache.DecodeCache(size, self._arch_maxinst)
+        else:
+            self._arch_dcache = None
+
+    def getDecodeCache(self):
+        """
+        Return the envi.cache.DecodeCache in use by makeOpcode() (or None).
+        """
+        return self._arch_dcache
 
     def archGetBreakInstr(self):
         """
@@ -50,13 +72,56 @@ class ArchitectureModule:
         """
         raise ArchNotImplemented("archGetRegCtx")
 
-    def makeOpcode(self, bytes, offset=0):
+    def makeOpcode(self, bytes, offset=0, va=0):
         """
         Create a new opcode from the specified bytes (beginning
-        at the specified offset)
+        at the specified offset) which lives at the given va.
         """
         raise ArchNotImplemented("makeOpcode")
 
+    def disasmRange(self, bytes, va, offset=0, size=None):
+        """
+        Linear sweep disassemble size bytes (default: the rest of bytes)
+        starting at offset (which lives at va).  This is a generator which
+        yields an OpcodeRecord per instruction.  Undecodable bytes are
+        skipped one at a time and a truncated instruction ends the sweep.
+
+        NOTE: Decoders don't all say when they run out of bytes, so any
+              decode failure within the arch's longest instruction of
+              the end of bytes is taken to be a truncated instruction.
+
+        Example: for rec in arch.disasmRange(bytes, 0x41410000):
+        """
+        if size == None:
+            end = len(bytes)
+        else:
+            end = offset + size
+
+        while offset < end:
+            try:
+                op = self.makeOpcode(bytes, offset, va)
+            except IndexError:
+                break
+            except (InvalidInstruction, struct.error):
+                if offset + self._arch_maxinst > len(bytes):
+                    break
+                offset += 1
+                va += 1
+                continue
+
+            if offset + op.size > end:
+                break
+
+            target = None
+            for bva, bflags in op.getBranches():
+                if not bflags & (BR_FALL | BR_DEREF):
+                    target = bva
+                    break
+
+            yield OpcodeRecord(self, bytes, offset, va, op.size, op.opcode, op.mnem, op.prefixes, op.iflags, target)
+            offset += op.size
+            va += op.size
+
     def getEmulator(self):
         """
         Return a default instance of an emulator for the given arch.
@@ -187,13 +252,39 @@ class MapOverlapException(EnviException):
         margs = (map1[0], map1[1], map2[0], map2[1])
         EnviException.__init__(self, "Map At 0x%.8x (%d) overlaps map at 0x%.8x (%d)" % margs)
 
-class Operand:
+def getSlotState(obj):
+    """
+    A __getstate__ helper for __slots__ classes (which can not be
+    pickled by the default protocol without one).
+    """
+    state = {}
+    for cls in obj.__class__.__mro__:
+        for name in cls.__dict__.get("__slots__", ()):
+            if hasattr(obj, name):
+                state[name] = getattr(obj, name)
+    return state
+
+def setSlotState(obj, state):
+    """
+    The __setstate__ helper to go with getSlotState()
+    """
+    for name, value in state.items():
+        setattr(obj, name, value)
+
+class Operand(object):
 
     """
     Thses are the expected methods needed by any implemented operand object
     attached to an envi Opcode.  This does *not* have a constructor of it's
     pwn on purpose to cut down on memory use and constructor CPU cost.
+
+    NOTE: Operands are __slots__ classes (there may be *many* of them)
+          so be sure to declare __slots__ in operand implementations.
     """
+    __slots__ = ()
+
+    __getstate__ = getSlotState
+    __setstate__ = setSlotState
 
     def getOperValue(self, op, emu=None):
         """
@@ -252,10 +343,18 @@ class Operand:
         #FIXME each one will need this...
         return True
 
-class Opcode:
+class Opcode(object):
     """
     A universal representation for an opcode
+
+    NOTE: Opcodes are __slots__ classes (there may be *many* of them)
+          so be sure to declare __slots__ in opcode implementations.
     """
+    __slots__ = ("opcode", "mnem", "prefixes", "size", "opers", "repr", "iflags", "va")
+
+    __getstate__ = getSlotState
+    __setstate__ = setSlotState
+
     def __init__(self, va, opcode, mnem, prefixes, size, operands, iflags=0):
         """
         constructor for the basic Envi Opcode object.  Arguments as follows:
@@ -334,6 +433,66 @@ class Opcode:
         """
         mcanv.addText("%s HAS NO RENDER METHOD" % self.__class__.__name__)
 
+class OpcodeRecord(object):
+    """
+    A compact record of an instruction produced by disasmRange().  Only the
+    basics are kept (va, size, opcode, mnem, prefixes, iflags, and target
+    which is the destination of a direct branch or None).  The full Opcode
+    (with operands) is only created when asked for with getOpcode().
+    """
+    __slots__ = ("arch", "bytes", "offset", "va", "size", "opcode", "mnem", "prefixes", "iflags", "target")
+
+    def __init__(self, arch, bytes, offset, va, size, opcode, mnem, prefixes, iflags, target):
+        self.arch = arch
+        self.bytes = bytes
+        self.offset = offset
+        self.va = va
+        self.size = size
+        self.opcode = opcode
+        self.mnem = mnem
+        self.prefixes = prefixes
+        self.iflags = iflags
+        self.target = target
+
+    def __len__(self):
+        return int(self.size)
+
+    def __repr__(self):
+        return "OpcodeRecord(0x%.8x, %d, %s)" % (self.va, self.size, self.mnem)
+
+    def getOpcode(self):
+        """
+        Decode and return the full envi Opcode for this record.
+        """
+        return self.arch.makeOpcode(self.bytes, self.offset, self.va)
+
+    def getBranches(self, emu=None):
+        """
+        See Opcode.getBranches()
+        """
+        return self.getOpcode().getBranches(emu=emu)
+
+_op_methods_cache = {}
+
+def getOpMethods(cls):
+    """
+    Return the mnemonic -> function dict of instruction handlers for
+    the given Emulator class by finding all methods starting with i_
+    (and assuming they implement an instruction by mnemonic).
+
+    The dict is built once per class and holds the plain functions
+    (each Emulator binds its own copy, see Emulator.__init__).
+    """
+    meths = _op_methods_cache.get(cls)
+    if meths == None:
+        meths = {}
+        for name in dir(cls):
+            if name.startswith("i_"):
+                meth = getattr(cls, name)
+                meths[name[2:]] = getattr(meth, "im_func", meth)
+        _op_methods_cache[cls] = meths
+    return meths
+
 class Emulator(e_reg.RegisterContext, e_mem.IMemory):
     """
     The Emulator class is mostly "Abstract" in the java
@@ -368,31 +527,49 @@ class Emulator(e_reg.RegisterContext, e_mem.IMemory):
 
         self.call_convs = {}
 
-        # Automagically setup an instruction mnemonic handler dict
-        # by finding all methods starting with i_ and assume they
-        # implement an instruction by mnemonic
-        # FIXME THIS *MUST* GET FASTER FOR UTIL FUNCS!
-        # POSSIBLY DECLARE IN ADVANCE?
-        self.op_methods = {}
-        for name in dir(self):
-            if name.startswith("i_"):
-                self.op_methods[name[2:]] = getattr(self, name)
+        # The instruction handlers are found once per class (see
+        # getOpMethods) and bound here for each instance
+        cls = self.__class__
+        self.op_methods = dict([ (mnem, func.__get__(self, cls))
+                                 for mnem, func in getOpMethods(cls).iteritems() ])
 
     def emuSnapshot(self):
         """
         Return the data needed to "snapshot" this emulator.  For most
         archs, this method will be enough (it takes the memory object,
         and register values with it)
+
+        NOTE: If the memory object supports getMemorySnap() (like the
+              envi.memory.PageMemoryObject) only the pages written after
+              the snapshot are saved (and the memory part of the snapshot
+              is an envi.memory.MemorySnap), otherwise memory is deepcopy'd.
+              Use emuDropSnapshot() on snapshots which won't be restored.
         """
         regs = self.getRegisterSnap()
+        if hasattr(self.memobj, "getMemorySnap"):
+            return regs, self.memobj.getMemorySnap()
+
         mem  = copy.deepcopy(self.memobj)
         return regs,mem
 
     def emuRestore(self, snap):
         regs,mem = snap
         self.setRegisterSnap(regs)
+        if isinstance(mem, e_mem.MemorySnap):
+            mem.memobj.setMemorySnap(mem)
+            mem = mem.memobj
         self.setMemoryObject(mem)
 
+    def emuDropSnapshot(self, snap):
+        """
+        Let go of a snapshot from emuSnapshot() which will not be
+        restored (again).  Journaled memory snapshots are otherwise kept
+        by the memory object until an earlier snapshot is restored.
+        """
+        regs,mem = snap
+        if isinstance(mem, e_mem.MemorySnap):
+            mem.memobj.dropMemorySnap(mem)
+
     def getSegmentInfo(self, op):
         idx = self.getSegmentIndex(op)
         return self.segments[idx]
@@ -439,7 +616,7 @@ class Emulator(e_reg.RegisterContext, e_mem.IMemory):
     def stepi(self):
         pc = self.getProgramCounter()
         bytes = self.readMemory(pc, 32)
-        op = self.makeOpcode(bytes)
+        op = self.makeOpcode(bytes, va=pc)
         self.executeOpcode(op)
 
 #############################################################
@@ -463,6 +640,9 @@ class Emulator(e_reg.RegisterContext, e_mem.IMemory):
 
     def getMemoryMaps(self):
         return self.memobj.getMemoryMaps()
+
+    def getMemoryMap(self, va):
+        return self.memobj.getMemoryMap(va)
 #############################################################
 
     def getOperValue(self, op, idx):
@@ -165,6 +165,9 @@ e_reg.addLocalMetas(l, amd64meta)
 import envi.archs.i386.opcode86 as opcode86
 
 class Amd64RipRelOper(envi.Operand):
+
+    __slots__ = ("imm", "tsize")
+
     def __init__(self, imm, tsize):
         self.imm = imm
         self.tsize = tsize
@@ -254,12 +257,19 @@ MODE_64 = 2
 
 RMETA_LOW32 = 0x00200000
 
+class Amd64Opcode(e_i386.i386Opcode):
+
+    __slots__ = ()
+
+    # Used by the operands to name registers
+    _dis_regctx = Amd64RegisterContext()
+
 class Amd64Disasm(e_i386.i386Disasm):
 
     def __init__(self):
         e_i386.i386Disasm.__init__(self)
         self._dis_prefixes = amd64_prefixes
-        self._dis_regctx = Amd64RegisterContext()
+        self._dis_opclass = Amd64Opcode
 
         # Over-ride these which are in use by the i386 version of the ASM
         self.ROFFSET_MMX   = e_i386.getRegOffset(amd64regs, "mm0")
@@ -272,29 +282,20 @@ class Amd64Disasm(e_i386.i386Disasm):
 
     # NOTE: Technically, the REX must be the *last* prefix specified
 
-    def _dis_calc_tsize(self, opertype, addrtype, prefixes):
+    def _dis_calc_mode(self, prefixes):
         """
-        Use the oper type and prefixes to decide on the tsize for
-        the operand.
+        Use the prefixes to decide which OPERSIZE mode (index) the
+        operands of an instruction use.
         """
-
-        mode = MODE_32
-
-        sizelist = opcode86.OPERSIZE.get(opertype, None)
-        if sizelist == None:
-            raise "OPERSIZE FAIL"
-
         # NOTE: REX takes precedence over 66
         # (see section 2.2.1.2 in Intel 2a)
         if prefixes & PREFIX_REX_W:
-
-            mode = MODE_64
+            return MODE_64
 
         elif prefixes & e_i386.PREFIX_OP_SIZE:
+            return MODE_16
 
-            mode = MODE_16
-
-        return sizelist[mode]
+        return MODE_32
 
     def byteRegOffset(self, val):
         # NOTE: Override this because there is no AH etc in 64 bit mode
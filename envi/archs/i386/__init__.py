@@ -52,7 +52,43 @@ class i386Module(envi.ArchitectureModule):
         """
         Parse a sequence of bytes out into an envi.Opcode instance.
         """
-        return self._arch_dis.disasm(bytes, offset, va)
+        dcache = self._arch_dcache
+        if dcache == None:
+            return self._arch_dis.disasm(bytes, offset, va)
+
+        op = dcache.getOpcode(bytes, offset, va)
+        if op == None:
+            op = self._arch_dis.disasm(bytes, offset, va)
+            dcache.addOpcode(bytes, offset, op)
+        return op
+
+    def disasmRange(self, bytes, va, offset=0, size=None):
+        """
+        Linear sweep disassemble bytes (see ArchitectureModule.disasmRange)
+        using the quick decoder which does not build operand objects.
+        """
+        if size == None:
+            end = len(bytes)
+        else:
+            end = offset + size
+
+        qdis = self._arch_dis.quickDisasm
+        while offset < end:
+            try:
+                qsize, optype, mnem, prefixes, iflags, target = qdis(bytes, offset, va)
+            except IndexError:
+                break # Truncated instruction at the end of bytes
+            except envi.InvalidInstruction:
+                offset += 1
+                va += 1
+                continue
+
+            if offset + qsize > end:
+                break
+
+            yield envi.OpcodeRecord(self, bytes, offset, va, qsize, optype, mnem, prefixes, iflags, target)
+            offset += qsize
+            va += qsize
 
     def getEmulator(self):
         return IntelEmulator()
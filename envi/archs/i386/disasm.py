@@ -134,13 +134,14 @@ def addrToName(mcanv, va):
 
 
 class i386RegOper(envi.Operand):
+    __slots__ = ("reg", "tsize")
 
     def __init__(self, reg, tsize):
         self.reg = reg
         self.tsize = tsize
 
     def repr(self, op):
-        return self._dis_regctx.getRegisterName(self.reg)
+        return op._dis_regctx.getRegisterName(self.reg)
 
     def getOperValue(self, op, emu=None):
         if emu == None: return None # This operand type requires an emulator
@@ -154,7 +155,7 @@ class i386RegOper(envi.Operand):
         if hint != None:
             mcanv.addNameText(name, typename="registers")
         else:
-            name = self._dis_regctx.getRegisterName(self.reg)
+            name = op._dis_regctx.getRegisterName(self.reg)
             mcanv.addNameText(name, typename="registers")
 
     def __eq__(self, other):
@@ -173,6 +174,8 @@ class i386ImmOper(envi.Operand):
     """
     An operand representing an immediate.
     """
+    __slots__ = ("imm", "tsize")
+
     def __init__(self, imm, tsize):
         self.imm = imm
         self.tsize = tsize
@@ -218,6 +221,8 @@ class i386PcRelOper(envi.Operand):
     This is the operand used for EIP relative offsets
     for operands on instructions like jmp/call
     """
+    __slots__ = ("imm", "tsize")
+
     def __init__(self, imm, tsize):
         self.imm = imm
         self.tsize = tsize
@@ -251,13 +256,15 @@ class i386RegMemOper(envi.Operand):
     An operand which represents the result of reading/writting memory from the
     dereference (with possible displacement) from a given register.
     """
+    __slots__ = ("reg", "tsize", "disp")
+
     def __init__(self, reg, tsize, disp=0):
         self.reg = reg
         self.tsize = tsize
         self.disp = disp
 
     def repr(self, op):
-        r = self._dis_regctx.getRegisterName(self.reg)
+        r = op._dis_regctx.getRegisterName(self.reg)
         if self.disp > 0:
             return "%s [%s + %d]" % (sizenames[self.tsize],r,self.disp)
         elif self.disp < 0:
@@ -284,7 +291,7 @@ class i386RegMemOper(envi.Operand):
     def render(self, mcanv, op, idx):
         mcanv.addNameText(sizenames[self.tsize])
         mcanv.addText(" [")
-        mcanv.addNameText(self._dis_regctx.getRegisterName(self.reg), typename="registers")
+        mcanv.addNameText(op._dis_regctx.getRegisterName(self.reg), typename="registers")
         hint = mcanv.syms.getSymHint(op.va, idx)
         if hint != None:
             mcanv.addText(" + ")
@@ -315,6 +322,8 @@ class i386ImmMemOper(envi.Operand):
     An operand which represents the dereference (memory read/write) of
     a memory location associated with an immediate.
     """
+    __slots__ = ("imm", "tsize")
+
     def __init__(self, imm, tsize):
         self.imm = imm
         self.tsize = tsize
@@ -367,6 +376,8 @@ class i386SibOper(envi.Operand):
     An operand which represents the result of reading/writting memory from the
     dereference (with possible displacement) from a given register.
     """
+    __slots__ = ("reg", "imm", "index", "scale", "tsize", "disp")
+
     def __init__(self, tsize, reg=None, imm=None, index=None, scale=1, disp=0):
         self.reg = reg
         self.imm = imm
@@ -397,13 +408,13 @@ class i386SibOper(envi.Operand):
         r = "%s [" % sizenames[self.tsize]
 
         if self.reg != None:
-            r += self._dis_regctx.getRegisterName(self.reg)
+            r += op._dis_regctx.getRegisterName(self.reg)
 
         if self.imm != None:
             r += "0x%.8x" % self.imm
 
         if self.index != None:
-            r += " + %s" % self._dis_regctx.getRegisterName(self.index)
+            r += " + %s" % op._dis_regctx.getRegisterName(self.index)
             if self.scale != 1:
                 r += " * %d" % self.scale
 
@@ -461,13 +472,13 @@ class i386SibOper(envi.Operand):
             mcanv.addVaText(name, self.imm)
 
         if self.reg != None:
-            name = self._dis_regctx.getRegisterName(self.reg)
+            name = op._dis_regctx.getRegisterName(self.reg)
             mcanv.addNameText(name, typename="registers")
 
         # Does our SIB have a scale
         if self.index != None:
             mcanv.addText(" + ")
-            name = self._dis_regctx.getRegisterName(self.index)
+            name = op._dis_regctx.getRegisterName(self.index)
             mcanv.addNameText(name, typename="registers")
             if self.scale != 1:
                 mcanv.addText(" * ")
@@ -488,6 +499,11 @@ class i386SibOper(envi.Operand):
 
 class i386Opcode(envi.Opcode):
 
+    __slots__ = ()
+
+    # Used by the operands to name registers
+    _dis_regctx = i386RegisterContext()
+
     def getBranches(self, emu=None):
         ret = []
 
@@ -592,12 +608,133 @@ MODE_16 = 0
 MODE_32 = 1
 MODE_64 = 2
 
+def flattenOpdesc(opdesc, consume):
+    """
+    Pre-compute everything disasm() needs from an opcode86 table
+    entry and return a tuple of:
+
+    (nexttable, consume, mnem, optype, operdescs, iflags)
+
+    Where operdescs is a tuple of (operflags, addrtype, sizelist, operval,
+    immoper) for each operand.
+    """
+    nexttable = opdesc[0]
+    optype = opdesc[1]
+    mnem = opdesc[6]
+
+    operdescs = []
+    for i in operand_range:
+        operflags = opdesc[i]
+        if operflags == 0:
+            break
+
+        opertype = operflags & opcode86.OPTYPE_MASK
+        addrtype = operflags & opcode86.ADDRMETH_MASK
+        sizelist = opcode86.OPERSIZE.get(opertype, None)
+        immoper = addrtype in (opcode86.ADDRMETH_I, opcode86.ADDRMETH_J)
+        operdescs.append((operflags, addrtype, sizelist, opdesc[5+i], immoper))
+
+    # Pull in the envi generic instruction flags
+    iflags = iflag_lookup.get(optype, 0)
+    if priv_lookup.get(mnem, False):
+        iflags |= envi.IF_PRIV
+
+    return (nexttable, consume, mnem, optype, tuple(operdescs), iflags)
+
+def flattenTables(tables):
+    """
+    Flatten the multi-level opcode86 table descriptions into a list
+    (by table index) of direct 256 entry lookup lists.  The overflow
+    tables and the shift/mask/sub index math are resolved here so the
+    decoder only does one list index per opcode byte.  Entries which
+    do not decode are None.
+    """
+    ret = []
+    for tabdesc in tables:
+        flat = []
+        for obyte in xrange(256):
+
+            t = tabdesc
+            if obyte > t[4]:
+                t = tables[t[5]]
+
+            optable, shift, mask, sub = t[:4]
+            tabidx = ((obyte - sub) >> shift) & mask
+            if tabidx >= len(optable):
+                flat.append(None)
+                continue
+
+            consume = 0
+            if mask == 0xff:
+                consume = 1
+
+            flat.append(flattenOpdesc(optable[tabidx], consume))
+
+        ret.append(flat)
+
+    return ret
+
+flat_tables = flattenTables(all_tables)
+
+# How many operand bytes each addressing method eats (for quickDisasm)
+QSIZE_NONE  = 0 # Operand comes from the modrm reg field (or is implied)
+QSIZE_MODRM = 1 # A full modrm (with possible sib and displacement)
+QSIZE_TSIZE = 2 # An immediate of the operand size
+QSIZE_FAR   = 3 # An immediate of the operand size plus a segment
+QSIZE_DISP  = 4 # A 32 bit displacement
+
+quick_sizes = {
+    opcode86.ADDRMETH_A:QSIZE_FAR,
+    opcode86.ADDRMETH_C:QSIZE_NONE,
+    opcode86.ADDRMETH_D:QSIZE_NONE,
+    opcode86.ADDRMETH_E:QSIZE_MODRM,
+    opcode86.ADDRMETH_G:QSIZE_NONE,
+    opcode86.ADDRMETH_I:QSIZE_TSIZE,
+    opcode86.ADDRMETH_J:QSIZE_TSIZE,
+    opcode86.ADDRMETH_M:QSIZE_MODRM,
+    opcode86.ADDRMETH_N:QSIZE_MODRM,
+    opcode86.ADDRMETH_O:QSIZE_DISP,
+    opcode86.ADDRMETH_P:QSIZE_NONE,
+    opcode86.ADDRMETH_Q:QSIZE_MODRM,
+    opcode86.ADDRMETH_R:QSIZE_MODRM,
+    opcode86.ADDRMETH_S:QSIZE_NONE,
+    opcode86.ADDRMETH_U:QSIZE_NONE,
+    opcode86.ADDRMETH_V:QSIZE_NONE,
+    opcode86.ADDRMETH_W:QSIZE_MODRM,
+    opcode86.ADDRMETH_X:QSIZE_NONE,
+    opcode86.ADDRMETH_Y:QSIZE_NONE,
+}
+
+def modrmSize(byte):
+    """
+    Return the size of a modrm (plus any sib and displacement) for
+    the given modrm byte.  A sib with no base (mod 0) adds 4 more
+    which must be checked by the caller.
+    """
+    mod = (byte >> 6) & 0x3
+    rm = byte & 0x7
+    if mod == 3:
+        return 1
+    size = 1
+    if rm == 4:
+        size += 1
+    if mod == 0:
+        if rm == 5:
+            size += 4
+    elif mod == 1:
+        size += 1
+    else:
+        size += 4
+    return size
+
+modrm_sizes = [ modrmSize(i) for i in xrange(256) ]
+
 class i386Disasm:
 
     def __init__(self, mode=MODE_32):
         self._dis_mode = MODE_32
         self._dis_prefixes = i386_prefixes
-        self._dis_regctx = i386RegisterContext()
+        self._dis_opclass = i386Opcode
 
         # This will make function lookups nice and quick
         self._dis_amethods = [ None for x in range(22) ]
@@ -757,30 +894,27 @@ class i386Disasm:
         Use the oper type and prefixes to decide on the tsize for
         the operand.
         """
-        mode = MODE_32
-
-        #print "OPERTYPE",hex(opertype)
         sizelist = opcode86.OPERSIZE.get(opertype, None)
         if sizelist == None:
-            raise "OPERSIZE FAIL: %.8x" % opertype
+            raise Exception("OPERSIZE FAIL: %.8x" % opertype)
 
-        if prefixes & PREFIX_OP_SIZE:
-
-            mode = MODE_16
+        return sizelist[self._dis_calc_mode(prefixes)]
 
-        #print "OPERTYPE",hex(opertype)
-        #print "SIZELIST",repr(sizelist)
-        return sizelist[mode]
+    def _dis_calc_mode(self, prefixes):
+        """
+        Use the prefixes to decide which OPERSIZE mode (index) the
+        operands of an instruction use.
+        """
+        if prefixes & PREFIX_OP_SIZE:
+            return MODE_16
+        return MODE_32
 
     def disasm(self, bytes, offset, va):
 
         # Stuff for opcode parsing
-        tabdesc = all_tables[0] # A tuple (optable, shiftbits, mask byte, sub, max)
+        optable = flat_tables[0] # The 256 entry list for the current table
         startoff = offset # Use startoff as a size knob if needed
 
-        # Stuff we'll be putting in the opcode object
-        optype = None # This gets set if we successfully decode below
-        mnem = None 
         operands = []
 
         prefixes = 0
@@ -799,27 +933,17 @@ class i386Disasm:
             offset += 1
             continue
 
-        #pdone = False
         while True:
 
             obyte = ord(bytes[offset])
-
-            #print "OBYTE",hex(obyte)
-            if (obyte > tabdesc[4]):
-                #print "Jumping To Overflow Table:", tabdesc[5]
-                tabdesc = all_tables[tabdesc[5]]
-
-            tabidx = ((obyte - tabdesc[3]) >> tabdesc[1]) & tabdesc[2]
-            #print "TABIDX: %d" % tabidx
-            opdesc = tabdesc[0][tabidx]
-            #print 'OPDESC: %s' % repr(opdesc)
+            opdesc = optable[obyte]
+            if opdesc == None:
+                raise envi.InvalidInstruction()
 
             # Hunt down multi-byte opcodes
             nexttable = opdesc[0]
-            #print "NEXT",nexttable,hex(obyte)
             if nexttable != 0: # If we have a sub-table specified, use it.
-                #print "Multi-Byte Next Hop For",hex(obyte),opdesc[0]
-                tabdesc = all_tables[nexttable]
+                optable = flat_tables[nexttable]
 
                 # In the case of 66 0f, the next table is *already* assuming we ate
                 # the 66 *and* the 0f...  oblidge them.
@@ -831,58 +955,40 @@ class i386Disasm:
 
                 continue
 
-            # We are now on the final table...
-            #print repr(opdesc)
-            mnem = opdesc[6]
-            optype = opdesc[1]
-            if tabdesc[2] == 0xff:
-                offset += 1 # For our final opcode byte
+            # We are now on the final table (eat the opcode byte if needed)
+            offset += opdesc[1]
             break
 
+        nexttable, consume, mnem, optype, operdescs, iflags = opdesc
+
         if optype == 0:
-            #print tabidx
-            #print opdesc
-            #print "OPTTYPE 0"
             raise envi.InvalidInstruction()
 
+        mode = self._dis_calc_mode(prefixes)
+        amethods = self._dis_amethods
+
         operoffset = 0
         # Begin parsing operands based off address method
-        for i in operand_range:
-
-            oper = None # Set this if we end up with an operand
-            osize = 0
-
-            # Pull out the operand description from the table
-            operflags = opdesc[i]
-            opertype = operflags & opcode86.OPTYPE_MASK
-            addrtype = operflags & opcode86.ADDRMETH_MASK
-
-            # If there are no more operands, break out of the loop!
-            if operflags == 0:
-                break
-
-            #print "ADDRTYPE: %.8x OPERTYPE: %.8x" % (addrtype, opertype)
-
-            tsize = self._dis_calc_tsize(opertype, addrtype, prefixes)
+        for operflags, addrtype, sizelist, operval, immoper in operdescs:
 
-            #print hex(opertype),hex(addrtype)
+            if sizelist == None:
+                raise Exception("OPERSIZE FAIL: %.8x" % (operflags & opcode86.OPTYPE_MASK))
 
+            tsize = sizelist[mode]
 
             # If addrtype is zero, we have operands embedded in the opcode
             if addrtype == 0:
                 osize = 0
-                oper = self.ameth_0(operflags, opdesc[5+i], tsize, prefixes)
+                oper = self.ameth_0(operflags, operval, tsize, prefixes)
 
             else:
-                #print "ADDRTYPE",hex(addrtype)
-                ameth = self._dis_amethods[addrtype >> 16]
-                #print "AMETH",ameth
+                ameth = amethods[addrtype >> 16]
                 if ameth == None:
                     raise Exception("Implement Addressing Method 0x%.8x" % addrtype)
 
                 # NOTE: Depending on your addrmethod you may get beginning of operands, or offset
                 try:
-                    if addrtype == opcode86.ADDRMETH_I or addrtype == opcode86.ADDRMETH_J:
+                    if immoper:
                         osize, oper = ameth(bytes, offset+operoffset, tsize, prefixes)
                     else:
                         osize, oper = ameth(bytes, offset, tsize, prefixes)
@@ -891,20 +997,103 @@ class i386Disasm:
                     raise envi.InvalidInstruction()
 
             if oper != None:
-                # This is a filty hack for now...
-                oper._dis_regctx = self._dis_regctx
                 operands.append(oper)
             operoffset += osize
 
-        # Pull in the envi generic instruction flags
-        iflags = iflag_lookup.get(optype, 0)
+        ret = self._dis_opclass(va, optype, mnem, prefixes, (offset-startoff)+operoffset, operands, iflags)
 
-        if priv_lookup.get(mnem, False):
-            iflags |= envi.IF_PRIV
+        return ret
 
-        ret = i386Opcode(va, optype, mnem, prefixes, (offset-startoff)+operoffset, operands, iflags)
+    def quickDisasm(self, bytes, offset, va):
+        """
+        Decode just enough of the instruction at offset to know its
+        size and type without creating any operand objects.  Returns a
+        tuple of (size, optype, mnem, prefixes, iflags, target) where
+        target is the destination of a relative or direct far branch
+        (or None).
+
+        NOTE: an IndexError means the bytes end mid-instruction, and
+              the returned size may run past the end of bytes.
+        """
+        optable = flat_tables[0]
+        startoff = offset
+        prefixes = 0
 
-        return ret
+        while True:
+            obyte = ord(bytes[offset])
+            p = self._dis_prefixes[obyte]
+            if p == None:
+                break
+            if obyte == 0x66 and ord(bytes[offset+1]) == 0x0f:
+                break
+            prefixes |= p
+            offset += 1
+
+        while True:
+            obyte = ord(bytes[offset])
+            opdesc = optable[obyte]
+            if opdesc == None:
+                raise envi.InvalidInstruction()
+
+            nexttable = opdesc[0]
+            if nexttable != 0:
+                optable = flat_tables[nexttable]
+                if obyte == 0x66 and ord(bytes[offset+1]) == 0x0f:
+                    offset += 1
+                offset += 1
+                continue
+
+            offset += opdesc[1]
+            break
+
+        nexttable, consume, mnem, optype, operdescs, iflags = opdesc
+        if optype == 0:
+            raise envi.InvalidInstruction()
+
+        mode = self._dis_calc_mode(prefixes)
+        reloff = None
+        faroff = None
+        operoffset = 0
+        for operflags, addrtype, sizelist, operval, immoper in operdescs:
+
+            if addrtype == 0:
+                continue
+
+            qsize = quick_sizes.get(addrtype)
+            if qsize == None or sizelist == None:
+                raise envi.InvalidInstruction()
+
+            if qsize == QSIZE_MODRM:
+                modrm = ord(bytes[offset])
+                osize = modrm_sizes[modrm]
+                if modrm & 0xc7 == 0x04 and ord(bytes[offset+1]) & 0x7 == 5:
+                    osize += 4
+            elif qsize == QSIZE_TSIZE:
+                osize = sizelist[mode]
+                if addrtype == opcode86.ADDRMETH_J:
+                    reloff = offset + operoffset
+                    relsize = osize
+            elif qsize == QSIZE_FAR:
+                osize = sizelist[mode] + 2
+                faroff = offset + operoffset
+                farsize = sizelist[mode]
+            elif qsize == QSIZE_DISP:
+                osize = 4
+            else:
+                osize = 0
+
+            operoffset += osize
+
+        size = (offset - startoff) + operoffset
+
+        target = None
+        if reloff != None and startoff + size <= len(bytes):
+            target = va + size + e_bits.parsebytes(bytes, reloff, relsize, sign=True)
+        elif faroff != None and startoff + size <= len(bytes):
+            # Match ameth_a, which keeps the far pointer as an immediate
+            target = e_bits.parsebytes(bytes, faroff, farsize)
+
+        return (size, optype, mnem, prefixes, iflags, target)
 
     # Declare all the address method parsers here!
 
@@ -101,9 +101,47 @@ stdcall = StdCall()
 thiscall = ThisCall()
 cdecl = Cdecl()
 
+# Instruction flags which end a basic block
+BLOCK_END_FLAGS = envi.IF_NOFALL | envi.IF_BRANCH | envi.IF_CALL | envi.IF_RET
+
+# Prefixes which make the emulator use doRepPrefix()
+REP_PREFIXES = PREFIX_REP | PREFIX_REPNZ
+
+# String instructions which use rep as repz/repnz (see doRepzPrefix)
+rep_cond_mnems = ("cmpsb", "cmpsd", "scasb", "scasd")
+
+# The most bytes the bulk rep helpers read/write at once
+REP_CHUNK = 0x10000
+
+def strMismatch(a, b):
+    """
+    Return the offset of the first byte which differs in the
+    (equal length) strings a and b or -1 if they are the same.
+    """
+    if a == b:
+        return -1
+    # Bisect with (C speed) slice compares down to a small range
+    lo = 0
+    hi = len(a)
+    while hi - lo > 64:
+        mid = (lo + hi) / 2
+        if a[lo:mid] == b[lo:mid]:
+            lo = mid
+        else:
+            hi = mid
+    for i in xrange(lo, hi):
+        if a[i] != b[i]:
+            return i
+    return -1
+
 class IntelEmulator(i386Module, i386RegisterContext, envi.Emulator):
 
     def __init__(self):
+        # For block mode (see setBlockMode())
+        self._emu_blockmode = False
+        self._emu_blockmax = 64
+        self.flushBlockCache()
+
         # Set ourself up as an arch module *and* register context
         i386Module.__init__(self)
 
@@ -117,6 +155,35 @@ class IntelEmulator(i386Module, i386RegisterContext, envi.Emulator):
         self.addCallingConvention("thiscall", thiscall)
         self.addCallingConvention("cdecl", cdecl)
 
+    def setMemoryObject(self, memobj):
+        self._emuUnhookDecodeCache()
+        envi.Emulator.setMemoryObject(self, memobj)
+        self._emuHookDecodeCache()
+        self.flushBlockCache()
+
+    def writeMemory(self, va, bytes):
+        self.memobj.writeMemory(va, bytes)
+        if self._emu_blockpages:
+            self._emuInvalidateBlocks(va, len(bytes))
+
+    def setDecodeCache(self, size=4096):
+        self._emuUnhookDecodeCache()
+        i386Module.setDecodeCache(self, size)
+        self._emuHookDecodeCache()
+
+    def _emuHookDecodeCache(self):
+        # Let the memory object tell our decode cache about writes
+        dcache = self._arch_dcache
+        memobj = getattr(self, "memobj", None)
+        if dcache != None and hasattr(memobj, "addWriteHook"):
+            memobj.addWriteHook(dcache.invalidate)
+
+    def _emuUnhookDecodeCache(self):
+        dcache = self._arch_dcache
+        memobj = getattr(self, "memobj", None)
+        if dcache != None and hasattr(memobj, "delWriteHook"):
+            memobj.delWriteHook(dcache.invalidate)
+
     def getSegmentIndex(self, op):
         # FIXME this needs to account for push/pop/etc
         if op.prefixes == 0:
@@ -202,7 +269,7 @@ class IntelEmulator(i386Module, i386RegisterContext, envi.Emulator):
         meth = self.op_methods.get(op.mnem, None)
         if meth == None:
             raise envi.UnsupportedInstruction(self, op)
-        if op.prefixes & PREFIX_REP:
+        if op.prefixes & REP_PREFIXES:
             x = self.doRepPrefix(meth, op)
         else:
             x = meth(op)
@@ -212,6 +279,132 @@ class IntelEmulator(i386Module, i386RegisterContext, envi.Emulator):
 
         self.setProgramCounter(x)
 
+    ###### Block Mode Execution #####
+
+    def setBlockMode(self, enabled=True):
+        """
+        Enable (or disable) block mode execution for run().  In block
+        mode, straight-line runs of instructions are decoded once into a
+        cache (keyed by their start address) and executed back to back.
+
+        NOTE: Writes made through the emulator invalidate the cached
+              blocks they touch.  If you modify code in the memory object
+              behind the emulator's back, call flushBlockCache().
+        """
+        self._emu_blockmode = enabled
+        self.flushBlockCache()
+
+    def flushBlockCache(self):
+        """
+        Throw away all the cached blocks used by block mode.
+        """
+        self._emu_blocks = {}
+        self._emu_blockpages = {}
+        self._emu_blockdirty = True
+
+    def run(self, stepcount=None):
+        if not self._emu_blockmode:
+            return envi.Emulator.run(self, stepcount)
+
+        if stepcount != None:
+            while stepcount > 0:
+                stepcount -= self.stepBlock(stepcount)
+        else:
+            while True:
+                self.stepBlock()
+
+    def stepBlock(self, maxcount=None):
+        """
+        Execute the (cached) basic block at the current program counter
+        (or at most maxcount instructions of it) and return the number
+        of instructions executed.
+        """
+        pc = self.getProgramCounter()
+        block = self._emu_blocks.get(pc)
+        if block == None:
+            block = self._emuBuildBlock(pc)
+            if block == None:
+                # Let stepi() raise whatever is wrong at pc
+                self.stepi()
+                return 1
+
+        if maxcount != None and maxcount < len(block):
+            block = block[:maxcount]
+
+        self._emu_blockdirty = False
+
+        count = 0
+        for meth, op in block:
+            if op.prefixes & REP_PREFIXES:
+                x = self.doRepPrefix(meth, op)
+            else:
+                x = meth(op)
+            count += 1
+
+            if x != None:
+                self.setProgramCounter(x)
+                break
+
+            pc = self.getProgramCounter() + op.size
+            self.setProgramCounter(pc)
+
+            # Did the emulated code write into a cached block?
+            if self._emu_blockdirty:
+                break
+
+        return count
+
+    def _emuBuildBlock(self, va):
+        block = []
+        pc = va
+        while len(block) < self._emu_blockmax:
+            # Any failure just ends the block so that stepi() can
+            # raise it when execution actually gets there.
+            try:
+                bytes = self.readMemory(pc, 32)
+                op = self.makeOpcode(bytes, va=pc)
+            except Exception, e:
+                break
+
+            meth = self.op_methods.get(op.mnem, None)
+            if meth == None:
+                break
+
+            block.append((meth, op))
+            pc += op.size
+
+            if op.iflags & BLOCK_END_FLAGS:
+                break
+
+        if not block:
+            return None
+
+        self._emu_blocks[va] = block
+        for page in xrange(va & ~0xfff, pc, 4096):
+            self._emu_blockpages.setdefault(page, []).append((va, pc))
+
+        return block
+
+    def _emuInvalidateBlocks(self, va, size):
+        end = va + size
+        for page in xrange(va & ~0xfff, end, 4096):
+            ranges = self._emu_blockpages.get(page)
+            if not ranges:
+                continue
+
+            keep = []
+            for bva, bend in ranges:
+                if bva < end and va < bend:
+                    self._emu_blocks.pop(bva, None)
+                    self._emu_blockdirty = True
+                else:
+                    keep.append((bva, bend))
+
+            if keep:
+                self._emu_blockpages[page] = keep
+            else:
+                self._emu_blockpages.pop(page)
+
     ###### Conditional Callbacks #####
 
     # NOTE: for ease of validation, these are in the same order as the Jcc
@@ -395,16 +588,219 @@ class IntelEmulator(i386Module, i386RegisterContext, envi.Emulator):
 
     def doRepPrefix(self, meth, op):
         #FIXME check for opcode family valid to rep
+        if op.mnem in rep_cond_mnems:
+            return self.doRepzPrefix(meth, op)
+
+        # repnz means nothing to the rest
+        if not op.prefixes & PREFIX_REP:
+            return meth(op)
+
+        # movs/stos do as much as they can in bulk first
+        if op.mnem in ("movsb", "movsd"):
+            self._emuRepMovs(op)
+        elif op.mnem in ("stosb", "stosd"):
+            self._emuRepStos(op)
+
+        # Whatever is left goes one element at a time (so a fault
+        # leaves ecx/esi/edi at the faulting element)
         ret = None
         ecx = self.getRegister(REG_ECX)
         while ecx != 0:
             ret = meth(op)
             ecx -= 1
-        self.setRegister(REG_ECX, 0)
+            self.setRegister(REG_ECX, ecx)
         return ret
 
     def doRepzPrefix(self, meth, op):
-        pass
+        """
+        Repeat a cmps/scas while ecx != 0 and the compare is equal
+        (rep/repz) or not equal (repnz).
+        """
+        repnz = op.prefixes & PREFIX_REPNZ
+        if not self.getFlag(EFLAGS_DF):
+            self._emuRepScan(op, repnz)
+
+        ret = None
+        ecx = self.getRegister(REG_ECX)
+        while ecx != 0:
+            ret = meth(op)
+            ecx -= 1
+            self.setRegister(REG_ECX, ecx)
+            if self.getFlag(EFLAGS_ZF):
+                if repnz:
+                    break
+            elif not repnz:
+                break
+        return ret
+
+    def getStrWidth(self, op):
+        """
+        Return the element width for a string instruction (the "d"
+        forms are words with an operand size prefix).
+        """
+        if op.mnem[-1] == "b":
+            return 1
+        if op.prefixes & PREFIX_OP_SIZE:
+            return 2
+        return 4
+
+    def _emuStrSpan(self, va, width, df, perm):
+        # How many whole elements (stepping by DF) starting at va
+        # are inside one memory map with the given perms?
+        map = self.getMemoryMap(va)
+        if map == None:
+            return 0
+        mva, msize, mperm, mname = map
+        if mperm & perm != perm:
+            return 0
+        if df:
+            if va + width > mva + msize:
+                return 0
+            return (va + width - mva) / width
+        return (mva + msize - va) / width
+
+    def _emuRepMovs(self, op):
+        width = self.getStrWidth(op)
+        df = self.getFlag(EFLAGS_DF)
+        ecx = self.getRegister(REG_ECX)
+        esi = self.getRegister(REG_ESI)
+        edi = self.getRegister(REG_EDI)
+        step = width
+        if df:
+            step = -width
+
+        while ecx != 0:
+            count = min(ecx, REP_CHUNK / width,
+                        self._emuStrSpan(esi, width, df, e_mem.MM_READ),
+                        self._emuStrSpan(edi, width, df, e_mem.MM_WRITE))
+            if count == 0:
+                break
+
+            size = count * width
+            src = esi
+            dst = edi
+            if df:
+                src -= size - width
+                dst -= size - width
+
+            # Overlapping copies (like the memset idiom) are only right
+            # if done element by element...
+            if abs(src - dst) < size:
+                break
+
+            # A fault mid-chunk goes back to the element loop, which
+            # redoes the chunk and faults with the element-wise state.
+            try:
+                self.writeMemory(dst, self.readMemory(src, size))
+            except envi.SegmentationViolation:
+                break
+
+            ecx -= count
+            esi += step * count
+            edi += step * count
+            self.setRegister(REG_ESI, esi)
+            self.setRegister(REG_EDI, edi)
+            self.setRegister(REG_ECX, ecx)
+
+    def _emuRepStos(self, op):
+        width = self.getStrWidth(op)
+        df = self.getFlag(EFLAGS_DF)
+        ecx = self.getRegister(REG_ECX)
+        edi = self.getRegister(REG_EDI)
+        base,size = self.segments[SEG_ES]
+        fmt = {1:"<B", 2:"<H", 4:"<L"}[width]
+        elem = struct.pack(fmt, self.getRegister(REG_EAX) & e_bits.u_maxes[width])
+        step = width
+        if df:
+            step = -width
+
+        while ecx != 0:
+            count = min(ecx, REP_CHUNK / width,
+                        self._emuStrSpan(base+edi, width, df, e_mem.MM_WRITE))
+            if count == 0:
+                break
+
+            dst = base + edi
+            if df:
+                dst -= (count - 1) * width
+
+            try:
+                self.writeMemory(dst, elem * count)
+            except envi.SegmentationViolation:
+                break
+
+            ecx -= count
+            edi += step * count
+            self.setRegister(REG_EDI, edi)
+            self.setRegister(REG_ECX, ecx)
+
+    def _emuRepScan(self, op, repnz):
+        # Skip (forward) over the cmps/scas elements which won't end
+        # the repeat.  The last element is always left for the real
+        # handler so it sets the flags (and the final esi/edi/ecx).
+        # The last skipped element is handed back as well, so if the
+        # element after it faults the flags are the element-wise ones.
+        width = self.getStrWidth(op)
+        cmps = op.mnem.startswith("cmps")
+        if cmps and repnz:
+            return
+
+        ecx = self.getRegister(REG_ECX)
+        esi = self.getRegister(REG_ESI)
+        edi = self.getRegister(REG_EDI)
+        base = 0
+        if not cmps:
+            base,size = self.segments[SEG_ES]
+            fmt = {1:"<B", 2:"<H", 4:"<L"}[width]
+            elem = struct.pack(fmt, self.getRegister(REG_EAX) & e_bits.u_maxes[width])
+
+        while ecx > 1:
+            count = min(ecx - 1, REP_CHUNK / width,
+                        self._emuStrSpan(base+edi, width, False, e_mem.MM_READ))
+            if cmps:
+                count = min(count, self._emuStrSpan(esi, width, False, e_mem.MM_READ))
+            if count == 0:
+                break
+
+            size = count * width
+            dbytes = self.readMemory(base+edi, size)
+            if cmps:
+                off = strMismatch(self.readMemory(esi, size), dbytes)
+
+            elif repnz:
+                # Find the first (aligned) element equal to eax
+                off = dbytes.find(elem)
+                while off != -1 and off % width:
+                    off = dbytes.find(elem, off + 1)
+
+            elif width == 1:
+                off = size - len(dbytes.lstrip(elem))
+                if off == size:
+                    off = -1
+
+            else:
+                off = strMismatch(elem * count, dbytes)
+
+            done = count
+            if off != -1:
+                done = off / width
+
+            ecx -= done
+            esi += done * width
+            edi += done * width
+            if done != count:
+                break
+
+        if ecx == self.getRegister(REG_ECX):
+            return
+
+        ecx += 1
+        esi -= width
+        edi -= width
+        self.setRegister(REG_ECX, ecx)
+        self.setRegister(REG_EDI, edi)
+        if cmps:
+            self.setRegister(REG_ESI, esi)
 
     # Beginning of Instruction methods
 
@@ -629,15 +1025,14 @@ class IntelEmulator(i386Module, i386RegisterContext, envi.Emulator):
 
         self.intSubBase(sval, dval, width, width)
 
-        if self.getFlag(EFLAGS_ZF):
-            if self.getFlag(EFLAGS_DF): # decrement
-                esi -= width
-                edi -= width
-            else:
-                esi += width
-                edi += width
-            self.setRegister(REG_ESI, esi)
-            self.setRegister(REG_EDI, edi)
+        if self.getFlag(EFLAGS_DF): # decrement
+            esi -= width
+            edi -= width
+        else:
+            esi += width
+            edi += width
+        self.setRegister(REG_ESI, esi)
+        self.setRegister(REG_EDI, edi)
 
     def i_cmpsb(self, op):
         self.doCmps(1)
@@ -645,13 +1040,9 @@ class IntelEmulator(i386Module, i386RegisterContext, envi.Emulator):
     def i_cmpsd(self, op):
         """
         Compare the dword pointed at by ds:esi to ds:edi.
-        (if equal, update esi/edi by one acording to DF)
+        (and update esi/edi by one acording to DF)
         """
-        width = 4
-        if op.prefixes & PREFIX_OP_SIZE:
-            width = 2
-
-        self.doCmps(width)
+        self.doCmps(self.getStrWidth(op))
 
     def i_cmpxchg(self, op):
         tsize = op.opers[0].tsize
@@ -991,16 +1382,17 @@ class IntelEmulator(i386Module, i386RegisterContext, envi.Emulator):
             self.setRegister(REG_EDI, edi+1)
 
     def i_movsd(self, op):
+        width = self.getStrWidth(op)
         esi = self.getRegister(REG_ESI)
         edi = self.getRegister(REG_EDI)
-        bytes = self.readMemory(esi, 4)
+        bytes = self.readMemory(esi, width)
         self.writeMemory(edi, bytes)
         if self.getFlag(EFLAGS_DF):
-            self.setRegister(REG_ESI, esi-4)
-            self.setRegister(REG_EDI, edi-4)
+            self.setRegister(REG_ESI, esi-width)
+            self.setRegister(REG_EDI, edi-width)
         else:
-            self.setRegister(REG_ESI, esi+4)
-            self.setRegister(REG_EDI, edi+4)
+            self.setRegister(REG_ESI, esi+width)
+            self.setRegister(REG_EDI, edi+width)
 
     def i_movsx(self, op):
         osize = op.opers[1].tsize
@@ -1483,16 +1875,16 @@ class IntelEmulator(i386Module, i386RegisterContext, envi.Emulator):
         self.setRegister(REG_EDI, edi)
 
     def i_scasd(self, op):
-        #FIXME probably need to handle oper prefix by hand here...
-        eax = self.getRegister(REG_EAX)
+        width = self.getStrWidth(op)
+        eax = self.getRegister(REG_EAX) & e_bits.u_maxes[width]
         edi = self.getRegister(REG_EDI)
         base,size = self.segments[SEG_ES]
-        memval = struct.unpack("<L",self.readMemory(base+edi, 4))[0]
-        self.intSubBase(eax, memval, 4, 4)
+        memval = self.readMemValue(base+edi, width)
+        self.intSubBase(eax, memval, width, width)
         if self.getFlag(EFLAGS_DF):
-            edi -= 4
+            edi -= width
         else:
-            edi += 4
+            edi += width
         self.setRegister(REG_EDI, edi)
 
     def i_stosb(self, op):
@@ -1507,14 +1899,15 @@ class IntelEmulator(i386Module, i386RegisterContext, envi.Emulator):
         self.setRegister(REG_EDI, edi)
 
     def i_stosd(self, op):
-        al = self.getRegister(REG_AL)
+        width = self.getStrWidth(op)
+        eax = self.getRegister(REG_EAX)
         edi = self.getRegister(REG_EDI)
         base,size = self.segments[SEG_ES]
-        self.writeMemory(base+edi, struct.pack("<L", eax))
+        self.writeMemValue(base+edi, eax & e_bits.u_maxes[width], width)
         if self.getFlag(EFLAGS_DF):
-            edi -= 4
+            edi -= width
         else:
-            edi += 4
+            edi += width
         self.setRegister(REG_EDI, edi)
 
     # We include all the possible SETcc names just in case somebody
@@ -1582,17 +1975,6 @@ class IntelEmulator(i386Module, i386RegisterContext, envi.Emulator):
     def i_sti(self, op):
         self.setFlag(EFLAGS_IF, True)
 
-    # FIXME stos variants go here
-    def i_stosd(self, op):
-        eax = self.getRegister(REG_EAX)
-        edi = self.getRegister(REG_EDI)
-        # FIXME shouldn't have to do this directly
-        # FIXME this needs a 32/16 bit mode check
-        base,size = self.segments[SEG_ES]
-        self.writeMemValue(base+edi, eax, 4)
-        # FIXME edi inc must be by oper len
-        self.setRegister(REG_EDI, edi+4)
-
     def i_sub(self, op):
         x = self.integerSubtraction(op)
         if x != None:
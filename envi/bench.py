@@ -0,0 +1,341 @@
+"""
+Micro benchmarks for envi components.
+
+Usage: python -m envi.bench [<name> ...]
+"""
+import sys
+import time
+import struct
+
+import envi
+
+# A chunk of typical compiler generated i386 code used by the benchmarks
+i386_code = ("\x55\x89\xe5\x83\xec\x18\x8b\x45\x08\x8b\x55\x0c\x01\xd0\x89\x04"
+             "\x24\xe8\x10\x00\x00\x00\x85\xc0\x74\x05\xc9\xc3\x90\x8d\x74\x26"
+             "\x00\x0f\xb6\x44\x8e\x04\xc7\x45\xfc\x00\x00\x00\x00")
+
+def objsize(obj):
+    """
+    Return the size in bytes of the given object plus its instance
+    dictionary (if it has one).
+    """
+    size = sys.getsizeof(obj)
+    d = getattr(obj, "__dict__", None)
+    if d != None:
+        size += sys.getsizeof(d)
+    return size
+
+def opcodeSize(op):
+    """
+    Return the bytes used by an Opcode and its Operand objects.
+    """
+    size = objsize(op) + sys.getsizeof(op.opers)
+    for oper in op.opers:
+        size += objsize(oper)
+    return size
+
+def benchOpcodeMemory(count=20000):
+    """
+    Decode count instructions and report the average bytes
+    used per decoded instruction.
+    """
+    arch = envi.getArchModule("i386")
+    code = i386_code * ((count / 10) + 1)
+
+    ops = []
+    offset = 0
+    total = 0
+    while len(ops) < count:
+        op = arch.makeOpcode(code, offset, 0x41410000 + offset)
+        total += opcodeSize(op)
+        offset += op.size
+        ops.append(op)
+
+    print "opcode memory: %d instructions %.1f bytes/instruction" % (count, float(total) / count)
+
+# A little emulation loop (sum ecx down to 0 with a push/pop in the loop)
+#   mov ecx,count / xor eax,eax / add eax,ecx / push eax / pop edx /
+#   dec ecx / jnz <add> / int3
+def loopCode(count):
+    return "\xb9" + struct.pack("<L", count) + "\x31\xc0\x01\xc8\x50\x5a\x49\x75\xf9\xcc"
+
+def loopEmulator(count):
+    import envi.memory as e_mem
+    import envi.archs.i386 as e_i386
+
+    emu = envi.getArchModule("i386").getEmulator()
+    mem = e_mem.MemoryObject()
+    mem.addMemoryMap(0x41410000, e_mem.MM_RWX, "code", loopCode(count))
+    mem.addMemoryMap(0x42420000, e_mem.MM_RWX, "stack", "\x00" * 0x10000)
+    emu.setMemoryObject(mem)
+    emu.setProgramCounter(0x41410000)
+    emu.setRegister(e_i386.REG_ESP, 0x42428000)
+    emu.setRegister(e_i386.REG_EFLAGS, 0)
+    return emu
+
+def runToBreak(emu):
+    start = time.time()
+    try:
+        emu.run()
+    except envi.BreakpointHit:
+        pass
+    return time.time() - start
+
+def benchEmuBlocks(count=5000):
+    """
+    Compare emulating a loop by stepi() against block mode.
+    """
+    emu = loopEmulator(count)
+    stime = runToBreak(emu)
+
+    emu = loopEmulator(count)
+    emu.setBlockMode()
+    btime = runToBreak(emu)
+
+    icount = (count * 5) + 3
+    print "emulator stepi: %d instructions %.2f us/instruction" % (icount, (stime * 1000000) / icount)
+    print "emulator block: %d instructions %.2f us/instruction" % (icount, (btime * 1000000) / icount)
+
+def benchMemoryWrites(count=2000, mapsize=0x100000):
+    """
+    Time 4 byte writes into a 1MB "stack" for the memory objects.
+    """
+    import envi.memory as e_mem
+
+    for cls in (e_mem.MemoryObject, e_mem.PageMemoryObject):
+        mem = cls()
+        mem.addMemoryMap(0x42420000, e_mem.MM_RWX, "stack", "\x00" * mapsize)
+        start = time.time()
+        va = 0x42420000 + mapsize
+        for i in xrange(count):
+            va -= 4
+            mem.writeMemory(va, "AAAA")
+            mem.readMemory(va, 4)
+        t = time.time() - start
+        print "%s: %d stack writes %.2f us/write" % (cls.__name__, count, (t * 1000000) / count)
+
+def benchRepMovs(size=0x10000):
+    """
+    Time an emulated "rep movsd" copying size bytes.
+    """
+    import envi.memory as e_mem
+    import envi.archs.i386 as e_i386
+
+    emu = envi.getArchModule("i386").getEmulator()
+    mem = e_mem.MemoryObject()
+    mem.addMemoryMap(0x41410000, e_mem.MM_RWX, "code", "\xf3\xa5\xcc")
+    mem.addMemoryMap(0x42420000, e_mem.MM_RWX, "heap", "A" * (size * 2))
+    emu.setMemoryObject(mem)
+    emu.setProgramCounter(0x41410000)
+    emu.setRegister(e_i386.REG_EFLAGS, 0)
+    emu.setRegister(e_i386.REG_ECX, size / 4)
+    emu.setRegister(e_i386.REG_ESI, 0x42420000)
+    emu.setRegister(e_i386.REG_EDI, 0x42420000 + size)
+    t = runToBreak(emu)
+    print "emulator rep movsd: %d bytes %.2f ms" % (size, t * 1000)
+
+def benchMapReads(count=20000, mapcount=2000):
+    """
+    Time 16 byte reads which straddle the boundaries between
+    adjacent maps in a MemoryObject with many maps.
+    """
+    import envi.memory as e_mem
+
+    mem = e_mem.MemoryObject()
+    for i in xrange(mapcount):
+        mem.addMemoryMap(0x41410000 + (i * 0x1000), e_mem.MM_RWX, "map%d" % i, "\xcc" * 0x1000)
+
+    start = time.time()
+    for i in xrange(count):
+        va = 0x41410000 + ((i % (mapcount-1)) * 0x1000) + 0xff8
+        if len(mem.readMemory(va, 16)) != 16:
+            raise Exception("Short read at 0x%.8x" % va)
+    t = time.time() - start
+    print "MemoryObject: %d cross map reads (%d maps) %.2f us/read" % (count, mapcount, (t * 1000000) / count)
+
+def benchEmuStartup(count=2000):
+    """
+    Time the construction of i386 emulators.
+    """
+    arch = envi.getArchModule("i386")
+    start = time.time()
+    for i in xrange(count):
+        arch.getEmulator()
+    t = time.time() - start
+    print "emulator startup: %d emulators %.2f us/emulator" % (count, (t * 1000000) / count)
+
+def benchEmuSnapshots(count=200, mapsize=0x1000000):
+    """
+    Time snapshot / write / restore cycles on an emulator with a 16MB
+    map using deepcopy (MemoryObject) and journals (PageMemoryObject).
+    """
+    import envi.memory as e_mem
+
+    emu = envi.getArchModule("i386").getEmulator()
+    for cls in (e_mem.MemoryObject, e_mem.PageMemoryObject):
+        mem = cls()
+        mem.addMemoryMap(0x42420000, e_mem.MM_RWX, "heap", "\x00" * mapsize)
+        emu.setMemoryObject(mem)
+        start = time.time()
+        for i in xrange(count):
+            snap = emu.emuSnapshot()
+            for j in xrange(8):
+                emu.writeMemory(0x42420000 + (j * 0x10000), "AAAA")
+            emu.emuRestore(snap)
+            emu.emuDropSnapshot(snap)
+        t = time.time() - start
+        print "%s: %d snapshot/restore %.2f us/cycle" % (cls.__name__, count, (t * 1000000) / count)
+
+def benchSigScan(sigcount=2000, size=10*1024*1024, count=200000):
+    """
+    Time finding signatures in a synthetic 10MB buffer with
+    getSignature() at each offset against SignatureTree.scanBuffer().
+    """
+    import random
+    import envi.bytesig as e_bytesig
+
+    rand = random.Random(0x4141)
+    tree = e_bytesig.SignatureTree()
+    sigs = []
+    for i in xrange(sigcount):
+        sig = "".join([chr(rand.randint(0, 255)) for j in xrange(16)])
+        # Mask out a "relocated" dword in half the signatures
+        masks = None
+        if i % 2:
+            masks = "\xff" * 8 + "\x00" * 4 + "\xff" * 4
+            sig = sig[:8] + "\x00" * 4 + sig[12:]
+        tree.addSignature(sig, masks, val=i)
+        sigs.append(sig)
+
+    # Plant a signature every 1k in a random 64k block
+    block = [chr(rand.randint(0, 255)) for i in xrange(0x10000)]
+    for i in xrange(0, 0x10000, 0x400):
+        block[i:i+16] = list(rand.choice(sigs))
+    bytes = "".join(block) * (size / 0x10000)
+
+    start = time.time()
+    for offset in xrange(count):
+        tree.getSignature(bytes, offset)
+    t = time.time() - start
+    print "getSignature: %d offsets %.2f us/offset (%.2f s for %d bytes)" % (count, (t * 1000000) / count, (t / count) * size, size)
+
+    start = time.time()
+    tree.scanBuffer("")
+    ctime = time.time() - start
+
+    start = time.time()
+    hits = tree.scanBuffer(bytes)
+    t = time.time() - start
+    print "scanBuffer: %d sigs %d bytes %d hits %.2f s (compile %.2f s, numpy %s)" % (sigcount, size, len(hits), t, ctime, e_bytesig.numpy != None)
+
+def benchSigDb(sigcount=50000, count=20000):
+    """
+    Time building, saving and loading a 50k signature database (and
+    lookups in the loaded one).
+    """
+    import os
+    import random
+    import tempfile
+    import envi.bytesig as e_bytesig
+
+    rand = random.Random(0x4141)
+    sigs = []
+    for i in xrange(sigcount):
+        sigs.append("".join([chr(rand.randint(0, 255)) for j in xrange(16)]))
+
+    start = time.time()
+    tree = e_bytesig.SignatureTree()
+    for i in xrange(sigcount):
+        tree.addSignature(sigs[i], val=i)
+    print "build: %d sigs %.2f s" % (sigcount, time.time() - start)
+
+    fd, filename = tempfile.mkstemp(suffix=".sigs")
+    os.close(fd)
+    try:
+        start = time.time()
+        tree.save(filename)
+        print "save: %d bytes %.2f s" % (os.path.getsize(filename), time.time() - start)
+
+        start = time.time()
+        mtree = e_bytesig.loadSignatures(filename)
+        print "load: %.2f ms" % ((time.time() - start) * 1000)
+
+        for t in (tree, mtree):
+            start = time.time()
+            for i in xrange(count):
+                if t.getSignature(sigs[i % sigcount]) != i % sigcount:
+                    raise Exception("Signature %d not found!" % i)
+            ltime = time.time() - start
+            print "%s: %d lookups %.2f us/lookup" % (t.__class__.__name__, count, (ltime * 1000000) / count)
+
+        mtree.close()
+
+    finally:
+        os.unlink(filename)
+
+def benchSymbols(symcount=10000, count=20000):
+    """
+    Time loading a libc sized symbol table into a SymbolResolver
+    (one at a time and in bulk) and nearest symbol lookups.
+    """
+    import random
+    import envi.resolver as e_resolv
+
+    rand = random.Random(0x4141)
+    base = 0x41410000
+    syms = []
+    va = base
+    for i in xrange(symcount):
+        va += rand.randint(1, 0x100)
+        syms.append(e_resolv.FunctionSymbol("func%d" % i, va, 0, "libc"))
+    vas = [rand.randint(base, va + 0x100) for i in xrange(count)]
+
+    for bulk in (False, True):
+        res = e_resolv.SymbolResolver()
+        res.addSymbol(e_resolv.FileSymbol("libc", base, va - base))
+        start = time.time()
+        if bulk:
+            res.addSymbols(syms)
+        else:
+            for sym in syms:
+                res.addSymbol(sym)
+        t = time.time() - start
+        print "%s: %d symbols %.2f ms" % (bulk and "addSymbols" or "addSymbol", symcount, t * 1000)
+
+    start = time.time()
+    for va in vas:
+        if res.getSymByAddr(va, exact=False) == None:
+            raise Exception("No symbol for 0x%.8x" % va)
+    t = time.time() - start
+    print "getSymByAddr(exact=False): %d lookups %.2f us/lookup" % (count, (t * 1000000) / count)
+
+benchmarks = {
+    "opmem":benchOpcodeMemory,
+    "emublock":benchEmuBlocks,
+    "memwrite":benchMemoryWrites,
+    "emusnap":benchEmuSnapshots,
+    "emustart":benchEmuStartup,
+    "mapread":benchMapReads,
+    "repmovs":benchRepMovs,
+    "sigdb":benchSigDb,
+    "symbols":benchSymbols,
+    "sigscan":benchSigScan,
+}
+
+def main(argv):
+    names = argv
+    if not names:
+        names = benchmarks.keys()
+        names.sort()
+
+    for name in names:
+        bench = benchmarks.get(name)
+        if bench == None:
+            print "Unknown benchmark: %s (try: %s)" % (name, ",".join(benchmarks.keys()))
+            return 1
+        bench()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
+
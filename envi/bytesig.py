@@ -6,24 +6,258 @@ signature matching.
 
 Currently used by vivisect function entry sig db and others.
 """
+import re
+import mmap
+import array
+import struct
+import cPickle
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class SignatureScanner:
+    """
+    A compiled (flattened) form of a SignatureTree used to find
+    signatures at every offset of a buffer.
+
+    Each node is an index into parallel lists:
+        tables - a list of 256 next node indexes (-1 for no match) for
+                 tree nodes which still have a choice to make (else None)
+        cbytes/cmasks/cnext - for the rest of a single signature, one
+                 (byte & mask) comparison per node
+        vals   - the index of the matched signature value (else -1)
+
+    The scan gives exactly the results of SignatureTree.getSignature()
+    at each offset (except that matches which would run off the end of
+    the buffer are not returned rather than raising IndexError).
+    """
+    def __init__(self, tree):
+        self.tables = []
+        self.cbytes = []
+        self.cmasks = []
+        self.cnext = []
+        self.vals = []
+        self.values = []
+
+        self._np = None
+
+        todo = [(tree._sigRootNode(), self._newNode())]
+        while todo:
+            tnode, idx = todo.pop()
+            depth, siginfo, choices = tree._sigNodeInfo(tnode)
+
+            if siginfo != None:
+                # The rest of the signature is a chain of compares
+                sbytes, smasks, sobj = siginfo
+                for i in xrange(depth, len(sbytes)):
+                    nidx = self._newNode()
+                    self.cbytes[idx] = sbytes[i]
+                    self.cmasks[idx] = smasks[i]
+                    self.cnext[idx] = nidx
+                    idx = nidx
+                self.vals[idx] = len(self.values)
+                self.values.append(sobj)
+                continue
+
+            if not choices:
+                continue
+
+            # Precompute the choice getSignature() makes for each byte
+            # (the first choice whose masked byte matches wins)
+            table = [-1] * 256
+            kids = {}
+            for b in xrange(256):
+                for cbyte, cmask, child in choices:
+                    if b & cmask == cbyte:
+                        kidx = kids.get(cbyte)
+                        if kidx == None:
+                            kidx = self._newNode()
+                            kids[cbyte] = kidx
+                            todo.append((child, kidx))
+                        table[b] = kidx
+                        break
+            self.tables[idx] = table
+
+        # Which bytes may start a signature (the prefilter)
+        first = [b for b in xrange(256) if self._step(0, b) != -1]
+        self.prefilter = None
+        if first:
+            chars = "".join([re.escape(chr(b)) for b in first])
+            self.prefilter = re.compile("[%s]" % chars, re.DOTALL)
+
+    def _newNode(self):
+        self.tables.append(None)
+        self.cbytes.append(0)
+        self.cmasks.append(0)
+        self.cnext.append(-1)
+        self.vals.append(-1)
+        return len(self.vals) - 1
+
+    def _step(self, node, b):
+        if self.vals[node] != -1:
+            return -1
+        table = self.tables[node]
+        if table != None:
+            return table[b]
+        if b & self.cmasks[node] != self.cbytes[node]:
+            return -1
+        return self.cnext[node]
+
+    def scanBuffer(self, bytes, base=0):
+        """
+        Return a list of (va, value) tuples for each offset in bytes
+        where a signature matches (va is base + offset).
+        """
+        if not self.vals or not bytes:
+            return []
+
+        # A zero length signature matches everywhere...
+        if self.vals[0] != -1:
+            val = self.values[self.vals[0]]
+            return [(base + i, val) for i in xrange(len(bytes))]
+
+        if self.prefilter == None:
+            return []
+
+        if numpy != None:
+            return self._scanNumpy(bytes, base)
+
+        tables = self.tables
+        cbytes = self.cbytes
+        cmasks = self.cmasks
+        cnext = self.cnext
+        vals = self.vals
+        values = self.values
+        blen = len(bytes)
+
+        ret = []
+        for m in self.prefilter.finditer(bytes):
+            offset = m.start()
+            node = 0
+            i = offset
+            while True:
+                v = vals[node]
+                if v != -1:
+                    ret.append((base + offset, values[v]))
+                    break
+
+                if i >= blen:
+                    break
+                b = ord(bytes[i])
+                i += 1
+
+                table = tables[node]
+                if table != None:
+                    node = table[b]
+                    if node == -1:
+                        break
+                elif b & cmasks[node] == cbytes[node]:
+                    node = cnext[node]
+                else:
+                    break
+
+        return ret
+
+    def _getNumpyArrays(self):
+        if self._np == None:
+            rows = [t for t in self.tables if t != None]
+            tblrow = []
+            r = 0
+            for t in self.tables:
+                if t == None:
+                    tblrow.append(-1)
+                else:
+                    tblrow.append(r)
+                    r += 1
+
+            self._np = (
+                numpy.array(rows, dtype=numpy.int32).reshape((len(rows), 256)),
+                numpy.array(tblrow, dtype=numpy.int32),
+                numpy.array(self.cbytes, dtype=numpy.uint8),
+                numpy.array(self.cmasks, dtype=numpy.uint8),
+                numpy.array(self.cnext, dtype=numpy.int32),
+                numpy.array(self.vals, dtype=numpy.int32),
+            )
+        return self._np
+
+    def _scanNumpy(self, bytes, base):
+        # Walk the tree for every offset at once, one byte per step
+        tables, tblrow, cbytes, cmasks, cnext, vals = self._getNumpyArrays()
+
+        buf = numpy.frombuffer(bytes, dtype=numpy.uint8)
+        blen = len(buf)
+        offsets = numpy.arange(blen, dtype=numpy.intp)
+        nodes = numpy.zeros(blen, dtype=numpy.int32)
+
+        hitoffs = []
+        hitvals = []
+        depth = 0
+        while len(offsets):
+            v = vals[nodes]
+            done = v != -1
+            if done.any():
+                hitoffs.append(offsets[done])
+                hitvals.append(v[done])
+                keep = ~done
+                offsets = offsets[keep]
+                nodes = nodes[keep]
+
+            keep = offsets + depth < blen
+            offsets = offsets[keep]
+            nodes = nodes[keep]
+            if not len(offsets):
+                break
+
+            b = buf[offsets + depth]
+            rows = tblrow[nodes]
+            istable = rows != -1
+            nxt = numpy.where((b & cmasks[nodes]) == cbytes[nodes], cnext[nodes], -1)
+            if istable.any():
+                nxt[istable] = tables[rows[istable], b[istable]]
+
+            keep = nxt != -1
+            offsets = offsets[keep]
+            nodes = nxt[keep]
+            depth += 1
+
+        if not hitoffs:
+            return []
+
+        hitoffs = numpy.concatenate(hitoffs)
+        hitvals = numpy.concatenate(hitvals)
+        order = numpy.argsort(hitoffs, kind="mergesort")
+        values = self.values
+        return [(base + int(o), values[v]) for o, v in zip(hitoffs[order].tolist(), hitvals[order].tolist())]
 
 class SignatureTree:
     """
-    A byte based decision tree which uses all the RAMs but is
-    really fast....
+    A byte based decision tree which is really fast....
 
     Signatures consist of a byte sequence and an optional mask
     sequence.  If present each mask byte is used to logical and
     the byte being compared before comparison.  This allows the
     creation of signatures which have parts of the sig generalized.
 
+    Each node is a list of [depth, siginfo, pairs, kids]:
+        empty nodes - siginfo, pairs and kids are all None
+        leaf nodes  - siginfo is the one (bytes, masks, val) tuple
+                      which made it this deep (bytes/masks are arrays)
+        choice nodes - pairs is the list of distinct (byte, mask)
+                      choices in the order the sigs were added and
+                      kids is a {byte:node} dict (sparse children)
+
+    Use save() to write the tree to a file which loadSignatures()
+    can map into memory (and share between processes).
+
     FIXME allow sigs to have a reliability rating
     FIXME allow sig nodes to store depth and truncate the tree early (and then mask the rest)
     """
 
     def __init__(self):
-        self.basenode = (0, [], [None for i in range(256)])
-        self.sigs = {} # track duplicates
+        self.basenode = [0, None, None, None]
+        self.scanner = None # compiled on demand by scanBuffer()
 
     def _addChoice(self, siginfo, node):
 
@@ -33,36 +267,63 @@ class SignatureTree:
         while len(todo):
 
             node, siginfo = todo.pop()
-            depth, sigs, choices = node
-            bytes, masks, o = siginfo
-            siglen = len(sigs)
+            depth, cursig, pairs, kids = node
 
-            sigs.append(siginfo)
-            if siglen == 0:
-                pass # we just don't want the "else" here, if we're the only
-                # one on this node, just let it ride.
+            if pairs == None:
+                if cursig == None:
+                    # If we're the only one on this node, just let it ride.
+                    node[1] = siginfo
+                    continue
 
-            elif siglen == 1:
                 # If it has one already, we *both* need to add another level
                 # (because if it is the only one, it thought it was last choice)
-                for s in sigs:
-                    chval = s[0][depth] # get the choice byte from siginfo
-                    nnode = self._getNode(depth, choices, chval)
-                    todo.append((nnode, s))
+                node[1] = None
+                node[2] = []
+                node[3] = {}
+                for s in (cursig, siginfo):
+                    todo.append((self._getNode(node, s), s))
+                continue
 
-            else: # This is already a choice node, keep on choosing...
-                chval = bytes[depth]
-                nnode = self._getNode(depth, choices, chval)
-                todo.append((nnode, siginfo))
+            # This is already a choice node, keep on choosing...
+            todo.append((self._getNode(node, siginfo), siginfo))
 
-    def _getNode(self, depth, choices, choice):
+    def _getNode(self, node, siginfo):
         # Chose, (and or initialize) a sub node
-        nnode = choices[choice]
+        depth, cursig, pairs, kids = node
+        bytes, masks, o = siginfo
+        chval = bytes[depth]
+        pair = (chval, masks[depth])
+        if pair not in pairs:
+            pairs.append(pair)
+
+        nnode = kids.get(chval)
         if nnode == None:
-            nnode = (depth+1, [], [None for i in range(256)])
-            choices[choice] = nnode
+            nnode = [depth+1, None, None, None]
+            kids[chval] = nnode
         return nnode
 
+    def _hasSignature(self, byteord, maskord):
+        # Walk the path the sig would take to see if it's already here
+        node = self.basenode
+        while node != None:
+            depth, siginfo, pairs, kids = node
+            if siginfo != None:
+                return siginfo[0] == byteord and siginfo[1] == maskord
+            if pairs == None or depth >= len(byteord):
+                return False
+            node = kids.get(byteord[depth])
+        return False
+
+    def _sigRootNode(self):
+        return self.basenode
+
+    def _sigNodeInfo(self, node):
+        # Return (depth, siginfo, [(byte, mask, child), ...]) for a node
+        depth, siginfo, pairs, kids = node
+        if pairs == None:
+            return depth, siginfo, []
+        return depth, None, [(cbyte, cmask, kids[cbyte]) for cbyte, cmask in pairs]
+
     def addSignature(self, bytes, masks=None, val=None):
         """
         Add a signature to the search tree.  If masks goes unspecified, it will be
@@ -78,15 +339,14 @@ class SignatureTree:
         if val == None:
             val = True
 
+        byteord = array.array("B", bytes)
+        maskord = array.array("B", masks)
+
         # Detect and skip duplicate additions...
-        bytekey = bytes + masks
-        if self.sigs.get(bytekey) != None:
+        if self._hasSignature(byteord, maskord):
             return
 
-        self.sigs[bytekey] = True
-
-        byteord = [ord(c) for c in bytes]
-        maskord = [ord(c) for c in masks]
+        self.scanner = None
 
         siginfo = (byteord, maskord, val)
         self._addChoice(siginfo, self.basenode)
@@ -98,11 +358,11 @@ class SignatureTree:
 
         node = self.basenode
         while True:
-            depth, sigs, choices = node
+            depth, siginfo, pairs, kids = node
             # Once we get down to one sig, there are no more branches,
             # just check the byte sequence.
-            if len(sigs) == 1:
-                sbytes, smasks, sobj = sigs[0]
+            if siginfo != None:
+                sbytes, smasks, sobj = siginfo
                 for i in xrange(depth, len(sbytes)):
                     realoff = offset + i
                     masked = ord(bytes[realoff]) & smasks[i]
@@ -110,15 +370,216 @@ class SignatureTree:
                         return None
                 return sobj
 
+            if pairs == None:
+                return None
+
             # There are still more choices, keep branching.
             node = None # Lets go find a new one
-            for sig in sigs:
-                sbytes, smasks, sobj = sig
-                masked = ord(bytes[offset+depth]) & smasks[depth]
-                if sbytes[depth] == masked: # We have a winner!
-                    node = choices[masked]
+            b = ord(bytes[offset+depth])
+            for cbyte, cmask in pairs:
+                if b & cmask == cbyte: # We have a winner!
+                    node = kids[cbyte]
                     break
 
             # We failed to make our next choice
             if node == None:
                 return None
+
+    def scanBuffer(self, bytes, base=0):
+        """
+        Check every offset in bytes for a signature (in one pass) and
+        return a list of (va, val) tuples where va is base + offset.
+
+        This uses a compiled SignatureScanner which is built on the
+        first scan after any signatures are added (and uses numpy
+        when it is available).
+        """
+        if self.scanner == None:
+            self.scanner = SignatureScanner(self)
+        return self.scanner.scanBuffer(bytes, base)
+
+    def save(self, filename):
+        """
+        Save the signatures to a file for loadSignatures().
+        (The vals must be pickleable)
+        """
+        saveSignatures(self, filename)
+
+# The signature file format (all little endian):
+#   header: magic, version, node count, node table offset,
+#           values offset, values size
+#   node table: (depth, choice count, data offset) per node (node 0 is
+#           the root).  The data is a list of (byte, mask, child node)
+#           choices, or for leaf nodes (count == SIGFILE_LEAF) a
+#           (length, value index) header followed by the bytes and masks
+#   values: a pickled list of the signature values
+SIGFILE_MAGIC = "ENVISIGS"
+SIGFILE_VERSION = 1
+SIGFILE_LEAF = 0xffffffff
+
+sigfile_header = struct.Struct("<8sIIIII")
+sigfile_node = struct.Struct("<III")
+sigfile_choice = struct.Struct("<BBxxI")
+sigfile_leaf = struct.Struct("<II")
+
+def saveSignatures(tree, filename):
+    """
+    Save a SignatureTree (or MappedSignatureTree) to a file.
+    """
+    # Number the nodes breadth first
+    handles = [tree._sigRootNode()]
+    nodes = []
+    data = []
+    dataoff = 0
+    values = []
+    i = 0
+    while i < len(handles):
+        depth, siginfo, choices = tree._sigNodeInfo(handles[i])
+        i += 1
+
+        if siginfo != None:
+            sbytes, smasks, sobj = siginfo
+            nodes.append((depth, SIGFILE_LEAF, dataoff))
+            chunk = sigfile_leaf.pack(len(sbytes), len(values)) + sbytes.tostring() + smasks.tostring()
+            values.append(sobj)
+
+        else:
+            nodes.append((depth, len(choices), dataoff))
+            kids = {}
+            parts = []
+            for cbyte, cmask, child in choices:
+                kidx = kids.get(cbyte)
+                if kidx == None:
+                    kidx = len(handles)
+                    kids[cbyte] = kidx
+                    handles.append(child)
+                parts.append(sigfile_choice.pack(cbyte, cmask, kidx))
+            chunk = "".join(parts)
+
+        data.append(chunk)
+        dataoff += len(chunk)
+
+    nodeoff = sigfile_header.size
+    dataoff = nodeoff + (len(nodes) * sigfile_node.size)
+    valbytes = cPickle.dumps(values, 2)
+    valoff = dataoff + sum([len(d) for d in data])
+
+    f = file(filename, "wb")
+    try:
+        f.write(sigfile_header.pack(SIGFILE_MAGIC, SIGFILE_VERSION, len(nodes), nodeoff, valoff, len(valbytes)))
+        for depth, count, off in nodes:
+            f.write(sigfile_node.pack(depth, count, dataoff + off))
+        for chunk in data:
+            f.write(chunk)
+        f.write(valbytes)
+    finally:
+        f.close()
+
+def loadSignatures(filename):
+    """
+    Map a signature file written by SignatureTree.save() into memory
+    and return a (read only) MappedSignatureTree for it.
+    """
+    return MappedSignatureTree(filename)
+
+class MappedSignatureTree:
+    """
+    A read only SignatureTree which walks the nodes of a signature
+    file (see saveSignatures) mapped into memory.  Loading is just
+    mapping the file (and unpickling the values), and the pages are
+    shared by every process which maps the same file.
+
+    NOTE: getSignature() caches the nodes it has decoded.
+    """
+    def __init__(self, filename):
+        f = file(filename, "rb")
+        try:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+
+        hdr = self.mmap[:sigfile_header.size]
+        if len(hdr) != sigfile_header.size:
+            raise Exception("%s is not a signature file" % filename)
+
+        magic, vers, self.nodecount, self.nodeoff, valoff, valsize = sigfile_header.unpack(hdr)
+        if magic != SIGFILE_MAGIC:
+            raise Exception("%s is not a signature file" % filename)
+        if vers != SIGFILE_VERSION:
+            raise Exception("Unsupported signature file version: %d" % vers)
+
+        self.values = cPickle.loads(self.mmap[valoff:valoff+valsize])
+        self.nodecache = {}
+        self.scanner = None
+
+    def close(self):
+        self.mmap.close()
+
+    def _sigRootNode(self):
+        return 0
+
+    def _sigNodeInfo(self, node):
+        depth, count, off = sigfile_node.unpack_from(self.mmap, self.nodeoff + (node * sigfile_node.size))
+        if count == SIGFILE_LEAF:
+            slen, vidx = sigfile_leaf.unpack_from(self.mmap, off)
+            off += sigfile_leaf.size
+            sbytes = array.array("B", self.mmap[off:off+slen])
+            smasks = array.array("B", self.mmap[off+slen:off+(2*slen)])
+            return depth, (sbytes, smasks, self.values[vidx]), []
+
+        choices = []
+        for i in xrange(count):
+            choices.append(sigfile_choice.unpack_from(self.mmap, off + (i * sigfile_choice.size)))
+        return depth, None, choices
+
+    def isSignature(self, bytes, offset=0):
+        return self.getSignature(bytes, offset=offset) != None
+
+    def _getNode(self, node):
+        # Decode (and cache) a node for getSignature()
+        ret = self.nodecache.get(node)
+        if ret == None:
+            depth, siginfo, choices = self._sigNodeInfo(node)
+            bytemap = None
+            if choices and not [c for c in choices if c[1] != 0xff]:
+                # Unmasked choices are unique by byte (order doesn't matter)
+                bytemap = dict([(cbyte, child) for cbyte, cmask, child in choices])
+            ret = (depth, siginfo, choices, bytemap)
+            self.nodecache[node] = ret
+        return ret
+
+    def getSignature(self, bytes, offset=0):
+        node = 0
+        while True:
+            depth, siginfo, choices, bytemap = self._getNode(node)
+            if siginfo != None:
+                sbytes, smasks, sobj = siginfo
+                for i in xrange(depth, len(sbytes)):
+                    if ord(bytes[offset+i]) & smasks[i] != sbytes[i]:
+                        return None
+                return sobj
+
+            if not choices:
+                return None
+
+            b = ord(bytes[offset+depth])
+            if bytemap != None:
+                node = bytemap.get(b)
+                if node == None:
+                    return None
+                continue
+
+            for cbyte, cmask, child in choices:
+                if b & cmask == cbyte:
+                    node = child
+                    break
+            else:
+                return None
+
+    def scanBuffer(self, bytes, base=0):
+        """
+        See SignatureTree.scanBuffer().
+        """
+        if self.scanner == None:
+            self.scanner = SignatureScanner(self)
+        return self.scanner.scanBuffer(bytes, base)
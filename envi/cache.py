@@ -0,0 +1,130 @@
+"""
+Caching helpers used to avoid re-doing expensive envi work
+(like decoding the same instructions over and over).
+"""
+
+class DecodeCache:
+    """
+    A size bounded LRU cache of decoded opcodes keyed by virtual address.
+
+    Each entry also remembers the bytes the opcode was decoded from, and a
+    lookup only hits if the bytes passed in still match them.  This way a
+    stale entry (self modifying code, a new memory object, etc) can never be
+    returned, while invalidate() lets memory objects drop entries early
+    when they know a write happened.
+    """
+    def __init__(self, maxsize=4096, maxinst=32):
+        self.maxsize = maxsize
+        self.maxinst = maxinst
+        self.hits = 0
+        self.misses = 0
+        self.clear()
+
+    def clear(self):
+        """
+        Throw away all the cached opcodes (counters are kept).
+        """
+        # The LRU list is circular and doubly linked through lists
+        # of [prev, next, va, opbytes, op] with self._dc_root as sentinel
+        root = []
+        root[:] = [root, root, None, None, None]
+        self._dc_root = root
+        self._dc_entries = {}
+
+    def __len__(self):
+        return len(self._dc_entries)
+
+    # Copies (and pickles) of a cache start out empty.  Copying the
+    # entries is slow and deepcopy recurses down the whole LRU list.
+    def __getstate__(self):
+        return (self.maxsize, self.maxinst, self.hits, self.misses)
+
+    def __setstate__(self, state):
+        self.maxsize, self.maxinst, self.hits, self.misses = state
+        self.clear()
+
+    def __deepcopy__(self, memo):
+        new = DecodeCache(self.maxsize, self.maxinst)
+        new.hits = self.hits
+        new.misses = self.misses
+        return new
+
+    def getOpcode(self, bytes, offset, va):
+        """
+        Return the cached opcode for va if the given bytes (starting
+        at offset) still match what it was decoded from (or None).
+        """
+        entry = self._dc_entries.get(va)
+        if entry == None:
+            self.misses += 1
+            return None
+
+        prev, next, eva, opbytes, op = entry
+        if bytes[offset:offset+len(opbytes)] != opbytes:
+            self._dcUnlink(entry)
+            self.misses += 1
+            return None
+
+        # Move it to the front (most recently used)
+        prev[1] = next
+        next[0] = prev
+        root = self._dc_root
+        first = root[1]
+        entry[0] = root
+        entry[1] = first
+        first[0] = entry
+        root[1] = entry
+
+        self.hits += 1
+        return op
+
+    def addOpcode(self, bytes, offset, op):
+        """
+        Add a freshly decoded opcode (decoded from bytes at offset)
+        to the cache.
+        """
+        va = op.va
+        entry = self._dc_entries.get(va)
+        if entry != None:
+            self._dcUnlink(entry)
+
+        if len(self._dc_entries) >= self.maxsize:
+            self._dcUnlink(self._dc_root[0])
+
+        root = self._dc_root
+        first = root[1]
+        entry = [root, first, va, bytes[offset:offset+op.size], op]
+        first[0] = entry
+        root[1] = entry
+        self._dc_entries[va] = entry
+
+    def invalidate(self, va, size):
+        """
+        Drop any cached opcodes which may overlap the given memory
+        range.  (Suitable for use as an IMemory write hook)
+        """
+        entries = self._dc_entries
+        if not entries:
+            return
+
+        # An instruction starting up to maxinst bytes before va
+        # may still cover the written bytes...
+        start = va - self.maxinst
+        end = va + size
+        if end - start < len(entries):
+            for eva in xrange(start, end):
+                entry = entries.get(eva)
+                if entry != None:
+                    self._dcUnlink(entry)
+            return
+
+        for eva in entries.keys():
+            if eva >= start and eva < end:
+                self._dcUnlink(entries[eva])
+
+    def _dcUnlink(self, entry):
+        prev, next = entry[0], entry[1]
+        prev[1] = next
+        next[0] = prev
+        self._dc_entries.pop(entry[2], None)
+
@@ -7,6 +7,7 @@ import traceback
 import threading
 
 import envi.memory as e_mem
+import envi.search as e_search
 import envi.memcanvas as e_canvas
 import envi.config as e_config
 import envi.expression as e_expr
@@ -307,6 +308,10 @@ class EnviCli(Cmd):
         Usage: search [options] <pattern>
         -X The specified pattern is in hex (ie.  414141424242 is AAABBB)
         -E The specified patter is an expression (search for numeric values)
+        -M <hexmask> Compare memory bytes & mask to the (hex) pattern bytes
+        -P The specified pattern is a regular expression
+        -F <filename> Also search for each line in the file (in hex with -X)
+        -T <threads> Search with this many threads (default 1)
         -R <baseexpr:sizeexpr> Search a specific range only.
         """
         if len(line) == 0:
@@ -315,27 +320,62 @@ class EnviCli(Cmd):
         range = None
         dohex = False
         doexpr = False
+        doregex = False
+        mask = None
+        fname = None
+        threads = 1
 
         argv = splitargs(line)
         try:
-            opts,args = getopt(argv, "ER:X")
+            opts,args = getopt(argv, "EF:M:PR:T:X")
         except:
             return self.do_help("search")
 
         for opt,optarg in opts:
             if opt == "-E":
                 doexpr = True
+            elif opt == "-F":
+                fname = optarg
+            elif opt == "-M":
+                mask = optarg.decode('hex')
+                dohex = True
+            elif opt == "-P":
+                doregex = True
             elif opt == "-R":
                 range = optarg
+            elif opt == "-T":
+                threads = int(optarg, 0)
             elif opt == "-X":
                 dohex = True
 
+        msearch = e_search.MemorySearch()
+
         pattern = " ".join(args)
         if doexpr:
             import struct #FIXME see below
             sval = self.parseExpression(pattern)
             pattern = struct.pack("<L", sval) # FIXME 64bit (and alt arch)
         if dohex: pattern = pattern.decode('hex')
+
+        if doregex:
+            msearch.addRegex(pattern)
+        elif mask != None:
+            if len(mask) != len(pattern):
+                self.vprint("The mask must be the same length as the pattern")
+                return
+            msearch.addMaskedNeedle(pattern, mask, name=pattern.encode('hex'))
+        elif pattern:
+            msearch.addNeedle(pattern, name=pattern.encode('hex'))
+
+        if fname:
+            for fline in file(fname, "rb").read().splitlines():
+                if not fline:
+                    continue
+                fbytes = fline
+                if dohex:
+                    fbytes = fline.decode('hex')
+                msearch.addNeedle(fbytes, name=fbytes.encode('hex'))
+
         if range:
             try:
                 addrexpr, sizeexpr = range.split(":")
@@ -346,17 +386,20 @@ class EnviCli(Cmd):
             self.canvas.addText("Searching from ")
             self.canvas.addVaText("0x%.8x", addr)
             self.canvas.addText(" for %d bytes\n" % size)
-            res = self.memobj.searchMemoryRange(pattern, addr, size)
+            res = msearch.searchRange(self.memobj, addr, size)
         else:
             self.vprint("Searching all memory...")
-            res = self.memobj.searchMemory(pattern)
+            res = msearch.searchMemory(self.memobj, workers=threads)
+
+        # Traces keep the results of the last search in their metadata
+        if hasattr(self.memobj, "setMeta"):
+            self.memobj.setMeta("search", [r for r,name in res])
 
         if len(res) == 0:
-            self.vprint('Pattern Not Found: %s' % pattern.encode('hex'))
+            self.vprint('Pattern Not Found')
             return
 
-        self.vprint('Matches for: %s' % pattern.encode('hex'))
-        for r in res:
+        for r,name in res:
             self.canvas.addVaText("0x%.8x" % r, r)
             self.canvas.addText(": ")
 
@@ -368,7 +411,7 @@ class EnviCli(Cmd):
             sname = self.reprPointer(r)
 
             self.canvas.addText(sname)
-            self.canvas.addText("\n")
+            self.canvas.addText(" (%s)\n" % name)
 
     def reprPointer(self, va):
         """
@@ -1,4 +1,6 @@
+import copy
 import struct
+import bisect
 import envi
 
 """
@@ -35,6 +37,23 @@ def parsePerms(pstr):
     if pstr.find('x') != -1: ret |= MM_EXEC
     return ret
 
+_struct_cache = {}
+
+def _getStruct(psize, fmt):
+    # Somehow, pointers are "signed" when they
+    # get chopped up by python's struct package
+    sfmt = fmt
+    if psize == 4:
+        sfmt = fmt.replace("P","L")
+    elif psize == 8:
+        sfmt = fmt.replace("P","Q")
+
+    s = struct.Struct(sfmt)
+    if len(_struct_cache) > 1024:
+        _struct_cache.clear()
+    _struct_cache[(psize, fmt)] = s
+    return s
+
 class IMemory:
     """
     This is the interface spec (and a few helper utils)
@@ -47,6 +66,29 @@ class IMemory:
 
     def __init__(self):
         self.imem_psize = struct.calcsize("P")
+        self.imem_whooks = []
+
+    def addWriteHook(self, callback):
+        """
+        Register a callback(va, size) which is called whenever memory
+        is modified by writeMemory() (used to invalidate caches).
+        """
+        self.imem_whooks.append(callback)
+
+    def delWriteHook(self, callback):
+        """
+        Remove a callback added with addWriteHook().
+        """
+        if callback in self.imem_whooks:
+            self.imem_whooks.remove(callback)
+
+    def fireWriteHooks(self, va, size):
+        """
+        Used by memory object implementations to notify the
+        registered write hooks of a modified memory range.
+        """
+        for callback in self.imem_whooks:
+            callback(va, size)
 
     def readMemory(self, va, size):
         """
@@ -105,16 +147,11 @@ class IMemory:
 
     # Mostly helpers from here down...
     def readMemoryFormat(self, va, fmt):
-        # Somehow, pointers are "signed" when they
-        # get chopped up by python's struct package
-        if self.imem_psize == 4:
-            fmt = fmt.replace("P","L")
-        elif self.imem_psize == 8:
-            fmt = fmt.replace("P","Q")
-
-        size = struct.calcsize(fmt)
-        bytes = self.readMemory(va, size)
-        return struct.unpack(fmt, bytes)
+        # Compiled Struct objects are cached by (pointer size, format)
+        s = _struct_cache.get((self.imem_psize, fmt))
+        if s == None:
+            s = _getStruct(self.imem_psize, fmt)
+        return s.unpack(self.readMemory(va, s.size))
 
     def getSegmentInfo(self, id):
         return (0,0xffffffff)
@@ -176,58 +213,164 @@ class IMemory:
         Search the specified memory range (address -> size)
         for the string needle.   Return a list of addresses
         where the match occurs.
+
+        NOTE: The range is read a chunk at a time (see envi.search
+              for searching many patterns at once).
         """
+        import envi.search as e_search
+        msearch = e_search.MemorySearch()
+        msearch.addNeedle(needle)
+
         results = []
-        memory = self.readMemory(address, size)
-        offset = 0
-        while offset < size:
-            loc = memory.find(needle, offset)
-            if loc == -1: # No more to be found ;)
-                break
-            results.append(address+loc)
-            offset = loc+len(needle) # Skip one past our matcher
+        for va, name in msearch.searchRange(self, address, size):
+            # Skip one past our matcher
+            if results and va < results[-1] + len(needle):
+                continue
+            results.append(va)
 
         return results
 
+class MemoryMapIndex:
+    """
+    A sorted (by start address) index of non-overlapping memory maps
+    which finds the map containing an address with a bisect rather than
+    a linear walk.  The maps may be any sequence whose first two elements
+    are the va and size of the map (like the (va, size, perms, fname)
+    tuples from getMemoryMaps()).
+    """
+    def __init__(self, maps=()):
+        self._mi_starts = []
+        self._mi_maps = []
+        # Adding them in order makes every insert an append
+        for map in sorted(maps):
+            self.addMap(map)
+
+    def __len__(self):
+        return len(self._mi_maps)
+
+    def __iter__(self):
+        return iter(self._mi_maps)
+
+    def addMap(self, map):
+        """
+        Add a map to the index (raises MapOverlapException if it
+        overlaps a map already in the index).
+        """
+        va, size = map[0], map[1]
+        idx = bisect.bisect_right(self._mi_starts, va)
+        if idx > 0:
+            prev = self._mi_maps[idx-1]
+            if prev[0] + prev[1] > va:
+                raise envi.MapOverlapException(map, prev)
+        if idx < len(self._mi_maps):
+            next = self._mi_maps[idx]
+            if va + size > next[0]:
+                raise envi.MapOverlapException(map, next)
+        self._mi_starts.insert(idx, va)
+        self._mi_maps.insert(idx, map)
+
+    def delMap(self, map):
+        """
+        Remove a map (previously added with addMap) from the index.
+        """
+        idx = self.getMapIndex(map[0])
+        if idx == -1:
+            raise Exception("Map at 0x%.8x not in index" % map[0])
+        del self._mi_starts[idx]
+        del self._mi_maps[idx]
+
+    def getMapIndex(self, va):
+        """
+        Return the index (in sorted order) of the map containing va
+        or -1 if it isn't mapped.
+        """
+        idx = bisect.bisect_right(self._mi_starts, va) - 1
+        if idx < 0:
+            return -1
+        map = self._mi_maps[idx]
+        if va >= map[0] + map[1]:
+            return -1
+        return idx
+
+    def getMap(self, va):
+        """
+        Return the map containing va (or None).
+        """
+        idx = bisect.bisect_right(self._mi_starts, va) - 1
+        if idx < 0:
+            return None
+        map = self._mi_maps[idx]
+        if va >= map[0] + map[1]:
+            return None
+        return map
+
+    def getMapRange(self, va, size):
+        """
+        Return the list of maps which cover the range va -> va+size
+        *contiguously* starting with the map containing va.  The list
+        stops short at the first unmapped gap (and is empty if va
+        itself is not mapped).
+        """
+        idx = self.getMapIndex(va)
+        if idx == -1:
+            return []
+
+        ret = []
+        maps = self._mi_maps
+        end = va + size
+        while idx < len(maps):
+            map = maps[idx]
+            if map[0] > va:
+                break
+            ret.append(map)
+            va = map[0] + map[1]
+            if va >= end:
+                break
+            idx += 1
+        return ret
+
 class MemoryObject(IMemory):
     def __init__(self, maps=None, pagesize=4096):
         """
         Take a set of memory maps (va, perms, bytes) and put them in
-        a sparse space finder. You may specify your own page-size to optimize
-        the search for an architecture.
+        a sorted map index.  (The pagesize is accepted for API
+        compatibility but no longer used)
         """
         IMemory.__init__(self)
         self._mem_pagesize = pagesize
-        self._mem_mask = (0-pagesize) & 0xffffffff
         self._mem_maps = []
-        self._mem_maplookup = {}
-        self._mem_bytelookup = {}
+        # The index holds [va, size, perms, fname, bytes] lists
+        self._mem_index = MemoryMapIndex()
         if maps != None:
             for va,perms,fname,bytes in maps:
                 self.addMemoryMap(va, perms, fname, bytes)
 
+    def __deepcopy__(self, memo):
+        # Write hooks belong to whoever registered them (like an emulator's
+        # decode cache) so the copy starts out without any.
+        new = copy.copy(self)
+        memo[id(self)] = new
+        for name, val in self.__dict__.items():
+            if name != "imem_whooks":
+                setattr(new, name, copy.deepcopy(val, memo))
+        new.imem_whooks = []
+        return new
+
     #FIXME MemoryObject: def allocateMemory(self, size, perms=MM_RWX, suggestaddr=0):
 
     def addMemoryMap(self, va, perms, fname, bytes):
-        x = [va, perms, fname, bytes] # Asign to a list cause we need to write to it
-        maptup = (va, len(bytes), perms, fname)
-        bytelist = [va, perms, bytes]
-        base = va & self._mem_mask
-        maxva = va + len(bytes)
-        while base < maxva:
-            t = self._mem_maplookup.get(base)
-            if t != None:
-                raise envi.MapOverlapException(maptup, t)
-            self._mem_maplookup[base] = maptup
-            self._mem_bytelookup[base] = bytelist
-            base += self._mem_pagesize
+        # Asign to a list cause we need to write to it
+        self._mem_index.addMap([va, len(bytes), perms, fname, bytes])
         self._mem_maps.append((va, len(bytes), perms, fname))
 
     def getMemoryMap(self, va):
         """
-        Get the va,perms,bytes list for this map
+        Get the va,size,perms,fname tuple for the map containing va
         """
-        return self._mem_maplookup.get(va & self._mem_mask)
+        map = self._mem_index.getMap(va)
+        if map == None:
+            return None
+        return tuple(map[:4])
 
     def getMemoryMaps(self):
         return list(self._mem_maps)
@@ -235,32 +378,336 @@ class MemoryObject(IMemory):
     #FIXME rename this... it's aweful
     #FIXME make extendable maps for things like the stack
     def checkMemory(self, va, perms=0):
-        map = self._mem_maplookup.get(va & self._mem_mask)
+        map = self._mem_index.getMap(va)
         if map == None:
             return False
-        if (perms & map[1]) != perms:
+        if (perms & map[2]) != perms:
             return False
         return True
 
     def readMemory(self, va, size):
-        map = self._mem_bytelookup.get(va & self._mem_mask)
+        """
+        Read size bytes from va.  Reads may span adjacent maps, and a
+        read which runs into unmapped memory returns the (short) bytes
+        up to the gap.
+        """
+        map = self._mem_index.getMap(va)
         if map == None:
             raise envi.SegmentationViolation(va)
-        mapva, mperm, mapbytes = map
+        mapva, mapsize, mperm, mname, mapbytes = map
         if not mperm & MM_READ:
             raise envi.SegmentationViolation(va)
         offset = va - mapva
-        return mapbytes[offset:offset+size]
+        # The common case of a read inside one map
+        if offset + size <= mapsize:
+            return mapbytes[offset:offset+size]
+
+        ret = []
+        for mapva, mapsize, mperm, mname, mapbytes in self._mem_index.getMapRange(va, size):
+            if not mperm & MM_READ:
+                raise envi.SegmentationViolation(mapva)
+            offset = va - mapva
+            chunk = mapbytes[offset:offset+size]
+            ret.append(chunk)
+            va += len(chunk)
+            size -= len(chunk)
+        return "".join(ret)
 
     def writeMemory(self, va, bytes):
-        map = self._mem_bytelookup.get(va & self._mem_mask)
-        if map == None:
-            raise envi.SegmentationViolation(va)
-        mva, mperm, mbytes = map
-        if not mperm & MM_WRITE:
+        """
+        Write bytes to va.  Writes may span adjacent maps, but they
+        must be entirely within writable mapped memory (maps do not grow).
+        """
+        size = len(bytes)
+        maps = self._mem_index.getMapRange(va, size)
+        if not maps:
             raise envi.SegmentationViolation(va)
-        offset = va - mva
-        map[2] = mbytes[:offset] + bytes + mbytes[offset+len(bytes):]
+        for map in maps:
+            if not map[2] & MM_WRITE:
+                raise envi.SegmentationViolation(max(va, map[0]))
+        last = maps[-1]
+        if last[0] + last[1] < va + size:
+            raise envi.SegmentationViolation(last[0] + last[1])
+
+        wva = va
+        boff = 0
+        for map in maps:
+            mva, msize, mperm, mname, mbytes = map
+            offset = wva - mva
+            chunk = min(size - boff, msize - offset)
+            map[4] = mbytes[:offset] + bytes[boff:boff+chunk] + mbytes[offset+chunk:]
+            wva += chunk
+            boff += chunk
+
+        if self.imem_whooks:
+            self.fireWriteHooks(va, size)
+
+class PageMemoryObject(IMemory):
+    """
+    A memory object which stores memory in per-page bytearrays so that
+    writes only touch the bytes written (rather than re-building the whole
+    map string like MemoryObject).  Pages are shared copy-on-write between
+    an object and its clone() (copy.deepcopy() also clones), which makes
+    copies of big address spaces cheap.
+
+    NOTE: Like MemoryObject, a page may only be part of one memory map.
+    """
+    def __init__(self, maps=None, pagesize=4096):
+        IMemory.__init__(self)
+        self._pm_pagesize = pagesize
+        self._pm_pagemask = ~(pagesize - 1)
+        self._pm_maps = []
+        self._pm_pagemaps = {} # pageva -> map tuple
+        self._pm_pages = {}    # pageva -> bytearray
+        self._pm_owned = {}    # pageva -> True if not shared with a clone
+        self._pm_journals = [] # MemorySnap objects (see getMemorySnap)
+        if maps != None:
+            for va,perms,fname,bytes in maps:
+                self.addMemoryMap(va, perms, fname, bytes)
+
+    def clone(self):
+        """
+        Return a new PageMemoryObject with the same memory contents.  The
+        pages are shared until either of the objects writes to them.
+        """
+        new = copy.copy(self)
+        new.imem_whooks = []
+        new._pm_journals = []
+        new._pm_maps = list(self._pm_maps)
+        new._pm_pagemaps = dict(self._pm_pagemaps)
+        new._pm_pages = dict(self._pm_pages)
+        # Neither of us owns the pages any more...
+        new._pm_owned = {}
+        self._pm_owned = {}
+        return new
+
+    def __deepcopy__(self, memo):
+        return self.clone()
+
+    def addMemoryMap(self, va, perms, fname, bytes):
+        size = len(bytes)
+        maptup = (va, size, perms, fname)
+        psize = self._pm_pagesize
+        base = va & self._pm_pagemask
+        maxva = va + size
+
+        pageva = base
+        while pageva < maxva:
+            t = self._pm_pagemaps.get(pageva)
+            if t != None:
+                raise envi.MapOverlapException(maptup, t)
+            pageva += psize
+
+        if self._pm_journals:
+            snap = self._pm_journals[-1]
+            if snap.maps == None:
+                snap.maps = (list(self._pm_maps), dict(self._pm_pagemaps))
+
+        pageva = base
+        while pageva < maxva:
+            if self._pm_journals:
+                snap.pages.setdefault(pageva, None)
+
+            page = bytearray(psize)
+            # Where in the page (and in bytes) do we start
+            pstart = max(va, pageva)
+            pend = min(maxva, pageva + psize)
+            page[pstart-pageva:pend-pageva] = bytes[pstart-va:pend-va]
+            self._pm_pagemaps[pageva] = maptup
+            self._pm_pages[pageva] = page
+            self._pm_owned[pageva] = True
+            pageva += psize
+
+        self._pm_maps.append(maptup)
+
+    def getMemoryMap(self, va):
+        map = self._pm_pagemaps.get(va & self._pm_pagemask)
+        if map == None:
+            return None
+        if va < map[0] or va >= map[0] + map[1]:
+            return None
+        return map
+
+    def getMemoryMaps(self):
+        return list(self._pm_maps)
+
+    def readMemory(self, va, size):
+        pageva = va & self._pm_pagemask
+        offset = va - pageva
+        map = self._pm_pagemaps.get(pageva)
+
+        # The (very) common case of a read inside one page
+        if (map != None and offset + size <= self._pm_pagesize and
+            va >= map[0] and va + size <= map[0] + map[1] and map[2] & MM_READ):
+            return str(self._pm_pages[pageva][offset:offset+size])
+
+        ret = []
+        while size > 0:
+            pageva = va & self._pm_pagemask
+            map = self._pm_pagemaps.get(pageva)
+            if map == None or va < map[0] or va >= map[0] + map[1]:
+                # Reads which run off the end of mapped memory are short
+                if not ret:
+                    raise envi.SegmentationViolation(va)
+                break
+            if not map[2] & MM_READ:
+                raise envi.SegmentationViolation(va)
+
+            offset = va - pageva
+            chunk = min(size, self._pm_pagesize - offset, map[0] + map[1] - va)
+            ret.append(str(self._pm_pages[pageva][offset:offset+chunk]))
+            va += chunk
+            size -= chunk
+
+        return "".join(ret)
+
+    def writeMemory(self, va, bytes):
+        wva = va
+        wsize = len(bytes)
+        pageva = va & self._pm_pagemask
+        offset = va - pageva
+        map = self._pm_pagemaps.get(pageva)
+
+        # The (very) common case of a write inside one page
+        if (map != None and offset + wsize <= self._pm_pagesize and
+            va >= map[0] and va + wsize <= map[0] + map[1] and map[2] & MM_WRITE):
+            page = self._pm_pages[pageva]
+            if not self._pm_owned.get(pageva):
+                page = self._pmOwnPage(pageva)
+            page[offset:offset+wsize] = bytes
+            if self.imem_whooks:
+                self.fireWriteHooks(wva, wsize)
+            return
+
+        # Check every page before writing any of them so that a write
+        # which faults part way through changes nothing.
+        chunks = []
+        boff = 0
+        while boff < wsize:
+            pageva = va & self._pm_pagemask
+            map = self._pm_pagemaps.get(pageva)
+            if map == None or va < map[0] or va >= map[0] + map[1]:
+                raise envi.SegmentationViolation(va)
+            if not map[2] & MM_WRITE:
+                raise envi.SegmentationViolation(va)
+
+            offset = va - pageva
+            chunk = min(wsize - boff, self._pm_pagesize - offset, map[0] + map[1] - va)
+            chunks.append((pageva, offset, boff, chunk))
+            va += chunk
+            boff += chunk
+
+        for pageva, offset, boff, chunk in chunks:
+            page = self._pm_pages[pageva]
+            if not self._pm_owned.get(pageva):
+                page = self._pmOwnPage(pageva)
+            page[offset:offset+chunk] = bytes[boff:boff+chunk]
+
+        if self.imem_whooks:
+            self.fireWriteHooks(wva, wsize)
+
+    def _pmOwnPage(self, pageva):
+        # Make our own copy of a (possibly) shared page before writing it
+        oldpage = self._pm_pages[pageva]
+        if self._pm_journals:
+            self._pm_journals[-1].pages.setdefault(pageva, oldpage)
+
+        page = bytearray(oldpage)
+        self._pm_pages[pageva] = page
+        self._pm_owned[pageva] = True
+        return page
+
+    def getMemorySnap(self):
+        """
+        Take a snapshot of the current memory contents and return an
+        object which may be handed to setMemorySnap() to return to it.
+
+        Taking a snapshot is O(1).  From then on, the first write to each
+        page saves the original page in a journal, so that restoring is
+        O(pages written).
+        """
+        snap = MemorySnap(self)
+        self._pm_journals.append(snap)
+        # Make sure the next write to any page goes through _pmOwnPage
+        self._pm_owned = {}
+        return snap
+
+    def setMemorySnap(self, snap):
+        """
+        Restore the memory contents to those at the time snap was taken
+        by getMemorySnap().  The snap may be restored again later, but any
+        snapshots taken after it are no longer valid.
+
+        NOTE: A snap is kept (along with the pages it saved) until it or
+              an earlier snap is restored, or it is given to
+              dropMemorySnap().
+        """
+        idx = self._pmJournalIndex(snap)
+        if idx == None:
+            raise Exception("Invalid (or already discarded) memory snapshot")
+
+        dirty = {}
+        for j in self._pm_journals[:idx:-1] + [snap,]:
+            for pageva, page in j.pages.items():
+                dirty[pageva] = True
+                if page == None:
+                    self._pm_pages.pop(pageva, None)
+                else:
+                    self._pm_pages[pageva] = page
+
+            if j.maps != None:
+                maps, pagemaps = j.maps
+                self._pm_maps = list(maps)
+                self._pm_pagemaps = dict(pagemaps)
+
+        del self._pm_journals[idx+1:]
+        snap.pages = {}
+        snap.maps = None
+        self._pm_owned = {}
+
+        if self.imem_whooks:
+            for pageva in dirty.keys():
+                self.fireWriteHooks(pageva, self._pm_pagesize)
+
+    def dropMemorySnap(self, snap):
+        """
+        Release a snap from getMemorySnap() which will not be restored
+        again.  Pages it saved are handed to the snap before it (if any)
+        so the snapshots taken earlier may still be restored.
+        """
+        idx = self._pmJournalIndex(snap)
+        if idx == None:
+            return
+
+        if idx > 0:
+            prev = self._pm_journals[idx-1]
+            # The older journal's copy of a page wins
+            for pageva, page in snap.pages.iteritems():
+                prev.pages.setdefault(pageva, page)
+            if prev.maps == None:
+                prev.maps = snap.maps
+
+        del self._pm_journals[idx]
+        snap.pages = {}
+        snap.maps = None
+
+    def _pmJournalIndex(self, snap):
+        # Snaps are most often restored/dropped newest first...
+        for i in xrange(len(self._pm_journals)-1, -1, -1):
+            if self._pm_journals[i] is snap:
+                return i
+        return None
+
+class MemorySnap:
+    """
+    The journal for a PageMemoryObject snapshot (see getMemorySnap).
+    """
+    def __init__(self, memobj):
+        self.memobj = memobj
+        # pageva -> the page at snapshot time (None if it didn't exist)
+        self.pages = {}
+        # (maps, pagemaps) at snapshot time if maps were added since
+        self.maps = None
 
 class MemoryTracker:
     """
@@ -4,6 +4,7 @@ symbol resolver.
 """
 
 import types
+import bisect
 
 class Symbol:
 
@@ -51,25 +52,20 @@ class SymbolResolver:
         self.width = width
         self.widthmask = (2**(width*8))-1
         self.casesens = casesens
-        # Lets use 4096 byte buckes for now
-        self.bucketsize = 4096
-        self.bucketmask = self.widthmask ^ (self.bucketsize-1)
-        self.buckets = {}
         self.symnames = {}
         self.symaddrs = {}
+        # A sorted list of the symbol addresses (for nearest lookups)
+        self.symvas = []
 
     def delSymbol(self, sym):
         """
         Delete a symbol from the resolver's namespace
         """
         symval = long(sym)
-        self.symaddrs.pop(symval, None)
-
-        bbase = symval & self.bucketmask
-        while bbase < symval:
-            bucket = self.buckets.get(bbase)
-            bucket.remove(sym)
-            bbase += self.bucketsize
+        if self.symaddrs.pop(symval, None) != None:
+            i = bisect.bisect_left(self.symvas, symval)
+            if i < len(self.symvas) and self.symvas[i] == symval:
+                self.symvas.pop(i)
 
         subres = None
         if sym.fname != None:
@@ -94,17 +90,10 @@ class SymbolResolver:
         # for the FileSymbol inside us rather than our namespace.
 
         symval = long(sym)
+        if not self.symaddrs.has_key(symval):
+            bisect.insort(self.symvas, symval)
         self.symaddrs[symval] = sym
 
-        bbase = symval & self.bucketmask
-        while bbase < symval:
-            bucket = self.buckets.get(bbase)
-            if bucket == None:
-                bucket = []
-                self.buckets[bbase] = bucket
-            bucket.append(sym)
-            bbase += self.bucketsize
-
         subres = None
         if sym.fname != None:
             subres = self.symnames.get(sym.fname)
@@ -120,6 +109,39 @@ class SymbolResolver:
                 symname = symname.lower()
             self.symnames[symname] = sym
 
+    def addSymbols(self, syms):
+        """
+        Add a list of symbols to the resolver (much faster than
+        calling addSymbol() for each of a large symbol table).
+        """
+        newvas = []
+        subsyms = {}
+        for sym in syms:
+            symval = long(sym)
+            if not self.symaddrs.has_key(symval):
+                newvas.append(symval)
+            self.symaddrs[symval] = sym
+
+            subres = None
+            if sym.fname != None:
+                subres = self.symnames.get(sym.fname)
+
+            if subres != None:
+                subsyms.setdefault(sym.fname, []).append(sym)
+
+            else:
+                symname = sym.name
+                if not self.casesens:
+                    symname = symname.lower()
+                self.symnames[symname] = sym
+
+        if newvas:
+            self.symvas.extend(newvas)
+            self.symvas.sort()
+
+        for fname, slist in subsyms.items():
+            self.symnames.get(fname).addSymbols(slist)
+
     def getSymByName(self, name):
         if not self.casesens:
             name = name.lower()
@@ -127,7 +149,9 @@ class SymbolResolver:
 
     def getSymByAddr(self, va, exact=True):
         """
-        Return a symbol tuple for the given virtual address.
+        Return a symbol tuple for the given virtual address.  With
+        exact=False, return the symbol with the nearest address at
+        or below va.
         """
         va = va & self.widthmask
         sym = self.symaddrs.get(va)
@@ -136,24 +160,9 @@ class SymbolResolver:
             return sym
 
         if not exact:
-            b = va & self.bucketmask
-            best = 999999999
-            while sym == None:
-                bucket = self.buckets.get(b)
-                if bucket != None:
-                    for s in bucket:
-                        sva = long(s)
-                        if sva > va:
-                            continue
-                        offset = va - sva
-                        if offset < best:
-                            best = offset
-                            sym = s
-                # If we get more than 8k away, just get out...
-                if va - b > 8192:
-                    break
-                # Move back to the previous bucket.
-                b -= self.bucketsize
+            i = bisect.bisect_right(self.symvas, va)
+            if i > 0:
+                sym = self.symaddrs[self.symvas[i-1]]
 
         # If we resolve a sub-resolver, see if he
         # has finer resolution than we do...
@@ -0,0 +1,350 @@
+"""
+A streaming, multi-pattern memory search engine for envi memory objects.
+
+A MemorySearch holds any number of patterns:
+
+  * literal needles (all of them found in one pass over the memory)
+  * masked needles (bytes + masks with the envi.bytesig.SignatureTree
+    semantics: a byte matches if (membyte & mask) == sigbyte)
+  * regular expressions
+
+and searches memory objects (traces, emulators, snapshots...) in fixed
+size chunks (with enough overlap to catch matches which straddle chunk
+boundaries) so that no map is ever read into memory whole.
+
+Example:
+    s = MemorySearch()
+    s.addNeedle("evil.com")
+    s.addMaskedNeedle("\\xe8\\x00\\x00\\x00\\x00", "\\xff\\x00\\x00\\x00\\x00", name="call")
+    s.addRegex("[a-z0-9]{8}\\.onion", maxlen=14)
+    for va, name in s.searchMemory(trace, workers=4):
+        print "0x%.8x: %s" % (va, name)
+"""
+import re
+import threading
+
+import envi.memory as e_mem
+
+def maskedRegex(bytes, masks):
+    """
+    Return a regular expression which matches bytes with the given
+    masks (each memory byte matches if (byte & mask) == sigbyte).
+    """
+    parts = []
+    for i in xrange(len(bytes)):
+        val = ord(bytes[i])
+        mask = ord(masks[i])
+        if mask == 0xff:
+            parts.append("\\x%.2x" % val)
+            continue
+
+        chars = ["\\x%.2x" % c for c in xrange(256) if c & mask == val]
+        if not chars:
+            return "(?!)" # The sig byte has bits outside the mask...
+        parts.append("[%s]" % "".join(chars))
+
+    return "".join(parts)
+
+def trieRegex(node):
+    """
+    Return a regular expression which matches any of the needles
+    in a trie of nested {char:node} dicts (None keys mark the end of
+    a needle).  The shared prefixes let the regex engine walk the
+    trie rather than trying each needle at each offset.
+    """
+    parts = []
+    # Walk chains of single choices without recursion (long needles)
+    while True:
+        keys = [k for k in node.keys() if k != None]
+        if len(keys) != 1 or node.has_key(None):
+            break
+        parts.append(re.escape(keys[0]))
+        node = node[keys[0]]
+
+    if keys:
+        keys.sort()
+        alts = [re.escape(k) + trieRegex(node[k]) for k in keys]
+        if len(alts) == 1 and not node.has_key(None):
+            parts.append(alts[0])
+        else:
+            alt = "(?:%s)" % "|".join(alts)
+            if node.has_key(None):
+                alt += "?"
+            parts.append(alt)
+
+    return "".join(parts)
+
+class MemorySearch:
+    """
+    A set of patterns to search memory for (see the module docs).
+
+    The chunksize is how many bytes are read from the memory object
+    (and scanned) at once.
+    """
+    def __init__(self, chunksize=0x100000):
+        self.chunksize = chunksize
+
+        self._ms_trie = {}      # literal needles (nested dicts)
+        self._ms_masked = []    # (bytes, masks, name)
+        self._ms_regexes = []   # (compiled regex, name)
+        self._ms_maxlen = 0     # longest pattern (chunk overlap)
+        self._ms_groups = None  # compiled regexes for literals + masked
+
+    def addNeedle(self, bytes, name=None):
+        """
+        Add a literal byte sequence to search for.  The name (default:
+        the bytes) is returned with the addresses it matches.
+        """
+        if not bytes:
+            raise Exception("Empty search needle")
+        if name == None:
+            name = bytes
+
+        node = self._ms_trie
+        for c in bytes:
+            node = node.setdefault(c, {})
+        node.setdefault(None, []).append(name)
+
+        self._ms_maxlen = max(self._ms_maxlen, len(bytes))
+        self._ms_groups = None
+
+    def addMaskedNeedle(self, bytes, masks, name=None):
+        """
+        Add a byte sequence which is compared using masks (like
+        envi.bytesig.SignatureTree signatures).
+        """
+        if len(bytes) != len(masks):
+            raise Exception("Masked needle bytes and masks must be the same length")
+        if not bytes:
+            raise Exception("Empty search needle")
+        if name == None:
+            name = bytes
+
+        self._ms_masked.append(([ord(c) for c in bytes], [ord(c) for c in masks], name))
+        self._ms_maxlen = max(self._ms_maxlen, len(bytes))
+        self._ms_groups = None
+
+    def addRegex(self, regex, name=None, maxlen=256, flags=re.DOTALL):
+        """
+        Add a regular expression to search for.  Matches longer than
+        maxlen bytes may be missed if they straddle a chunk boundary.
+        """
+        if name == None:
+            name = regex
+        self._ms_regexes.append((re.compile(regex, flags), name))
+        self._ms_maxlen = max(self._ms_maxlen, maxlen)
+
+    def _msGetGroups(self):
+        # Compile the literal and masked needles into one regex per
+        # distinct first byte.  A regex which starts with a literal lets
+        # the regex engine skip ahead to that byte at C speed, which
+        # (unlike one big alternation) keeps scans fast even for
+        # hundreds of needles.  Masked needles with a wildcard first
+        # byte share one extra regex.
+        if self._ms_groups == None:
+            groups = {}
+            for c, node in self._ms_trie.items():
+                groups.setdefault(c, []).append(trieRegex(node))
+
+            wild = []
+            for sbytes, smasks, name in self._ms_masked:
+                rest = maskedRegex("".join([chr(c) for c in sbytes[1:]]),
+                                   "".join([chr(c) for c in smasks[1:]]))
+                if smasks[0] == 0xff:
+                    groups.setdefault(chr(sbytes[0]), []).append(rest)
+                else:
+                    wild.append(maskedRegex(chr(sbytes[0]), chr(smasks[0])) + rest)
+
+            regexes = []
+            for c, alts in groups.items():
+                regexes.append(re.compile("%s(?:%s)" % (re.escape(c), "|".join(alts)), re.DOTALL))
+            if wild:
+                regexes.append(re.compile("(?:%s)" % "|".join(wild), re.DOTALL))
+            self._ms_groups = regexes
+
+        return self._ms_groups
+
+    def _msMatchesAt(self, bytes, offset):
+        # Return the names of the literal and masked needles at offset
+        ret = []
+        node = self._ms_trie
+        i = offset
+        blen = len(bytes)
+        while node != None:
+            names = node.get(None)
+            if names:
+                ret.extend(names)
+            if i >= blen:
+                break
+            node = node.get(bytes[i])
+            i += 1
+
+        for sbytes, smasks, name in self._ms_masked:
+            slen = len(sbytes)
+            if offset + slen > blen:
+                continue
+            for j in xrange(slen):
+                if ord(bytes[offset+j]) & smasks[j] != sbytes[j]:
+                    break
+            else:
+                ret.append(name)
+
+        return ret
+
+    def searchBytes(self, bytes, base=0, limit=None, rxends=None):
+        """
+        Search a string of bytes (which start at address base) and
+        return a list of (va, name) tuples.  Only matches which start
+        before offset limit (default: the end) are returned.
+
+        The rxends dict (used by searchRange to keep regex matches from
+        overlapping across chunks) maps each regex to the address its
+        last match ended at.  Matches starting before it are skipped,
+        and it is updated with the matches found.
+        """
+        if limit == None:
+            limit = len(bytes)
+
+        # Find every offset where one of the literal/masked needles
+        # may start (searching again from the next byte after each hit
+        # so that overlapping matches are found)...
+        offsets = {}
+        for regex in self._msGetGroups():
+            pos = 0
+            while True:
+                m = regex.search(bytes, pos)
+                if m == None:
+                    break
+                pos = m.start()
+                if pos >= limit:
+                    break
+                offsets[pos] = True
+                pos += 1
+
+        # ... and then which needles match there
+        ret = []
+        for offset in offsets.keys():
+            for name in self._msMatchesAt(bytes, offset):
+                ret.append((base + offset, name))
+
+        for regex, name in self._ms_regexes:
+            pos = 0
+            if rxends != None:
+                pos = max(rxends.get(regex, base) - base, 0)
+            for m in regex.finditer(bytes, pos):
+                offset = m.start()
+                if offset >= limit:
+                    break
+                ret.append((base + offset, name))
+                if rxends != None:
+                    rxends[regex] = base + m.end()
+
+        ret.sort()
+        return ret
+
+    def searchRange(self, memobj, va, size, endva=None, rxends=None):
+        """
+        Search size bytes of memory starting at va (reading it a chunk
+        at a time) and return a list of (va, name) tuples.  Matches must
+        start in the range, but may continue past it up to endva
+        (default: the end of the range).
+
+        Like one finditer() over the whole range, regex matches do not
+        overlap.  To continue that across ranges, pass the same rxends
+        dict (see searchBytes) when searching them in order.
+        """
+        if endva == None:
+            endva = va + size
+        if rxends == None:
+            rxends = {}
+
+        ret = []
+        overlap = max(self._ms_maxlen - 1, 0)
+        maxva = va + size
+        while va < maxva:
+            csize = min(self.chunksize, maxva - va)
+            rsize = min(csize + overlap, endva - va)
+            bytes = memobj.readMemory(va, rsize)
+            if not bytes:
+                break
+            ret.extend(self.searchBytes(bytes, va, limit=min(csize, len(bytes)), rxends=rxends))
+            # A short read means we hit the end of readable memory
+            if len(bytes) < csize:
+                break
+            va += csize
+
+        return ret
+
+    def searchMemory(self, memobj, workers=1, perms=e_mem.MM_READ, segsize=None):
+        """
+        Search all the memory maps (with perms) of a memory object and
+        return a sorted list of (va, name) tuples.
+
+        With workers > 1, maps are split into segments (default: 16
+        chunks) which are searched by a pool of threads.  This mostly
+        lets reading memory (which is often a system call that drops the
+        GIL) overlap with scanning.  (If there are regexes, the segments
+        of a map are searched in order by one thread so that regex matches
+        don't overlap across segments)
+
+        NOTE: Maps which can't be read are skipped.
+        """
+        if segsize == None:
+            segsize = self.chunksize * 16
+
+        # Each todo entry is a list of segments to search in order
+        todo = []
+        for mva, msize, mperm, mname in memobj.getMemoryMaps():
+            if mperm & perms != perms:
+                continue
+            mend = mva + msize
+            segs = [(sva, min(segsize, mend - sva), mend) for sva in xrange(mva, mend, segsize)]
+            if self._ms_regexes:
+                todo.append(segs)
+            else:
+                todo.extend([[seg,] for seg in segs])
+
+        ret = []
+        if workers <= 1:
+            for segs in todo:
+                ret.extend(self._msSearchSegments(memobj, segs))
+            ret.sort()
+            return ret
+
+        lock = threading.Lock()
+        todo.reverse()
+
+        def worker():
+            while True:
+                with lock:
+                    if not todo:
+                        return
+                    segs = todo.pop()
+                res = self._msSearchSegments(memobj, segs)
+                with lock:
+                    ret.extend(res)
+
+        # Build the shared regexes before the threads race to it
+        self._msGetGroups()
+        threads = []
+        for i in xrange(workers):
+            thr = threading.Thread(target=worker)
+            thr.setDaemon(True)
+            thr.start()
+            threads.append(thr)
+
+        for thr in threads:
+            thr.join()
+
+        ret.sort()
+        return ret
+
+    def _msSearchSegments(self, memobj, segs):
+        ret = []
+        rxends = {}
+        for sva, ssize, mend in segs:
+            try:
+                ret.extend(self.searchRange(memobj, sva, ssize, mend, rxends))
+            except Exception, e:
+                pass # Some platforms dont let debuggers read non-readable mem
+        return ret
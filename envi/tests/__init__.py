@@ -0,0 +1,3 @@
+"""
+Unit tests for envi (run with "python -m unittest discover envi/tests").
+"""
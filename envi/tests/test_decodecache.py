@@ -0,0 +1,54 @@
+import unittest
+
+import envi
+import envi.memory as e_mem
+
+from envi.archs.i386.regs import *
+
+class DecodeCacheSnapshotTest(unittest.TestCase):
+
+    def getEmulator(self, memcls):
+        emu = envi.getArchModule("i386").getEmulator()
+        mem = memcls()
+        # Enough straight line code to fill the decode cache
+        mem.addMemoryMap(0x1000, e_mem.MM_RWX, "code", "\x40" * 0x2000)
+        mem.addMemoryMap(0x10000, e_mem.MM_RWX, "data", "\x00" * 0x1000)
+        emu.setMemoryObject(mem)
+        emu.setDecodeCache()
+        emu.setProgramCounter(0x1000)
+        emu.setRegister(REG_EAX, 0)
+        return emu
+
+    def checkSnapRestore(self, memcls):
+        emu = self.getEmulator(memcls)
+        emu.run(3000)
+        self.assertTrue(len(emu.getDecodeCache()) >= 3000)
+
+        for i in xrange(5):
+            snap = emu.emuSnapshot()
+            emu.writeMemory(0x10000, "AAAA")
+            emu.run(10)
+            emu.emuRestore(snap)
+
+            self.assertEqual(emu.getProgramCounter(), 0x1000 + 3000)
+            self.assertEqual(emu.getRegister(REG_EAX), 3000)
+            self.assertEqual(emu.readMemory(0x10000, 4), "\x00" * 4)
+            self.assertEqual(len(emu.getMemoryObject().imem_whooks), 1)
+
+    def test_snapshot_memoryobject(self):
+        self.checkSnapRestore(e_mem.MemoryObject)
+
+    def test_snapshot_pagememoryobject(self):
+        self.checkSnapRestore(e_mem.PageMemoryObject)
+
+    def test_copy_is_empty(self):
+        import copy
+        emu = self.getEmulator(e_mem.MemoryObject)
+        emu.run(100)
+        dcache = emu.getDecodeCache()
+        new = copy.deepcopy(dcache)
+        self.assertEqual(len(new), 0)
+        self.assertEqual(new.maxsize, dcache.maxsize)
+
+if __name__ == "__main__":
+    unittest.main()
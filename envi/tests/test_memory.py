@@ -0,0 +1,54 @@
+import unittest
+
+import envi
+import envi.memory as e_mem
+
+class PageMemorySnapTest(unittest.TestCase):
+
+    def getMemory(self):
+        mem = e_mem.PageMemoryObject()
+        mem.addMemoryMap(0x1000, e_mem.MM_RWX, "data", "\x00" * 0x4000)
+        return mem
+
+    def test_drop_keeps_earlier(self):
+        mem = self.getMemory()
+        snap1 = mem.getMemorySnap()
+        mem.writeMemory(0x1000, "A")
+        snap2 = mem.getMemorySnap()
+        mem.writeMemory(0x1000, "B")
+        mem.writeMemory(0x2000, "B")
+        mem.addMemoryMap(0x8000, e_mem.MM_RWX, "new", "C" * 0x100)
+        snap3 = mem.getMemorySnap()
+        mem.writeMemory(0x3000, "C")
+
+        # Dropping the middle and newest snaps hands their pages down
+        mem.dropMemorySnap(snap2)
+        mem.dropMemorySnap(snap3)
+        self.assertEqual(mem._pm_journals, [snap1])
+
+        mem.setMemorySnap(snap1)
+        for va in (0x1000, 0x2000, 0x3000):
+            self.assertEqual(mem.readMemory(va, 1), "\x00")
+        self.assertEqual(mem.getMemoryMap(0x8000), None)
+
+    def test_emulator_branches(self):
+        emu = envi.getArchModule("i386").getEmulator()
+        mem = self.getMemory()
+        emu.setMemoryObject(mem)
+
+        base = emu.emuSnapshot()
+        self.assertEqual(len(base), 2)
+        for i in xrange(100):
+            snap = emu.emuSnapshot()
+            emu.writeMemory(0x1000 + (i * 0x10), "X")
+            emu.emuRestore(snap)
+            emu.emuDropSnapshot(snap)
+            emu.writeMemory(0x1000 + (i * 0x10), "Y")
+
+        self.assertEqual(mem._pm_journals, [base[1]])
+        self.assertEqual(emu.readMemory(0x1000, 1), "Y")
+        emu.emuRestore(base)
+        self.assertEqual(emu.readMemory(0x1000, 0x1000), "\x00" * 0x1000)
+
+if __name__ == "__main__":
+    unittest.main()
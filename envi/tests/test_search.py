@@ -0,0 +1,35 @@
+import random
+import unittest
+
+import envi.memory as e_mem
+import envi.search as e_search
+
+class MemorySearchChunkTest(unittest.TestCase):
+
+    def getMemory(self):
+        rand = random.Random(0x4141)
+        bytes = "".join([rand.choice("AAAB.xyz") for i in xrange(0x8000)])
+        mem = e_mem.MemoryObject()
+        mem.addMemoryMap(0x10000, e_mem.MM_READ, "data", bytes)
+        return mem, bytes
+
+    def getSearch(self, chunksize):
+        s = e_search.MemorySearch(chunksize=chunksize)
+        s.addNeedle("AAB")
+        s.addRegex("A+B?", name="arun", maxlen=64)
+        s.addRegex("[xyz.]{2,}", name="junk", maxlen=64)
+        return s
+
+    def test_chunksize(self):
+        mem, bytes = self.getMemory()
+        whole = self.getSearch(len(bytes)).searchRange(mem, 0x10000, len(bytes))
+        self.assertTrue(len(whole) > 1000)
+
+        for chunksize in (7, 64, 100, 0x1000):
+            s = self.getSearch(chunksize)
+            self.assertEqual(s.searchRange(mem, 0x10000, len(bytes)), whole)
+            self.assertEqual(s.searchMemory(mem, segsize=chunksize * 3), whole)
+            self.assertEqual(s.searchMemory(mem, workers=4, segsize=chunksize * 3), whole)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -473,22 +473,31 @@ class Vdb(e_cli.EnviMutableCli, v_notif.Notifier, v_util.TraceManager):
     def do_snapshot(self, line):
         """
         Take a process snapshot of the current (stopped) trace and
-        save it to the specified file.
+        save it to the specified file.  With -p, only the pages which
+        changed since the given (earlier) snapshot file are saved.
 
-        Usage: snapshot <filename>
+        Usage: snapshot [-p <parentfile>] <filename>
         """
         if len(line) == 0:
             return self.do_help("snapshot")
-        alist = e_cli.splitargs(line)
-        if len(alist) != 1:
+        argv = e_cli.splitargs(line)
+        try:
+            opts,args = getopt(argv, "p:")
+        except Exception, e:
+            return self.do_help("snapshot")
+
+        parent = None
+        for opt,optarg in opts:
+            if opt == "-p":
+                parent = optarg
+
+        if len(args) != 1:
             return self.do_help("snapshot")
 
         t = self.trace
         t.requireAttached()
-        self.vprint("Taking Snapshot...")
-        snap = t.takeSnapshot()
-        self.vprint("Saving To File")
-        snap.saveToFile(alist[0])
+        self.vprint("Saving Snapshot...")
+        t.saveSnapshot(args[0], parent=parent)
         self.vprint("Done")
 
     def do_ignore(self, args):
@@ -12,6 +12,7 @@ class OpcodeRenderer(e_canvas.MemoryRenderer):
     def __init__(self, trace):
         a = trace.getMeta("Architecture")
         self.arch = envi.getArchModule(a)
+        self.arch.setDecodeCache()
         self.pwidth = self.arch.getPointerSize()
 
     def render(self, mcanv, va):
@@ -109,6 +109,39 @@ from vtrace.breakpoints import *
 from vtrace.watchpoints import *
 import vtrace.util as v_util
 
+# The page size for the MemCache mode read cache and the largest
+# read which is cached (bigger ones go straight to the platform)
+MEMCACHE_PAGESIZE = 4096
+MEMCACHE_MAXREAD = 0x10000
+
+class MapCacheIndex(e_mem.MemoryMapIndex):
+    """
+    The MemoryMapIndex for a list of maps from platformGetMaps()
+    (which remembers the list it was built from).
+
+    Like IMemory.getMemoryMap(), getMap() returns the first map (in
+    the order reported) which contains the address.  Some platforms
+    report nested or overlapping maps, and then the index can't
+    tell which one was reported first, so lookups walk the list.
+    """
+    def __init__(self, maps):
+        e_mem.MemoryMapIndex.__init__(self)
+        self.maps = maps
+        self.overlaps = False
+        for map in maps:
+            try:
+                self.addMap(map)
+            except envi.MapOverlapException, e:
+                self.overlaps = True
+
+    def getMap(self, va):
+        if self.overlaps:
+            for map in self.maps:
+                if va >= map[0] and va < (map[0] + map[1]):
+                    return map
+            return None
+        return e_mem.MemoryMapIndex.getMap(self, va)
+
 class PlatformException(Exception):
     """
     A universal way to represent a failure in the
@@ -154,6 +187,8 @@ class Trace(e_mem.IMemory, e_reg.RegisterContext, e_resolv.SymbolResolver, objec
         self.initMode("FastBreak", False, "Do *NOT* add/remove breakpoints per-run, but leave them there once active")
         self.initMode("SingleStep", False, "All calls to run() actually just step.  This allows RunForever + SingleStep to step forever ;)")
         self.initMode("FastStep", False, "All stepi() will NOT generate a step event")
+        self.initMode("MemCache", True, "Cache memory reads by page while the trace is stopped")
+        self.initMode("SymbolCache", True, "Cache the symbols parsed from binaries in ~/.vtrace/symcache")
 
         self.regcache = None
         self.regcachedirty = False
@@ -234,6 +269,7 @@ class Trace(e_mem.IMemory, e_reg.RegisterContext, e_resolv.SymbolResolver, objec
         # Since we don't go through the normal run/wait
         # code, we have a little house-keeping to do...
         self.curbp = None
+        self.memcache = {}
 
         self._syncRegs()
         self.platformStepi()
@@ -297,6 +333,7 @@ class Trace(e_mem.IMemory, e_reg.RegisterContext, e_resolv.SymbolResolver, objec
         self.attached = False
         self.pid = 0
         self.mapcache = None
+        self.memcache = {}
 
     def getPid(self):
         """
@@ -331,6 +368,13 @@ class Trace(e_mem.IMemory, e_reg.RegisterContext, e_resolv.SymbolResolver, objec
         # NOTE: Override this from envi.SymbolResolver to do on-demand
         # file parsing.
 
+        if not exact:
+            # The nearest symbol is only right once the file for the
+            # address has been parsed...
+            map = self.getMemoryMap(addr)
+            if map != None:
+                self._loadBinary(map[3])
+
         r = e_resolv.SymbolResolver.getSymByAddr(self, addr, exact=exact)
         if r != None:
             return r
@@ -393,6 +437,7 @@ class Trace(e_mem.IMemory, e_reg.RegisterContext, e_resolv.SymbolResolver, objec
         """
         self.requireNotRunning()
         self.mapcache = None # We may have a new memory map
+        self.memcache = {}
         return self.platformAllocateMemory(size, perms=perms, suggestaddr=suggestaddr)
 
     def protectMemory(self, va, size, perms):
@@ -402,15 +447,178 @@ class Trace(e_mem.IMemory, e_reg.RegisterContext, e_resolv.SymbolResolver, objec
         """
         self.requireNotRunning()
         self.mapcache = None # We may have new memory protections
+        self.memcache = {}
         return self.platformProtectMemory(va, size, perms)
 
     def readMemory(self, address, size):
         """
         Read memory from address.  Areas that are NOT valid memory will be read
         back as \x00s (this probably goes in a mixin soon)
+
+        NOTE: In MemCache mode (the default) reads are satisfied from a
+              cache of pages which is thrown away whenever the target runs.
+        """
+        self.requireNotRunning()
+        address = long(address)
+        size = long(size)
+        if size > MEMCACHE_MAXREAD or not self.getMode("MemCache"):
+            return self.platformReadMemory(address, size)
+
+        return self._readCachedPages(address, size)
+
+    def _readCachedPages(self, address, size):
+        psize = MEMCACHE_PAGESIZE
+        pageva = address & ~(psize-1)
+        offset = address - pageva
+
+        # The common case of a read inside one (whole) page
+        if offset + size <= psize:
+            page = self.memcache.get(pageva)
+            if page == None:
+                self.memcache_misses += 1
+                page = self._readCachePage(pageva, address)
+            else:
+                self.memcache_hits += 1
+            if page.__class__ is tuple:
+                return self._readPartialPage(page, pageva, offset, offset+size)
+            return page[offset:offset+size]
+
+        ret = []
+        endva = address + size
+        va = address
+        while va < endva:
+            page = self.memcache.get(pageva)
+            if page == None:
+                self.memcache_misses += 1
+                page = self._readCachePage(pageva, va)
+            else:
+                self.memcache_hits += 1
+
+            lo = va - pageva
+            hi = min(psize, endva - pageva)
+            if page.__class__ is tuple:
+                ret.append(self._readPartialPage(page, pageva, lo, hi))
+            else:
+                ret.append(page[lo:hi])
+
+            pageva += psize
+            va = pageva
+        return "".join(ret)
+
+    def _readCachePage(self, pageva, va):
+        # Read a page into the MemCache.  A page which is only partly
+        # mapped (unaligned maps in snapshots etc) is cached as an
+        # (offset, bytes) tuple for the mapped part which contains va.
+        psize = MEMCACHE_PAGESIZE
+        try:
+            page = self.platformReadMemory(pageva, psize)
+        except Exception, e:
+            lo, hi = self._getMappedRange(pageva, va)
+            if lo == hi:
+                raise e
+            page = (lo - pageva, self.platformReadMemory(lo, hi - lo))
+        else:
+            if len(page) != psize: # (some memory objects read short)
+                page = (0, page)
+        self.memcache[pageva] = page
+        return page
+
+    def _readPartialPage(self, page, pageva, lo, hi):
+        # Return the bytes lo -> hi of a partial page (from the cache
+        # if they were mapped when it was read)
+        poff, pbytes = page
+        if lo >= poff and hi <= poff + len(pbytes):
+            return pbytes[lo-poff:hi-poff]
+        return self.platformReadMemory(pageva + lo, hi - lo)
+
+    def _getMappedRange(self, pageva, va):
+        # Return the (start, end) of the contiguously mapped part of
+        # the page at pageva which contains va (start == end if none)
+        pend = pageva + MEMCACHE_PAGESIZE
+        map = self.getMemoryMap(va)
+        if map == None:
+            return va, va
+
+        lo = max(pageva, map[0])
+        hi = min(pend, map[0] + map[1])
+        while lo > pageva:
+            map = self.getMemoryMap(lo - 1)
+            if map == None:
+                break
+            lo = max(pageva, map[0])
+        while hi < pend:
+            map = self.getMemoryMap(hi)
+            if map == None:
+                break
+            hi = min(pend, map[0] + map[1])
+        return lo, hi
+
+    def takeSnapshot(self, workers=4, progress=None):
+        """
+        Take a snapshot of the process from the current state and
+        return a vtrace.snapshot.TraceSnapshot for it (which holds
+        all the process memory).
+
+        Memory is read by up to workers threads where the platform
+        allows, and progress (if specified) is called with the
+        (bytesdone, bytestotal) as it goes.
+        """
+        import vtrace.snapshot as vs_snap
+        return vs_snap.takeSnapshot(self, workers=workers, progress=progress)
+
+    def saveSnapshot(self, filename, compress=True, parent=None, workers=4, progress=None):
+        """
+        Snapshot the process from the current state straight into a
+        file (without reading all its memory in at once).  Load it
+        with vtrace.snapshot.TraceSnapshot(filename).
+
+        If parent is the filename of an earlier snapshot of this
+        process, only the pages changed since then are saved.  (See
+        takeSnapshot() for workers and progress)
+        """
+        import vtrace.snapshot as vs_snap
+        vs_snap.saveSnapshot(self, filename, compress=compress, parent=parent,
+                             workers=workers, progress=progress)
+
+    def getMemCacheStats(self):
+        """
+        Return a dictionary of the MemCache counters (hits, misses)
+        and the number of pages currently cached.
+        """
+        return {
+            "hits":self.memcache_hits,
+            "misses":self.memcache_misses,
+            "pages":len(self.memcache),
+        }
+
+    def clearMemCache(self):
+        """
+        Throw away the MemCache pages (use this if the target memory is
+        modified behind the trace's back, like shared memory).
+        """
+        self.memcache = {}
+
+    def readMemoryInto(self, address, buf):
+        """
+        Read len(buf) bytes of memory from address into the writable
+        buffer buf (a bytearray or ctypes array) without creating a
+        new string for them.  Returns the number of bytes read.
         """
         self.requireNotRunning()
-        return self.platformReadMemory(long(address), long(size))
+        return self.platformReadMemoryInto(long(address), buf)
+
+    def readMemoryRegions(self, regions):
+        """
+        Read a list of (address, size) regions (in as few system calls
+        as the platform allows) and return a list of the bytes for each
+        region (None for regions which could not be read).
+
+        Example:
+            for bytes in trace.readMemoryRegions([(va1, 16), (va2, 32)]):
+                ...
+        """
+        self.requireNotRunning()
+        return self.platformReadMemoryRegions([(long(a), long(s)) for a,s in regions])
 
     def writeMemory(self, address, bytes):
         """
@@ -418,6 +626,13 @@ class Trace(e_mem.IMemory, e_reg.RegisterContext, e_resolv.SymbolResolver, objec
         """
         self.requireNotRunning()
         self.platformWriteMemory(long(address), bytes)
+        if self.memcache:
+            pageva = address & ~(MEMCACHE_PAGESIZE-1)
+            while pageva < address + len(bytes):
+                self.memcache.pop(pageva, None)
+                pageva += MEMCACHE_PAGESIZE
+        if self.imem_whooks:
+            self.fireWriteHooks(address, len(bytes))
 
     def searchMemory(self, needle):
         """
@@ -703,6 +918,18 @@ class Trace(e_mem.IMemory, e_reg.RegisterContext, e_resolv.SymbolResolver, objec
             self.mapcache = self.platformGetMaps()
         return self.mapcache
 
+    def getMemoryMap(self, va):
+        """
+        Return the (addr,len,perms,file) tuple for the memory map which
+        contains va (or None).  Lookups use a sorted index which is built
+        once each time the memory maps are (re)cached.
+        """
+        maps = self.getMemoryMaps()
+        mindex = self.mapindex
+        if mindex == None or mindex.maps is not maps:
+            mindex = self.mapindex = MapCacheIndex(maps)
+        return mindex.getMap(va)
+
     def isAttached(self):
         """
         Return boolean true/false for weather or not this trace is
@@ -217,10 +217,22 @@ class SnapshotBreak(Breakpoint):
     to a default name of <exename>-<timestamp>.vsnap.  This is not
     recommended for use in heavily hit breakpoints as taking a
     snapshot is processor intensive.
+
+    If incremental is set, each snapshot after the first only saves
+    the pages changed since the previous one (and needs it to load).
     """
+    def __init__(self, address, expression=None, incremental=False):
+        Breakpoint.__init__(self, address, expression=expression)
+        self.incremental = incremental
+        self.lastsnap = None
+
     def notify(self, event, trace):
         exe = trace.getExe()
-        snap = trace.takeSnapshot()
-        snap.saveToFile("%s-%d.vsnap" % (exe,time.time()))
+        filename = "%s-%d.vsnap" % (exe,time.time())
+        parent = None
+        if self.incremental:
+            parent = self.lastsnap
+        trace.saveSnapshot(filename, parent=parent)
+        self.lastsnap = filename
         Breakpoint.notify(self, event, trace)
 
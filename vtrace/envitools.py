@@ -92,6 +92,10 @@ class TraceEmulator(vtrace.Trace, v_base.TracerBase):
 
         self.setRegisterInfo(emu.getRegisterInfo())
 
+        # The emulator's memory may change (and may not be page
+        # aligned) behind our back...
+        self.setMode("MemCache", False)
+
     def platformStepi(self):
         self.emu.stepi()
 
@@ -5,6 +5,7 @@ Tracer Platform Base
 import os
 import struct
 import vtrace
+import vtrace.symcache as v_symcache
 import traceback
 import platform
 
@@ -43,6 +44,11 @@ class TracerBase(vtrace.Notifier):
         self.attached = False
         # A cache for memory maps and fd listings
         self.mapcache = None
+        self.mapindex = None # A MemoryMapIndex for the mapcache
+        # A page cache for memory reads while stopped (see MemCache mode)
+        self.memcache = {}
+        self.memcache_hits = 0
+        self.memcache_misses = 0
         self.threadcache = None
         self.fds = None
         self.signal_ignores = []
@@ -52,6 +58,7 @@ class TracerBase(vtrace.Notifier):
         # normame to full path mappings
         self.libloaded = {} # True if the library has been loaded already
         self.libpaths = {}  # normname->filename and filename->normname lookup
+        self.symcache = None # The SymbolCache (see getSymbolCache())
 
         # For all transient data (if notifiers want
         # to track stuff per-trace
@@ -137,6 +144,7 @@ class TracerBase(vtrace.Notifier):
         self._throwdownBreaks()
 
         self.running = True
+        self.memcache = {}
         # Syncregs must happen *after* notifiers for CONTINUE
         # and checkForBreak.
         self._syncRegs()
@@ -432,6 +440,7 @@ class TracerBase(vtrace.Notifier):
         """
         self.threadcache = None
         self.mapcache = None
+        self.memcache = {}
         self.fds = None
         self.running = False
 
@@ -546,6 +555,22 @@ class TracerBase(vtrace.Notifier):
                 return True
         return False
 
+    def getSymbolCache(self):
+        """
+        Return the vtrace.symcache.SymbolCache for parsed binaries
+        (or None if SymbolCache mode is off or there is no cache dir).
+        """
+        if not self.getMode("SymbolCache"):
+            return None
+        if self.symcache == None:
+            try:
+                self.symcache = v_symcache.SymbolCache()
+            except Exception, e:
+                return None
+        if self.symcache.cachedir == None:
+            return None
+        return self.symcache
+
     def threadWrap(self, name, meth):
         """
         Cause the method (given in value) to be wrapped
@@ -715,10 +740,60 @@ class TracerBase(vtrace.Notifier):
         
     def platformReadMemory(self, address, size):
         raise Exception("Platform must implement platformReadMemory!")
+
+    def platformReadMemoryInto(self, address, buf):
+        """
+        Read len(buf) bytes from address into the writable buffer buf
+        and return the number of bytes read.  Platforms which can read
+        straight into the buffer should over-ride this.
+        """
+        bytes = self.platformReadMemory(address, len(buf))
+        buf[:len(bytes)] = bytes
+        return len(bytes)
+
+    def platformReadMemoryRegions(self, regions):
+        """
+        Read a list of (address, size) regions and return a list of
+        the bytes for each (or None where the region can't be read).
+        Platforms which can read many regions per call should
+        over-ride this.
+        """
+        ret = []
+        for address, size in regions:
+            try:
+                ret.append(self.platformReadMemory(address, size))
+            except Exception, e:
+                ret.append(None)
+        return ret
         
     def platformWriteMemory(self, address, bytes):
         raise Exception("Platform must implement platformWriteMemory!")
 
+    def platformOpenMemReader(self):
+        """
+        Return an object with readMemory(va, size) and close() methods
+        which may be used from any (one) thread to read the memory of
+        the stopped process without going through the trace, or None
+        if the platform can't.  (Snapshots use these to read memory
+        from many threads at once)
+        """
+        return None
+
+    def platformGetDirtyPages(self, va, size):
+        """
+        Return a list of booleans (one for each page in va, size)
+        which are True for the pages written since the last call to
+        platformClearDirtyPages(), or None if the platform can't tell.
+        """
+        return None
+
+    def platformClearDirtyPages(self):
+        """
+        Start tracking dirty pages (see platformGetDirtyPages) from now
+        and return True (or return False if the platform can't).
+        """
+        return False
+
     def platformGetMemFault(self):
         """
         Return the addr of the current memory fault
@@ -3,6 +3,7 @@ Linux Platform Module
 """
 # Copyright (C) 2007 Invisigoth - See LICENSE file for details
 import os
+import array
 import struct
 import signal
 import traceback
@@ -19,8 +20,9 @@ import vtrace.archs.i386 as v_i386
 from ctypes import *
 import ctypes.util as cutil
 
-libc = CDLL(cutil.find_library("c"))
+libc = CDLL(cutil.find_library("c"), use_errno=True)
 
+O_RDONLY = 0
 O_RDWR = 2
 O_LARGEFILE = 0x8000
 
@@ -60,10 +62,116 @@ PT_EVENT_EXEC       = 4
 PT_EVENT_VFORK_DONE = 5
 PT_EVENT_EXIT       = 6
 
+# The most iovecs (struct iovec {void *base; size_t len}) one
+# process_vm_readv call may take
+IOV_MAX = 1024
+EIO = 5
+EFAULT = 14
+
+libc.pread64.argtypes = [c_int, c_void_p, c_size_t, c_longlong]
+libc.pread64.restype = c_ssize_t
+libc.pwrite64.argtypes = [c_int, c_char_p, c_size_t, c_longlong]
+libc.pwrite64.restype = c_ssize_t
+
+# process_vm_readv/writev are Linux >= 3.2 (and a new enough libc)
+try:
+    process_vm_readv = libc.process_vm_readv
+    process_vm_readv.argtypes = [c_int, c_void_p, c_ulong, c_void_p, c_ulong, c_ulong]
+    process_vm_readv.restype = c_ssize_t
+    process_vm_writev = libc.process_vm_writev
+    process_vm_writev.argtypes = [c_int, c_void_p, c_ulong, c_void_p, c_ulong, c_ulong]
+    process_vm_writev.restype = c_ssize_t
+except AttributeError:
+    process_vm_readv = None
+    process_vm_writev = None
+
 # Used to tell some of the additional events apart
 SIG_LINUX_SYSCALL = signal.SIGTRAP | 0x80
 SIG_LINUX_CLONE = signal.SIGTRAP | (PT_EVENT_CLONE << 8)
 
+# The soft-dirty bit in a /proc/<pid>/pagemap entry (set when the page
+# is written after "4" is written to /proc/<pid>/clear_refs)
+PAGEMAP_SOFT_DIRTY = 1 << 55
+PAGEMAP_SWAPPED = 1 << 62
+PAGEMAP_PRESENT = 1 << 63
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+softdirty = None
+
+def softDirtySupported():
+    """
+    Return True if the kernel tracks soft-dirty pages (which we find
+    out once by clearing and dirtying a page of our own).
+
+    NOTE: The probe writes /proc/self/clear_refs, which resets the
+          soft-dirty bits of this (the debugger) process.
+    """
+    global softdirty
+    if softdirty != None:
+        return softdirty
+
+    softdirty = False
+    try:
+        buf = create_string_buffer(PAGE_SIZE * 2)
+        # A page entirely within the buffer
+        va = (addressof(buf) + PAGE_SIZE - 1) & ~(PAGE_SIZE - 1)
+
+        f = file("/proc/self/clear_refs", "wb")
+        f.write("4")
+        f.close()
+
+        memmove(va, "A" * 8, 8)
+
+        f = file("/proc/self/pagemap", "rb")
+        f.seek((va / PAGE_SIZE) * 8)
+        entry, = struct.unpack("<Q", f.read(8))
+        f.close()
+
+        softdirty = bool(entry & PAGEMAP_SOFT_DIRTY)
+    except Exception, e:
+        pass
+    return softdirty
+
+class LinuxMemReader:
+    """
+    Read the memory of a (stopped) process from any thread using
+    process_vm_readv (or a memfile of its own) rather than through
+    the TracerThread (see platformOpenMemReader).
+    """
+    def __init__(self, pid, vmreadv=True):
+        self.pid = pid
+        self.vmreadv = vmreadv and process_vm_readv != None
+        self.memfd = None
+
+    def readMemory(self, address, size):
+        buf = create_string_buffer(size)
+        if self.vmreadv:
+            local = array.array("L", [addressof(buf), size])
+            remote = array.array("L", [address, size])
+            x = process_vm_readv(self.pid, local.buffer_info()[0], 1,
+                                 remote.buffer_info()[0], 1, 0)
+            if x == size:
+                return buf.raw
+            if x < 0 and get_errno() != EFAULT:
+                self.vmreadv = False
+
+        if self.memfd == None:
+            fd = libc.open("/proc/%d/mem" % self.pid, O_RDONLY | O_LARGEFILE, 0)
+            if fd < 0:
+                raise Exception("Can't open memfile for pid %d" % self.pid)
+            self.memfd = fd
+
+        x = libc.pread64(self.memfd, buf, size, address)
+        if x != size:
+            raise Exception("reading from invalid memory %s (%d returned)" % (hex(address), x))
+        return buf.raw
+
+    def close(self):
+        if self.memfd != None:
+            libc.close(self.memfd)
+            self.memfd = None
+
 class user_regs_i386(Structure):
     _fields_ = (
         ("ebx",  c_ulong),
@@ -132,12 +240,16 @@ class LinuxMixin(v_posix.PtraceMixin, v_posix.PosixMixin):
         self.threadWrap("platformAllocateMemory", self.platformAllocateMemory)
         self.threadWrap("getPtraceEvent", self.getPtraceEvent)
         self.threadWrap("platformReadMemory", self.platformReadMemory)
+        self.threadWrap("platformReadMemoryInto", self.platformReadMemoryInto)
+        self.threadWrap("platformReadMemoryRegions", self.platformReadMemoryRegions)
         if platform.release().startswith("2.4"):
             self.threadWrap("platformWait", self.platformWait)
-        #self.threadWrap("platformWriteMemory", self.platformWriteMemory)
         self.threadWrap("doAttachThread", self.doAttachThread)
         self.nptlinit = False
         self.memfd = None
+        self.vmreadv = process_vm_readv != None
+        self.vmwritev = process_vm_writev != None
+        self.memwrite = True # Can we write the memfile (2.6.39 and later)
 
         self.initMode("Syscall", False, "Break On Syscalls")
 
@@ -154,8 +266,7 @@ class LinuxMixin(v_posix.PtraceMixin, v_posix.PosixMixin):
         if self.memfd == None:
             self.memfd = libc.open("/proc/%d/mem" % self.pid, O_RDWR | O_LARGEFILE, 0755)
 
-        addr = c_ulonglong(offset)
-        x = libc.llseek(self.memfd, addr, 0)
+        os.lseek(self.memfd, offset, 0)
 
     #FIXME this is intel specific and should probably go in with the regs
     def platformAllocateMemory(self, size, perms=e_mem.MM_RWX, suggestaddr=0):
@@ -213,30 +324,218 @@ class LinuxMixin(v_posix.PtraceMixin, v_posix.PosixMixin):
     def platformReadMemory(self, address, size):
         """
         A *much* faster way of reading memory that the 4 bytes
-        per syscall allowed by ptrace
+        per syscall allowed by ptrace (os.read() reads from the
+        memfile straight into the returned string)
         """
         self.setupMemFile(address)
-        # Use ctypes cause python implementation is teh ghey
-        buf = create_string_buffer("\x00" * size)
-        x = libc.read(self.memfd, addressof(buf), size)
+        try:
+            bytes = os.read(self.memfd, size)
+        except OSError, e:
+            bytes = ""
+        if len(bytes) != size:
+            raise Exception("reading from invalid memory %s (%d returned)" % (hex(address), len(bytes)))
+        return bytes
+
+    def platformReadMemoryInto(self, address, buf):
+        """
+        Read len(buf) bytes into the (writable) buffer buf with pread
+        on the memfile (no intermediate strings).
+        """
+        size = len(buf)
+        if self.memfd == None:
+            self.setupMemFile(address)
+        cbuf = (c_char * size).from_buffer(buf)
+        x = libc.pread64(self.memfd, addressof(cbuf), size, address)
         if x != size:
             raise Exception("reading from invalid memory %s (%d returned)" % (hex(address), x))
-        # We have to slice cause ctypes "helps" us by adding a null byte...
-        return buf.raw[:size]
+        return x
 
-    def whynot_platformWriteMemory(self, address, data):
+    def platformReadMemoryRegions(self, regions):
         """
-        A *much* faster way of writting memory that the 4 bytes
-        per syscall allowed by ptrace
+        Read many (address, size) regions with one process_vm_readv
+        per IOV_MAX regions (falling back to pread on the memfile) into
+        one buffer.  Regions which can't be read come back as None.
         """
-        self.setupMemFile(address)
-        buf = create_string_buffer(data)
-        size = len(data)
-        x = libc.write(self.memfd, addressof(buf), size)
-        if x != size:
-            raise Exception("write memory failed: %d" % x)
+        if not regions:
+            return []
+
+        total = 0
+        for address, size in regions:
+            total += size
+
+        buf = bytearray(max(total, 1))
+        cbuf = (c_char * len(buf)).from_buffer(buf)
+        base = addressof(cbuf)
+
+        # Offsets into buf and a read/failed status per region
+        offsets = []
+        status = [False] * len(regions)
+        off = 0
+        for address, size in regions:
+            offsets.append(off)
+            off += size
+
+        if self.vmreadv:
+            for i in xrange(0, len(regions), IOV_MAX):
+                batch = regions[i:i+IOV_MAX]
+                self._readvBatch(i, batch, offsets, status, base)
+                if not self.vmreadv:
+                    break
+
+        # Anything not yet read goes one region at a time
+        for i, (address, size) in enumerate(regions):
+            if status[i] or size == 0:
+                status[i] = True
+                continue
+            if self.memfd == None:
+                self.setupMemFile(address)
+            x = libc.pread64(self.memfd, base + offsets[i], size, address)
+            status[i] = (x == size)
+
+        ret = []
+        for i, (address, size) in enumerate(regions):
+            if not status[i]:
+                ret.append(None)
+                continue
+            ret.append(str(buffer(buf, offsets[i], size)))
+        return ret
+
+    def _readvBatch(self, first, batch, offsets, status, base):
+        # Read a batch of regions with process_vm_readv and mark the
+        # ones which were completely read in status.  process_vm_readv
+        # stops at the first remote iovec it can't read, so keep going
+        # from the region after the failed one.
+        count = len(batch)
+        start = 0
+        while start < count:
+            # Build the iovec arrays as flat arrays of unsigned longs
+            # (much faster than making iovec structures one by one)
+            n = count - start
+            local = array.array("L")
+            remote = array.array("L")
+            for j in xrange(start, count):
+                address, size = batch[j]
+                local.append(base + offsets[first+j])
+                local.append(size)
+                remote.append(address)
+                remote.append(size)
+
+            x = process_vm_readv(self.pid, local.buffer_info()[0], n,
+                                 remote.buffer_info()[0], n, 0)
+            if x < 0:
+                # Only EFAULT is about the region, anything else (ENOSYS,
+                # EPERM...) means use the fallback from now on.
+                if get_errno() != EFAULT:
+                    self.vmreadv = False
+                    return
+                # Skip the (first) unreadable region
+                start += 1
+                continue
+
+            j = start
+            while j < count and x >= batch[j][1]:
+                status[first+j] = True
+                x -= batch[j][1]
+                j += 1
+
+            # Region j came back short (unreadable), leave it for the
+            # pread fallback and carry on after it
+            start = j + 1
+
+    def platformWriteMemory(self, address, bytes):
+        """
+        A *much* faster way of writting memory than the one word per
+        syscall allowed by ptrace.  Use process_vm_writev, then pwrite on
+        the memfile (which may write read-only pages like code) and
+        only fall back to ptrace for what those can't write.
+        """
+        size = len(bytes)
+        if self.vmwritev and size:
+            x = self._writevMemory(address, bytes)
+            if x == size:
+                return
+            # Short (or no) write, probably a read-only page...
+            if x > 0:
+                address += x
+                bytes = bytes[x:]
+                size -= x
+
+        if self.memwrite and size:
+            if self.memfd == None:
+                self.setupMemFile(address)
+            x = libc.pwrite64(self.memfd, bytes, size, address)
+            if x == size:
+                return
+            if x < 0:
+                # Older kernels don't allow memfile writes (EINVAL)
+                if get_errno() != EIO:
+                    self.memwrite = False
+            else:
+                address += x
+                bytes = bytes[x:]
+
+        return v_posix.PtraceMixin.platformWriteMemory(self, address, bytes)
+
+    def _writevMemory(self, address, bytes):
+        # process_vm_writev the bytes to address and return how many
+        # were written (or -1).  It respects page protections, so
+        # writes to read-only pages fail (EFAULT).
+        size = len(bytes)
+        buf = c_char_p(bytes)
+        local = array.array("L", [cast(buf, c_void_p).value, size])
+        remote = array.array("L", [address, size])
+        x = process_vm_writev(self.pid, local.buffer_info()[0], 1,
+                              remote.buffer_info()[0], 1, 0)
+        if x < 0 and get_errno() != EFAULT:
+            self.vmwritev = False
         return x
 
+    def platformOpenMemReader(self):
+        return LinuxMemReader(self.pid, vmreadv=self.vmreadv)
+
+    def platformGetDirtyPages(self, va, size):
+        """
+        Use the soft-dirty bits from /proc/<pid>/pagemap to tell which
+        pages were written since platformClearDirtyPages().
+
+        Only pages which are present (or swapped out) without the
+        soft-dirty bit are clean.  A page which isn't there at all may
+        have been dropped (MADV_DONTNEED etc) since the bits were
+        cleared, so it must be read again.
+        """
+        if not softDirtySupported():
+            return None
+
+        first = va / PAGE_SIZE
+        count = ((va + size + PAGE_SIZE - 1) / PAGE_SIZE) - first
+        fd = os.open("/proc/%d/pagemap" % self.pid, os.O_RDONLY)
+        try:
+            os.lseek(fd, first * 8, 0)
+            bytes = os.read(fd, count * 8)
+        finally:
+            os.close(fd)
+
+        if len(bytes) != count * 8:
+            return None
+
+        entries = struct.unpack("<%dQ" % count, bytes)
+        ret = []
+        for e in entries:
+            ret.append(bool(e & PAGEMAP_SOFT_DIRTY) or
+                       not (e & (PAGEMAP_PRESENT | PAGEMAP_SWAPPED)))
+        return ret
+
+    def platformClearDirtyPages(self):
+        if not softDirtySupported():
+            return False
+        try:
+            f = file("/proc/%d/clear_refs" % self.pid, "wb")
+            f.write("4")
+            f.close()
+        except Exception, e:
+            return False
+        return True
+
     def _findExe(self, pid):
         exe = os.readlink("/proc/%d/exe" % pid)
         if "(deleted)" in exe:
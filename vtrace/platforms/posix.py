@@ -11,6 +11,7 @@ import platform
 
 import vtrace
 import vtrace.util as v_util
+import vtrace.symcache as v_symcache
 import Elf
 from ctypes import *
 import ctypes.util as cutil
@@ -154,35 +155,58 @@ class ElfMixin:
         self.setMeta('Format','elf')
 
     def platformParseBinary(self, filename, baseaddr, normname):
+        symcache = self.getSymbolCache()
+
+        cached = None
+        if symcache != None:
+            cached = symcache.getSymbols(filename)
+
+        if cached == None:
+            cached = self.parseElfSymbols(filename)
+            if symcache != None:
+                symcache.setSymbols(filename, *cached)
+
+        absolute, symtups = cached
+        if absolute:
+            baseaddr = 0
+
+        self.addSymbols(v_symcache.buildSymbols(symtups, baseaddr, normname))
+
+    def parseElfSymbols(self, filename):
+        """
+        Parse the sections and symbols from an Elf file and return
+        (absolute, symtups) as used by vtrace.symcache.
+        """
         typemap = {
-            Elf.STT_FUNC:e_resolv.FunctionSymbol,
-            Elf.STT_SECTION:e_resolv.SectionSymbol,
+            Elf.STT_FUNC:v_symcache.SYMCACHE_FUNCTION,
+            Elf.STT_SECTION:v_symcache.SYMCACHE_SECTION,
         }
 
         elf = Elf.Elf(filename)
 
         # Quick pass to see if we need to assume prelink
+        absolute = False
         for sec in elf.sections:
             if sec.name != ".text":
                 continue
             # Try to detect prelinked
             if sec.sh_addr != sec.sh_offset:
-                baseaddr = 0
+                absolute = True
             break
 
+        symtups = []
         for sec in elf.sections:
-            sym = e_resolv.SectionSymbol(sec.name, sec.sh_addr+baseaddr, sec.sh_size, normname)
-            self.addSymbol(sym)
-
-        for sym in elf.symbols:
-            symclass = typemap.get((sym.st_info & 0xf), e_resolv.Symbol)
-            sym = symclass(sym.name, sym.st_value+baseaddr, sym.st_size, normname)
-            self.addSymbol(sym)
-
-        for sym in elf.dynamic_symbols:
-            symclass = typemap.get((sym.st_info & 0xf), e_resolv.Symbol)
-            sym = symclass(sym.name, sym.st_value+baseaddr, sym.st_size, normname)
-            self.addSymbol(sym)
+            symtups.append((v_symcache.SYMCACHE_SECTION, sec.name, sec.sh_addr, sec.sh_size))
+
+        for sym in elf.iterSymbols():
+            symtype = typemap.get((sym.st_info & 0xf), v_symcache.SYMCACHE_SYMBOL)
+            symtups.append((symtype, sym.name, sym.st_value, sym.st_size))
+
+        for sym in elf.iterDynSyms():
+            symtype = typemap.get((sym.st_info & 0xf), v_symcache.SYMCACHE_SYMBOL)
+            symtups.append((symtype, sym.name, sym.st_value, sym.st_size))
+
+        return absolute, symtups
 
 # As much as I would *love* if all the ptrace defines were the same all the time,
 # there seem to be small platform differences...
@@ -14,6 +14,7 @@ import vtrace
 import vtrace.archs.i386 as v_i386
 import vtrace.archs.amd64 as v_amd64
 import vtrace.platforms.base as v_base
+import vtrace.symcache as v_symcache
 
 import envi
 import envi.memory as e_mem
@@ -1297,17 +1298,33 @@ class WindowsMixin:
         parser = Win32SymbolParser(self.phandle, filename, baseaddr)
         parser.parse()
 
+        syms = []
         for name, addr, size, flags in parser.symbols:
             symclass = e_resolv.Symbol
             if flags & funcflags:
                 symclass = e_resolv.FunctionSymbol
             sym = symclass(name, addr, size, normname)
-            self.addSymbol(sym)
+            syms.append(sym)
+        self.addSymbols(syms)
 
     def parseWithPE(self, filename, baseaddr, normname):
-        pe = PE.peFromMemoryObject(self, baseaddr)
-        for rva, ord, name in pe.getExports():
-            self.addSymbol(e_resolv.Symbol(name, baseaddr+rva, 0, normname))
+        symcache = self.getSymbolCache()
+
+        symtups = None
+        if symcache != None:
+            cached = symcache.getSymbols(filename)
+            if cached != None:
+                symtups = cached[1]
+
+        if symtups == None:
+            pe = PE.peFromMemoryObject(self, baseaddr)
+            symtups = []
+            for rva, ord, name in pe.getExports():
+                symtups.append((v_symcache.SYMCACHE_SYMBOL, name, rva, 0))
+            if symcache != None:
+                symcache.setSymbols(filename, False, symtups)
+
+        self.addSymbols(v_symcache.buildSymbols(symtups, baseaddr, normname))
 
     def platformGetRegCtx(self, threadid):
         ctx = self.archGetRegCtx()
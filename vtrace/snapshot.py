@@ -1,12 +1,333 @@
 """
 All the code related to vtrace process snapshots
 and TraceSnapshot classes.
+
+Snapshot files come in two versions:
+
+    1 - a pickled snapdict (every map's bytes as one string)
+    2 - a streamed page container (see SnapshotWriter) which is
+        mapped into memory and read a page at a time
+
+Use saveSnapshot() to stream a trace's memory straight into a
+version 2 file without holding it all in memory.
+
+A version 2 snapshot may also be incremental: given a parent snapshot
+file, only the pages which changed since the parent are stored and the
+rest are read (transparently) from the parent, so a chain of snapshots
+taken at successive stops of the same process stays small.
 """
+import os
+import sys
+import copy
+import mmap
+import zlib
+import struct
+import hashlib
+import itertools
+import cPickle as pickle
+
+from Queue import Queue
+from threading import Thread
 
 import vtrace
 import vtrace.platforms.base as v_base
+import envi.memory as e_mem
+
+SNAPFILE_MAGIC = "VTSNAPV2"
+SNAPFILE_VERSION = 2
+SNAP_PAGESIZE = 4096
+# The default number of threads reading memory for a snapshot
+SNAP_WORKERS = 4
+
+# magic, version, page size, index offset, index size
+snap_header = struct.Struct("<8sIIQQ")
 
-class TraceSnapshot(v_base.TracerBase):
+# The stored length of a page which is read from the parent snapshot
+PAGE_PARENT = 0xffffffff
+# The size of the page hashes (sha1) in the snapdict "hashes"
+PAGE_HASHSIZE = 20
+
+# The snapdict keys which describe the file (not the process)
+snapfile_keys = ("mem", "file", "pagesize", "pages", "hashes",
+                 "parent", "parentid", "snapid")
+
+class SnapshotWriter:
+    """
+    Write a version 2 snapshot file a page at a time.
+
+    The file is a header, the page data (written as the maps are
+    added) and a zlib compressed pickle of the snapdict at the end.
+    For each map, the snapdict "pages" entry holds packed arrays of
+    the file offset ("<Q") and stored length ("<I") of each page:
+
+        0                   - a page of zeros (nothing stored)
+        the page size       - the raw page bytes
+        PAGE_PARENT         - the page is in the parent snapshot
+        anything else       - the zlib compressed page
+
+    The snapdict "hashes" entry holds the sha1 of each page of each
+    map (which is what an incremental snapshot compares against) and
+    "snapid" is a random id for the file.
+
+    If parent (the filename of a version 2 snapshot) is specified, any
+    page whose hash matches the parent's page at the same address is
+    not stored.  The snapdict "parent" entry is the parent filename
+    (relative to the directory of this one where possible) and
+    "parentid" is the snapid of the parent.
+    """
+    def __init__(self, filename, compress=True, pagesize=SNAP_PAGESIZE, chunksize=0x100000, parent=None):
+        self.compress = compress
+        self.pagesize = pagesize
+        self.chunksize = chunksize - (chunksize % pagesize)
+        self.zeropage = "\x00" * pagesize
+        self.snapid = os.urandom(16).encode("hex")
+
+        self.maps = []
+        self.pages = {}
+        self.hashes = {}
+
+        self.parent = None
+        self.parentid = None
+        self.parenthashes = {}
+        self.parentmaps = {}
+        if parent != None:
+            psnap = loadSnapFile(parent)
+            if psnap.get("version") != SNAPFILE_VERSION or not psnap.has_key("hashes"):
+                raise Exception("ERROR: Parent snapshot %s has no page hashes" % parent)
+            if psnap["pagesize"] != pagesize:
+                raise Exception("ERROR: Parent snapshot %s has a different page size" % parent)
+            psnap["file"].close()
+
+            self.parentid = psnap["snapid"]
+            self.parenthashes = psnap["hashes"]
+            for pmap in psnap["maps"]:
+                self.parentmaps[pmap[0]] = pmap
+
+            # Keep the chain relocatable if the files are moved together
+            self.parent = os.path.abspath(parent)
+            pdir = os.path.dirname(self.parent)
+            if pdir == os.path.dirname(os.path.abspath(filename)):
+                self.parent = os.path.basename(self.parent)
+
+        self.fd = file(filename, "wb")
+        self.fd.write(snap_header.pack(SNAPFILE_MAGIC, 0, 0, 0, 0))
+        self.offset = snap_header.size
+
+    def _packPage(self, page):
+        # Return the bytes to store for a page ("" for a zero page)
+        plen = len(page)
+        if page == self.zeropage[:plen]:
+            return ""
+
+        if self.compress:
+            cpage = zlib.compress(page, 1)
+            if len(cpage) < plen:
+                return cpage
+
+        return page
+
+    def _writePage(self, page):
+        # Return the (offset, stored length) for packed page bytes
+        if not page:
+            return 0, 0
+        offset = self.offset
+        self.fd.write(page)
+        self.offset += len(page)
+        return offset, len(page)
+
+    def _getParentHashes(self, memmap):
+        # Return a list of the parent's hash for each page of the map
+        # (or None where the parent doesn't have the same full page)
+        va, size, perms, fname = memmap
+        pcount = (size + self.pagesize - 1) / self.pagesize
+        ret = [None] * pcount
+
+        pmap = self.parentmaps.get(va)
+        if pmap == None:
+            return ret
+
+        phashes = self.parenthashes[va]
+        fullpages = min(size, pmap[1]) / self.pagesize
+        for i in xrange(fullpages):
+            ret[i] = phashes[i*PAGE_HASHSIZE:(i+1)*PAGE_HASHSIZE]
+        return ret
+
+    def planMap(self, memmap, dirty=None):
+        """
+        Return a (mapinfo, runs) tuple for a map, where runs is a list
+        of (first, last) page indexes which need to be read (see
+        addMap() for dirty).  Pass each run (in order) to readPages()
+        and storePages() and then the mapinfo to finishMap().
+        """
+        va, size, perms, fname = memmap
+        pcount = (size + self.pagesize - 1) / self.pagesize
+        offsets = [0] * pcount
+        lengths = [0] * pcount
+        hashes = [None] * pcount
+
+        phashes = self._getParentHashes(memmap)
+        if dirty != None and len(dirty) != pcount:
+            dirty = None
+
+        # Pages which are clean (and in the parent) need no reading
+        readidx = []
+        for i in xrange(pcount):
+            if dirty != None and not dirty[i] and phashes[i] != None:
+                lengths[i] = PAGE_PARENT
+                hashes[i] = phashes[i]
+            else:
+                readidx.append(i)
+
+        # Runs of consecutive pages up to a chunk in size
+        runs = []
+        chunkpages = self.chunksize / self.pagesize
+        r = 0
+        while r < len(readidx):
+            first = readidx[r]
+            last = first
+            while (r + 1 < len(readidx) and readidx[r+1] == last + 1 and
+                   last + 1 - first < chunkpages):
+                r += 1
+                last += 1
+            r += 1
+            runs.append((first, last))
+
+        return (memmap, offsets, lengths, hashes, phashes), runs
+
+    def getRunSize(self, mapinfo, run):
+        """
+        Return the number of bytes in a run of pages (from planMap()).
+        """
+        va, size, perms, fname = mapinfo[0]
+        first, last = run
+        cva = va + (first * self.pagesize)
+        return min((last + 1 - first) * self.pagesize, va + size - cva)
+
+    def readPages(self, memobj, mapinfo, run):
+        """
+        Read a run of pages from memobj and return a list of (hash,
+        packed page) tuples for them (where the packed page is None if
+        the page is in the parent).  This does no file access, so many
+        threads may read pages for the writer at once.
+        """
+        memmap, offsets, lengths, hashes, phashes = mapinfo
+        first, last = run
+        cva = memmap[0] + (first * self.pagesize)
+        csize = self.getRunSize(mapinfo, run)
+        bytes = memobj.readMemory(cva, csize)
+        if len(bytes) != csize:
+            raise Exception("Short read at 0x%.8x" % cva)
+
+        ret = []
+        for i in xrange(first, last + 1):
+            boff = (i - first) * self.pagesize
+            page = bytes[boff:boff+self.pagesize]
+            phash = hashlib.sha1(page).digest()
+            if phash == phashes[i]:
+                ret.append((phash, None))
+            else:
+                ret.append((phash, self._packPage(page)))
+        return ret
+
+    def storePages(self, mapinfo, run, packed):
+        """
+        Write the pages for a run (from readPages()) to the file.
+        """
+        memmap, offsets, lengths, hashes, phashes = mapinfo
+        i = run[0]
+        for phash, page in packed:
+            hashes[i] = phash
+            if page == None:
+                lengths[i] = PAGE_PARENT
+            else:
+                offsets[i], lengths[i] = self._writePage(page)
+            i += 1
+
+    def finishMap(self, mapinfo):
+        """
+        Add a map (whose runs have all been stored) to the index.
+        """
+        memmap, offsets, lengths, hashes, phashes = mapinfo
+        va = memmap[0]
+        self.maps.append(memmap)
+        self.pages[va] = (struct.pack("<%dQ" % len(offsets), *offsets),
+                          struct.pack("<%dI" % len(lengths), *lengths))
+        self.hashes[va] = "".join(hashes)
+
+    def addMap(self, memmap, memobj, dirty=None):
+        """
+        Read the memory for a (va, size, perms, fname) map from a memory
+        object a chunk at a time and write it out.  If reading fails the
+        exception is raised and the map is left out.
+
+        For an incremental snapshot, dirty may be a list of booleans for
+        each page of the map which are False for pages known not to
+        have changed since the parent (see platformGetDirtyPages), which
+        are then not read at all.
+        """
+        mapinfo, runs = self.planMap(memmap, dirty=dirty)
+        for run in runs:
+            self.storePages(mapinfo, run, self.readPages(memobj, mapinfo, run))
+        self.finishMap(mapinfo)
+
+    def close(self, snapdict):
+        """
+        Write the index (the given snapdict plus the maps and pages)
+        and close the file.
+        """
+        snapdict = dict(snapdict)
+        snapdict["version"] = SNAPFILE_VERSION
+        # (Don't save the memory or mapped file of a loaded snapshot)
+        for key in snapfile_keys:
+            snapdict.pop(key, None)
+        snapdict["maps"] = self.maps
+        snapdict["pages"] = self.pages
+        snapdict["hashes"] = self.hashes
+        snapdict["snapid"] = self.snapid
+        if self.parent != None:
+            snapdict["parent"] = self.parent
+            snapdict["parentid"] = self.parentid
+
+        index = zlib.compress(pickle.dumps(snapdict, 2))
+        self.fd.write(index)
+        self.fd.seek(0)
+        self.fd.write(snap_header.pack(SNAPFILE_MAGIC, SNAPFILE_VERSION, self.pagesize, self.offset, len(index)))
+        self.fd.close()
+
+def loadSnapFile(filename):
+    """
+    Return the snapdict for a snapshot file (of either version).
+    For version 2 files, the snapdict "file" entry is the mapped file
+    (and the "parent" of an incremental snapshot is made absolute).
+    """
+    sfile = file(filename, "rb")
+    try:
+        magic = sfile.read(len(SNAPFILE_MAGIC))
+        if magic != SNAPFILE_MAGIC:
+            sfile.seek(0)
+            return pickle.load(sfile)
+
+        fmap = mmap.mmap(sfile.fileno(), 0, access=mmap.ACCESS_READ)
+
+    finally:
+        sfile.close()
+
+    magic, version, pagesize, indexoff, indexsize = snap_header.unpack_from(fmap, 0)
+    if version != SNAPFILE_VERSION:
+        raise Exception("ERROR: Unknown snapshot file version: %d" % version)
+
+    snapdict = pickle.loads(zlib.decompress(fmap[indexoff:indexoff+indexsize]))
+    snapdict["file"] = fmap
+    snapdict["pagesize"] = pagesize
+
+    parent = snapdict.get("parent")
+    if parent != None and not os.path.isabs(parent):
+        pdir = os.path.dirname(os.path.abspath(filename))
+        snapdict["parent"] = os.path.join(pdir, parent)
+
+    return snapdict
+
+class TraceSnapshot(vtrace.Trace, v_base.TracerBase):
     """
     A tracer snapshot is similar to a traditional "core file" except that
     you may also have memory only snapshots that are never written to disk.
@@ -16,37 +337,52 @@ class TraceSnapshot(v_base.TracerBase):
     analysis...
     """
     def __init__(self, filename=None, snapdict=None):
-        Trace.__init__(self)
+        vtrace.Trace.__init__(self)
+        v_base.TracerBase.__init__(self)
         if filename == None and snapdict == None:
             raise Exception("ERROR: TraceSnapshot needs either filename or snapdict!")
 
         if filename:
-            sfile = file(filename, "rb")
-            snapdict = pickle.load(sfile)
+            snapdict = loadSnapFile(filename)
 
         self.s_snapcache = {}
         self.s_snapdict = snapdict
 
+        # Written pages are copied (on write) into page sized buffers
+        # over the snapshot memory (which is never modified)
+        self.s_dirty = {} # pageva -> bytearray
+        self.s_pagesize = snapdict.get('pagesize', SNAP_PAGESIZE)
+
         # a seperate parser for each version...
-        if snapdict['version'] == 1:
-            self.s_version = snapdict['version']
-            self.s_threads = snapdict['threads']
-            self.s_regs = snapdict['regs']
-            self.s_maps = snapdict['maps']
+        self.s_version = snapdict['version']
+        if self.s_version == 1:
             self.s_mem = snapdict['mem']
-            self.metadata = snapdict['meta']
-            self.s_stacktrace = snapdict['stacktrace']
-            self.s_exe = snapdict['exe']
-            self.s_fds = snapdict['fds']
-            self.localvars = snapdict.get('vars', {})
+
+        elif self.s_version == 2:
+            self.s_file = snapdict['file']
+            self.s_pages = snapdict['pages']
+
+            # Incremental snapshots read unchanged pages from the parent
+            self.s_parent = None
+            parent = snapdict.get('parent')
+            if parent != None:
+                self.s_parent = TraceSnapshot(filename=parent)
+                if self.s_parent.s_snapdict.get('snapid') != snapdict['parentid']:
+                    raise Exception("ERROR: Parent snapshot %s has changed!" % parent)
+
         else:
             raise Exception("ERROR: Unknown snapshot version!")
 
-        #FIXME hard-coded page size!
-        self.s_map_lookup = {}
-        for map in self.s_maps:
-            for i in range(map[0],map[0] + map[1], 4096):
-                self.s_map_lookup[i] = map
+        self.s_threads = snapdict['threads']
+        self.s_regs = snapdict['regs']
+        self.s_maps = snapdict['maps']
+        self.metadata = snapdict['meta']
+        self.s_stacktrace = snapdict['stacktrace']
+        self.s_exe = snapdict['exe']
+        self.s_fds = snapdict['fds']
+        self.localvars = snapdict.get('vars', {})
+
+        self.s_map_index = vtrace.MapCacheIndex(self.s_maps)
 
         self.attached = True
         # So that we pickle
@@ -55,19 +391,35 @@ class TraceSnapshot(v_base.TracerBase):
 
         #FIXME maybe self.arch is NOT the same as real platform...
 
-    def saveToFile(self, filename):
+    def saveToFile(self, filename, version=SNAPFILE_VERSION, compress=True):
         """
         Save a snapshot to file for later reading in...
+        (Version 2 files are written a page at a time and compress
+        pages if compress is set.  An incremental snapshot is saved
+        with all its pages, so the file doesn't need the parent)
         """
-        #import zlib
-        f = file(filename, "wb")
-        pickle.dump(self.s_snapdict, f)
-        #f.write(zlib.compress(rawbytes))
-        f.close()
+        if version == 1:
+            snapdict = dict(self.s_snapdict)
+            snapdict['version'] = 1
+            for key in snapfile_keys:
+                snapdict.pop(key, None)
+            mem = {}
+            for memmap in self.s_maps:
+                mem[memmap[0]] = self.platformReadMemory(memmap[0], memmap[1])
+            snapdict['mem'] = mem
+
+            f = file(filename, "wb")
+            pickle.dump(snapdict, f, 2)
+            f.close()
+            return
+
+        writer = SnapshotWriter(filename, compress=compress)
+        for memmap in self.s_maps:
+            writer.addMap(memmap, self)
+        writer.close(self.s_snapdict)
 
     def getMemoryMap(self, addr):
-        base = addr & 0xfffff000
-        return self.s_map_lookup.get(base, None)
+        return self.s_map_index.getMap(addr)
 
     def platformGetFds(self):
         return self.s_fds
@@ -88,31 +440,101 @@ class TraceSnapshot(v_base.TracerBase):
     def platformGetThreads(self):
         return self.s_threads
 
-    def platformReadMemory(self, address, size):
+    def _snapGetPage(self, map, pageva):
+        # Return the bytes for a page from the writes or the snapshot
+        page = self.s_dirty.get(pageva)
+        if page != None:
+            return page
+
+        mapva, mapsize, mperm, mfname = map
+        psize = min(self.s_pagesize, mapva + mapsize - pageva)
+
+        if self.s_version == 1:
+            offset = pageva - mapva
+            return self.s_mem[mapva][offset:offset+psize]
+
+        offsets, lengths = self.s_pages[mapva]
+        pidx = (pageva - mapva) / self.s_pagesize
+        offset, = struct.unpack_from("<Q", offsets, pidx * 8)
+        plen, = struct.unpack_from("<I", lengths, pidx * 4)
+
+        if plen == PAGE_PARENT:
+            pmap = self.s_parent.getMemoryMap(pageva)
+            if pmap == None:
+                raise Exception("ERROR: Parent snapshot has no map for 0x%.8x" % pageva)
+            return self.s_parent._snapGetPage(pmap, pageva)
+
+        if plen == 0:
+            return "\x00" * psize
+
+        page = self.s_file[offset:offset+plen]
+        if plen != psize:
+            page = zlib.decompress(page)
+        return page
+
+    def _snapGetMap(self, address, what):
+        # Return the (backed) map for an address
         map = self.getMemoryMap(address)
         if map == None:
-            raise Exception("ERROR: platformReadMemory says no map for 0x%.8x" % address)
-        offset = address - map[0] # Base address
-        mapbytes = self.s_mem.get(map[0], None)
-        if mapbytes == None:
-            raise vtrace.PlatformException("ERROR: Memory map at 0x%.8x is not backed!" % map[0])
-        if len(mapbytes) == 0:
-            raise vtrace.PlatformException("ERROR: Memory Map at 0x%.8x is backed by ''" % map[0])
-
-        ret = mapbytes[offset:offset+size]
-        rlen = len(ret)
-        # We may have a cross-map read, just recurse for the rest
-        if rlen != size:
-            ret += self.platformReadMemory(address+rlen, size-rlen)
-        return ret
+            raise Exception("ERROR: %s says no map for 0x%.8x" % (what, address))
+
+        mapva = map[0]
+        if self.s_version == 1:
+            mapbytes = self.s_mem.get(mapva, None)
+            if mapbytes == None:
+                raise vtrace.PlatformException("ERROR: Memory map at 0x%.8x is not backed!" % mapva)
+            if len(mapbytes) == 0:
+                raise vtrace.PlatformException("ERROR: Memory Map at 0x%.8x is backed by ''" % mapva)
+
+        elif not self.s_pages.has_key(mapva):
+            raise vtrace.PlatformException("ERROR: Memory map at 0x%.8x is not backed!" % mapva)
+
+        return map
+
+    def platformReadMemory(self, address, size):
+        # Read page by page (and map by map) without recursion
+        ret = []
+        while size > 0:
+            map = self._snapGetMap(address, "platformReadMemory")
+            mapva, mapsize, mperm, mfname = map
+
+            # With no writes, version 1 maps read straight from the bytes
+            if self.s_version == 1 and not self.s_dirty:
+                offset = address - mapva
+                bytes = self.s_mem[mapva][offset:offset+size]
+
+            else:
+                pageoff = (address - mapva) % self.s_pagesize
+                pageva = address - pageoff
+                bytes = self._snapGetPage(map, pageva)[pageoff:pageoff+size]
+
+            if not bytes:
+                raise Exception("ERROR: platformReadMemory says no map for 0x%.8x" % address)
+
+            ret.append(str(bytes))
+            address += len(bytes)
+            size -= len(bytes)
+
+        return "".join(ret)
 
     def platformWriteMemory(self, address, bytes):
-        map = self.getMemoryMap(address)
-        if map == None:
-            raise Exception("ERROR: platformWriteMemory says no map for 0x%.8x" % address)
-        offset = address - map[0]
-        mapbytes = self.s_mem[map[0]]
-        self.s_mem[map[0]] = mapbytes[:offset] + bytes + mapbytes[offset+len(bytes):]
+        # Write into the (copy on write) page buffers
+        boff = 0
+        while boff < len(bytes):
+            map = self._snapGetMap(address, "platformWriteMemory")
+            mapva, mapsize, mperm, mfname = map
+            pageoff = (address - mapva) % self.s_pagesize
+            pageva = address - pageoff
+
+            page = self.s_dirty.get(pageva)
+            if page == None:
+                page = bytearray(self._snapGetPage(map, pageva))
+                self.s_dirty[pageva] = page
+
+            wlen = min(len(page) - pageoff, len(bytes) - boff)
+            page[pageoff:pageoff+wlen] = bytes[boff:boff+wlen]
+            address += wlen
+            boff += wlen
 
     def platformDetach(self):
         pass
@@ -127,11 +549,9 @@ class TraceSnapshot(v_base.TracerBase):
     def syncRegs(self):
         pass
 
-
-def takeSnapshot(trace):
+def getSnapInfo(trace):
     """
-    Take a snapshot of the process from the current state and return
-    a reference to a tracer which wraps a "snapshot" or "core file".
+    Return a snapdict with everything but the memory for a trace.
     """
     sd = dict()
     orig_thread = trace.getMeta("ThreadId")
@@ -150,26 +570,220 @@ def takeSnapshot(trace):
     if orig_thread != -1:
         trace.selectThread(orig_thread)
 
-    mem = dict()
-    maps = []
-    for base,size,perms,fname in trace.getMemoryMaps():
-        try:
-            mem[base] = trace.readMemory(base, size)
-            maps.append((base,size,perms,fname))
-        except Exception, msg:
-            print >> sys.stderr, "WARNING: Can't snapshot memmap at 0x%.8x (%s)" % (base,msg)
-
     # If the contents here change, change the version...
     sd['version'] = 1
     sd['threads'] = trace.getThreads()
     sd['regs'] = regs
-    sd['maps'] = maps
-    sd['mem'] = mem
     sd['meta'] = copy.deepcopy(trace.metadata)
     sd['stacktrace'] = stacktrace
     sd['exe'] = trace.getExe()
     sd['fds'] = trace.getFds()
     sd['vars'] = trace.localvars
 
+    return sd
+
+def _captureWorker(trace, func, jobs, done):
+    # Do func(reader, item) for (index, item) jobs until a None job
+    reader = trace.platformOpenMemReader()
+    try:
+        while True:
+            job = jobs.get()
+            if job == None:
+                return
+            idx, item = job
+            try:
+                ret = func(reader, item)
+            except Exception, e:
+                ret = e
+            done.put((idx, ret))
+    finally:
+        reader.close()
+
+def captureMemory(trace, func, items, workers=SNAP_WORKERS):
+    """
+    Yield func(memobj, item) for each of the items (in order), where
+    memobj is something to call readMemory() on.  If the platform can
+    read the (stopped) process memory from any thread (see
+    platformOpenMemReader) the items are done by a pool of worker
+    threads, each with a reader of its own.  Otherwise they are done
+    one at a time with the trace.  Any item which fails yields the
+    exception instead.
+    """
+    reader = None
+    if workers > 1 and len(items) > 1:
+        reader = trace.platformOpenMemReader()
+
+    if reader == None:
+        for item in items:
+            try:
+                ret = func(trace, item)
+            except Exception, e:
+                ret = e
+            yield ret
+        return
+
+    reader.close()
+
+    jobs = Queue()
+    done = Queue()
+    for i in xrange(workers):
+        thr = Thread(target=_captureWorker, args=(trace, func, jobs, done))
+        thr.setDaemon(True)
+        thr.start()
+
+    try:
+        # Only keep a few items ahead (to bound the memory in use)
+        ahead = workers * 2
+        nextjob = 0
+        results = {}
+        for idx in xrange(len(items)):
+            while nextjob < len(items) and nextjob < idx + ahead:
+                jobs.put((nextjob, items[nextjob]))
+                nextjob += 1
+
+            while not results.has_key(idx):
+                i, ret = done.get()
+                results[i] = ret
+
+            ret = results.pop(idx)
+            if isinstance(ret, Exception):
+                # The trace itself may still manage (reader permissions...)
+                try:
+                    ret = func(trace, items[idx])
+                except Exception, e:
+                    ret = e
+            yield ret
+
+    finally:
+        for i in xrange(workers):
+            jobs.put(None)
+
+def takeSnapshot(trace, workers=SNAP_WORKERS, progress=None, chunksize=0x100000):
+    """
+    Take a snapshot of the process from the current state and return
+    a reference to a tracer which wraps a "snapshot" or "core file".
+
+    The memory is read a chunk at a time by up to workers threads (see
+    captureMemory) and progress (if specified) is called as
+    progress(bytesdone, bytestotal) as the chunks come in.
+    """
+    sd = getSnapInfo(trace)
+
+    chunks = []
+    total = 0
+    memmaps = trace.getMemoryMaps()
+    for memmap in memmaps:
+        base, size, perms, fname = memmap
+        for cva in xrange(base, base + size, chunksize):
+            chunks.append((base, cva, min(chunksize, base + size - cva)))
+            total += chunks[-1][2]
+
+    def readchunk(memobj, chunk):
+        return memobj.readMemory(chunk[1], chunk[2])
+
+    mapbytes = dict()
+    failed = dict()
+    done = 0
+    capture = captureMemory(trace, readchunk, chunks, workers=workers)
+    for (base, cva, csize), ret in itertools.izip(chunks, capture):
+        done += csize
+        if progress != None:
+            progress(done, total)
+
+        if failed.has_key(base):
+            continue
+        if isinstance(ret, Exception):
+            failed[base] = ret
+            continue
+        mapbytes.setdefault(base, []).append(ret)
+
+    mem = dict()
+    maps = []
+    for base,size,perms,fname in memmaps:
+        msg = failed.get(base)
+        if msg != None:
+            print >> sys.stderr, "WARNING: Can't snapshot memmap at 0x%.8x (%s)" % (base,msg)
+            continue
+        mem[base] = "".join(mapbytes.get(base, []))
+        maps.append((base,size,perms,fname))
+
+    sd['maps'] = maps
+    sd['mem'] = mem
+
     return TraceSnapshot(snapdict=sd)
 
+def saveSnapshot(trace, filename, compress=True, parent=None, workers=SNAP_WORKERS, progress=None):
+    """
+    Snapshot the process from the current state straight into a
+    (version 2) snapshot file, reading and writing its memory a chunk
+    at a time.
+
+    If parent is the filename of an earlier snapshot of the same
+    process, only the pages which changed since then are stored (the
+    file then needs the parent to be read).  Changed pages are found
+    by hashing each page, unless the platform tracks dirty pages (the
+    soft-dirty bits on linux) since the parent was taken, in which
+    case the clean pages are not even read.
+
+    The pages are read (and compressed) by up to workers threads (see
+    captureMemory) and progress (if specified) is called as
+    progress(bytesdone, bytestotal) as they are written.
+    """
+    sd = getSnapInfo(trace)
+
+    writer = SnapshotWriter(filename, compress=compress, parent=parent)
+
+    # The dirty page bits are only good since the snapshot which
+    # last cleared them...
+    usedirty = (parent != None and
+                trace.getMeta("SnapshotDirtyId") == writer.parentid)
+
+    mapinfos = []
+    runs = []
+    total = 0
+    for memmap in trace.getMemoryMaps():
+        dirty = None
+        if usedirty:
+            try:
+                dirty = trace.platformGetDirtyPages(memmap[0], memmap[1])
+            except Exception, e:
+                pass
+        mapinfo, mapruns = writer.planMap(memmap, dirty=dirty)
+        mapinfos.append(mapinfo)
+        for run in mapruns:
+            runs.append((mapinfo, run))
+            total += writer.getRunSize(mapinfo, run)
+
+    def readrun(memobj, (mapinfo, run)):
+        return writer.readPages(memobj, mapinfo, run)
+
+    failed = dict()
+    done = 0
+    capture = captureMemory(trace, readrun, runs, workers=workers)
+    for (mapinfo, run), ret in itertools.izip(runs, capture):
+        done += writer.getRunSize(mapinfo, run)
+        if progress != None:
+            progress(done, total)
+
+        va = mapinfo[0][0]
+        if failed.has_key(va):
+            continue
+        if isinstance(ret, Exception):
+            failed[va] = ret
+            continue
+        writer.storePages(mapinfo, run, ret)
+
+    for mapinfo in mapinfos:
+        va = mapinfo[0][0]
+        msg = failed.get(va)
+        if msg != None:
+            print >> sys.stderr, "WARNING: Can't snapshot memmap at 0x%.8x (%s)" % (va,msg)
+            continue
+        writer.finishMap(mapinfo)
+
+    writer.close(sd)
+
+    dirtyid = None
+    if trace.platformClearDirtyPages():
+        dirtyid = writer.snapid
+    trace.setMeta("SnapshotDirtyId", dirtyid)
@@ -0,0 +1,194 @@
+"""
+A persistent cache of the symbols parsed from binaries, so a trace
+doesn't re-parse every shared library each time it attaches.
+
+The cache directory (~/.vtrace/symcache by default) holds:
+
+    <sha1 of the contents>.syms - the symbol table for a binary
+    <sha1 of the path>.path     - the mtime, size and contents sha1
+                                  last seen for a file path
+
+The contents hash is only re-computed when a file's mtime or size
+changes, and a changed binary simply hashes to a new .syms file.
+
+A .syms file is a header, a table of fixed size symbol records and
+the symbol name strings (see symfile_* below) so it may be mapped
+and unpacked without any parsing.
+"""
+import os
+import mmap
+import struct
+import hashlib
+
+import envi.config as e_config
+import envi.resolver as e_resolv
+
+# Symbol types stored in the cache
+SYMCACHE_SYMBOL = 0
+SYMCACHE_FUNCTION = 1
+SYMCACHE_SECTION = 2
+
+symclasses = {
+    SYMCACHE_SYMBOL:e_resolv.Symbol,
+    SYMCACHE_FUNCTION:e_resolv.FunctionSymbol,
+    SYMCACHE_SECTION:e_resolv.SectionSymbol,
+}
+
+SYMFILE_MAGIC = "VTSYMCCH"
+SYMFILE_VERSION = 1
+
+# magic, version, absolute (don't add the base address), record count
+symfile_header = struct.Struct("<8sIII")
+# value, size, name offset, name length, symbol type
+symfile_record = "QQIIB3x"
+
+def buildSymbols(symtups, baseaddr, normname):
+    """
+    Make envi Symbol objects from (symtype, name, value, size) tuples
+    (adding baseaddr to each value).
+    """
+    ret = []
+    for symtype, name, value, size in symtups:
+        symclass = symclasses.get(symtype, e_resolv.Symbol)
+        ret.append(symclass(name, value+baseaddr, size, normname))
+    return ret
+
+class SymbolCache:
+    """
+    The on-disk symbol cache (see the module docs).  If no cache
+    directory is given, ~/.vtrace/symcache is used.
+    """
+    def __init__(self, cachedir=None):
+        if cachedir == None:
+            cachedir = e_config.gethomedir(".vtrace", "symcache")
+        elif not os.path.exists(cachedir):
+            os.makedirs(cachedir)
+        self.cachedir = cachedir
+
+    def _cachePath(self, name):
+        return os.path.join(self.cachedir, name)
+
+    def _writeFile(self, name, bytes):
+        # Write to a temp file and rename so readers never see a
+        # partial file (and racing writers just write the same thing)
+        path = self._cachePath(name)
+        tmppath = "%s.%d.tmp" % (path, os.getpid())
+        f = file(tmppath, "wb")
+        try:
+            f.write(bytes)
+        finally:
+            f.close()
+        try:
+            os.rename(tmppath, path)
+        except OSError:
+            # Windows won't rename over an existing file
+            if os.path.exists(path):
+                os.unlink(path)
+            os.rename(tmppath, path)
+
+    def getFileHash(self, filename):
+        """
+        Return the sha1 (hex) of the contents of filename, only
+        re-hashing the file if its mtime or size has changed.
+        """
+        filename = os.path.abspath(filename)
+        st = os.stat(filename)
+        stamp = "%r %d" % (st.st_mtime, st.st_size)
+
+        pathname = hashlib.sha1(filename).hexdigest() + ".path"
+        try:
+            line = file(self._cachePath(pathname), "rb").read()
+            lstamp, fhash = line.rsplit(" ", 1)
+            if lstamp == stamp:
+                return fhash.strip()
+        except Exception, e:
+            pass
+
+        h = hashlib.sha1()
+        f = file(filename, "rb")
+        try:
+            while True:
+                bytes = f.read(0x100000)
+                if not bytes:
+                    break
+                h.update(bytes)
+        finally:
+            f.close()
+        fhash = h.hexdigest()
+
+        try:
+            self._writeFile(pathname, "%s %s\n" % (stamp, fhash))
+        except Exception, e:
+            pass # A read only cache still hashes...
+
+        return fhash
+
+    def getSymbols(self, filename):
+        """
+        Return (absolute, symtups) for the cached symbols of a binary
+        (where symtups is a list of (symtype, name, value, size) tuples)
+        or None if the binary is not in the cache.
+        """
+        try:
+            path = self._cachePath(self.getFileHash(filename) + ".syms")
+            if not os.path.exists(path):
+                return None
+
+            f = file(path, "rb")
+            try:
+                fmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            finally:
+                f.close()
+
+            try:
+                magic, vers, absolute, count = symfile_header.unpack_from(fmap, 0)
+                if magic != SYMFILE_MAGIC or vers != SYMFILE_VERSION:
+                    return None
+
+                recfmt = "<" + (symfile_record * count)
+                fields = struct.unpack_from(recfmt, fmap, symfile_header.size)
+                stroff = symfile_header.size + struct.calcsize(recfmt)
+                strtab = fmap[stroff:]
+            finally:
+                fmap.close()
+
+        except Exception, e:
+            return None # A broken cache entry is just a miss
+
+        symtups = []
+        for i in xrange(0, len(fields), 5):
+            value, size, nameoff, namelen, symtype = fields[i:i+5]
+            symtups.append((symtype, strtab[nameoff:nameoff+namelen], value, size))
+
+        return bool(absolute), symtups
+
+    def setSymbols(self, filename, absolute, symtups):
+        """
+        Store the (symtype, name, value, size) symbol tuples parsed
+        from a binary.  Set absolute if the values should not have the
+        base address added (prelinked binaries...).
+        """
+        fields = []
+        names = []
+        nameoff = 0
+        for symtype, name, value, size in symtups:
+            fields.extend((value, size, nameoff, len(name), symtype))
+            names.append(name)
+            nameoff += len(name)
+
+        bytes = symfile_header.pack(SYMFILE_MAGIC, SYMFILE_VERSION, int(bool(absolute)), len(symtups))
+        bytes += struct.pack("<" + (symfile_record * len(symtups)), *fields)
+        bytes += "".join(names)
+
+        try:
+            self._writeFile(self.getFileHash(filename) + ".syms", bytes)
+        except Exception, e:
+            pass # Caching is best effort
+
+    def clear(self):
+        """
+        Remove all the entries from the cache.
+        """
+        for name in os.listdir(self.cachedir):
+            if name.endswith(".syms") or name.endswith(".path"):
+                os.unlink(self._cachePath(name))
@@ -0,0 +1,102 @@
+"""
+Benchmark the process memory write paths of a (linux) trace.
+
+Usage: python -m vtrace.tools.membench [<size> [<cmdline>]]
+
+Execute cmdline (default "/bin/sleep 100") under vtrace and time
+writing size bytes (default 1MB, or less if the process has no writable
+map that big) into its largest writable memory map with
+process_vm_writev, the /proc/<pid>/mem memfile and word at a time
+ptrace writes.
+"""
+import sys
+import time
+
+import vtrace
+import envi.memory as e_mem
+
+# (name, use process_vm_writev, use the memfile)
+write_paths = [
+    ("process_vm_writev", True, False),
+    ("/proc/pid/mem", False, True),
+    ("ptrace", False, False),
+]
+
+def findWritableMap(trace):
+    """
+    Return the (va, size) of the largest writable map (or None).
+    """
+    ret = None
+    for va, msize, perms, fname in trace.getMemoryMaps():
+        if not perms & e_mem.MM_WRITE:
+            continue
+        if ret == None or msize > ret[1]:
+            ret = (va, msize)
+    return ret
+
+def benchWrites(trace, size=0x100000):
+    """
+    Time a size byte write (clamped to the largest writable map) with
+    each of the write paths the trace supports and return a list of
+    (name, bytes, seconds) tuples.
+    """
+    if not hasattr(trace, "vmwritev"):
+        raise Exception("The %s platform has only one write path" % trace.getMeta("Platform"))
+
+    map = findWritableMap(trace)
+    if map == None:
+        raise Exception("No writable memory maps")
+    va, msize = map
+    size = min(size, msize)
+
+    orig = trace.readMemory(va, size)
+    saved = (trace.vmwritev, trace.memwrite)
+
+    ret = []
+    try:
+        for i, (name, vmwritev, memwrite) in enumerate(write_paths):
+            if vmwritev and not saved[0]:
+                continue
+            if memwrite and not saved[1]:
+                continue
+            # Each path writes different bytes so the check below
+            # can't be fooled by what an earlier path wrote.
+            data = chr(0x41 + i) * size
+            trace.vmwritev = vmwritev
+            trace.memwrite = memwrite
+            start = time.time()
+            trace.writeMemory(va, data)
+            ret.append((name, size, time.time() - start))
+            if trace.readMemory(va, size) != data:
+                raise Exception("%s write did not take!" % name)
+
+    finally:
+        trace.vmwritev, trace.memwrite = saved
+        trace.writeMemory(va, orig)
+
+    return ret
+
+def main(argv):
+    size = 0x100000
+    cmdline = "/bin/sleep 100"
+    if len(argv) > 0:
+        size = int(argv[0], 0)
+    if len(argv) > 1:
+        cmdline = " ".join(argv[1:])
+
+    trace = vtrace.getTrace()
+    trace.execute(cmdline)
+    try:
+        for name, bytes, t in benchWrites(trace, size):
+            if t == 0:
+                print "%20s: %d bytes (too fast to time)" % (name, bytes)
+                continue
+            rate = (bytes / t) / (1024 * 1024)
+            print "%20s: %d bytes %.2f ms (%.2f MB/sec)" % (name, bytes, t * 1000, rate)
+    finally:
+        trace.kill()
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))